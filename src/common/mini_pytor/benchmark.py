@@ -0,0 +1,1143 @@
+"""
+Micro-benchmarks for the hot paths of the onion routing code.
+Run with: python benchmark.py [benchmark]
+Load tests spawn their own directory and relays, so stop any running ones first.
+"""
+import contextlib
+import os
+import pickle
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import types
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+
+import requests
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives import padding as sym_padding
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+
+import consensus
+import httpcache
+import util
+from cell import Cell, CellType
+from client import Client, DirectoryCache, ThreadingHTTPServer, choose_path
+from framing import FrameReader, pack_header, send_frames
+from relay import RESPONSE_READ_SIZE, Relay
+
+HOP_COUNTS = (3, 4, 5)
+REPEATS = 2000
+CRYPTO_HOP_COUNTS = (3, 5)
+CRYPTO_BODY_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 4096  # body bytes per frame, as sent by the exit relay
+PEEL_RUN_LENGTHS = (1, 16, 256)  # frames peeled together by the client
+SEND_BODY_SIZES = (1, 10, 50)  # megabytes
+SAMPLE_URL = b"http://www.example.com/some/page.html?with=query&and=more"
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DIRECTORY_ADDRESS = ("127.0.0.1", 50000)
+LOAD_RELAYS = {"a": 45000, "b": 45001, "c": 45002}
+LOAD_CIRCUITS = (1, 8, 32)
+LOAD_REQUESTS = 4  # sequential requests made on every circuit
+LOAD_BODY_SIZE = 256 * 1024
+BUILD_REPEATS = 10
+KEYPOOL_BURSTS = (8, 32, 128)  # handshakes started back to back
+HANDSHAKE_REPEATS = 200
+RELAY_WORKERS = (1, 4)  # worker processes per relay
+WORKER_BUILDS = 32  # circuits built at once against each setup
+STORM_HANDSHAKES = 48  # handshakes thrown at the first relay
+STORM_THREADS = 4
+STORM_BODY_SIZE = 16 * 1024
+DIRECTORY_SIZES = (1000, 10000)  # relays listed during the listing load test
+LISTING_THREADS = 8
+LISTING_SECONDS = 3
+CHURN_SIZES = (1000, 10000)  # relays listed while some come and go
+CHURN_RATES = (0.001, 0.01, 0.1)  # share of the relays replaced per refresh
+CONSENSUS_RELAYS = 10000
+PATH_RELAYS = 50
+PATH_CIRCUITS = 500  # 3 hop circuits placed on the simulated network
+PATH_BANDWIDTHS = (100e3, 10e6)  # bytes per second, slowest and fastest
+MIRROR_ADDRESS = ("127.0.0.1", 50001)
+LINK_CIRCUITS = (1, 8, 32)
+LINK_STREAMS = (1, 4, 16)  # requests in flight on one circuit
+FETCH_REPEATS = 300
+FETCH_THREADS = (1, 8)
+FETCH_BODY_SIZE = 16 * 1024
+CACHE_BODY_SIZES = (16 * 1024, 1024 * 1024)
+PROXY_PORT = 27182
+REVISITS = 20  # times the browser comes back to the same page
+
+
+def _encrypt(key, data):
+    """Per-cell AES-CBC with a fresh IV and padding, as cells used to be
+    encrypted before the per-circuit AES-CTR streams."""
+    init_vector = os.urandom(16)
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(init_vector),
+                       backend=default_backend()).encryptor()
+    padder = sym_padding.PKCS7(128).padder()
+    data = padder.update(data) + padder.finalize()
+    return encryptor.update(data) + encryptor.finalize(), init_vector
+
+
+def _decrypt(key, cell):
+    """Inverse of _encrypt."""
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(cell.init_vector),
+                       backend=default_backend()).decryptor()
+    unpadder = sym_padding.PKCS7(128).unpadder()
+    return unpadder.update(
+        decryptor.update(cell.payload) + decryptor.finalize()) \
+        + unpadder.finalize()
+
+
+def wrap_onion(keys, dumps):
+    """Build a request onion the way Client.req_wrapper does."""
+    sending_cell = Cell(SAMPLE_URL, ctype=CellType.REQ)
+    for i in range(len(keys) - 1, -1, -1):
+        encrypted, init_vector = _encrypt(keys[i], dumps(sending_cell))
+        sending_cell = Cell(encrypted, IV=init_vector, ctype=CellType.RELAY)
+        sending_cell.ip_addr = "127.0.0.1"
+        sending_cell.port = 45000 + i
+        if i != 0:
+            sending_cell = Cell(dumps(sending_cell), ctype=CellType.RELAY)
+    return dumps(sending_cell)
+
+
+def peel_onion(keys, wire, loads):
+    """Peel the onion hop by hop, the way each relay does."""
+    for key in keys:
+        cell = loads(_decrypt(key, loads(wire)))
+        wire = cell.payload
+    return wire
+
+
+def bench_cells():
+    """Compare the binary cell codec with the old pickle serialisation."""
+    codecs = {
+        "pickle": (pickle.dumps, pickle.loads),
+        "binary": (Cell.to_bytes, Cell.from_bytes),
+    }
+    print(f"{'hops':>4} {'codec':>7} {'wire bytes':>10} "
+          f"{'wrap us':>9} {'peel us':>9}")
+    for hops in HOP_COUNTS:
+        keys = [os.urandom(32) for _ in range(hops)]
+        for name, (dumps, loads) in codecs.items():
+            wire = wrap_onion(keys, dumps)
+            assert peel_onion(keys, wire, loads) == SAMPLE_URL
+            wrap_time = timeit.timeit(
+                lambda: wrap_onion(keys, dumps), number=REPEATS)
+            peel_time = timeit.timeit(
+                lambda: peel_onion(keys, wire, loads), number=REPEATS)
+            print(f"{hops:>4} {name:>7} {len(wire):>10} "
+                  f"{wrap_time / REPEATS * 1e6:>9.1f} "
+                  f"{peel_time / REPEATS * 1e6:>9.1f}")
+
+
+def cbc_seal(keys, chunk):
+    """Send a chunk back to the client the old way: the exit relay
+    encrypts a cell, and every hop wraps it in a cell and encrypts again."""
+    encrypted, init_vector = _encrypt(
+        keys[-1], Cell(chunk, ctype=CellType.CONTINUE).to_bytes())
+    wire = Cell(encrypted, IV=init_vector, ctype=CellType.CONTINUE).to_bytes()
+    for key in reversed(keys[:-1]):
+        encrypted, init_vector = _encrypt(
+            key, Cell(wire, ctype=CellType.CONNECT_RESP).to_bytes())
+        wire = Cell(encrypted, IV=init_vector,
+                    ctype=CellType.CONTINUE).to_bytes()
+    return wire
+
+
+def cbc_open(keys, wire):
+    """Peel a chunk sent by cbc_seal, the way the client used to."""
+    cell = Cell.from_bytes(wire)
+    for i, key in enumerate(keys):
+        cell = Cell.from_bytes(_decrypt(key, cell))
+        if i < len(keys) - 1:
+            cell = Cell.from_bytes(cell.payload)
+    return cell.payload
+
+
+def ctr_seal(ciphers, chunk):
+    """Send a chunk back through the relays' AES-CTR streams."""
+    wire = ciphers[-1].backward.update(
+        Cell(chunk, ctype=CellType.CONTINUE).to_bytes())
+    for cipher in reversed(ciphers[:-1]):
+        wire = cipher.backward.update(wire)
+    return wire
+
+
+def ctr_open(ciphers, wire):
+    """Peel a chunk sent by ctr_seal, the way Client.chain_decryptor does."""
+    for cipher in ciphers:
+        wire = cipher.backward.update(wire)
+    return Cell.from_bytes(wire).payload
+
+
+def bench_crypto():
+    """Throughput of the onion layers on a streamed response,
+    per-cell AES-CBC against per-circuit AES-CTR streams."""
+    body = os.urandom(CRYPTO_BODY_SIZE)
+    chunks = [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+    megabytes = len(body) / 1e6
+    print(f"{'hops':>4} {'cipher':>7} {'MB/s/layer':>10} "
+          f"{'relays MB/s':>11} {'client MB/s':>11}")
+    for hops in CRYPTO_HOP_COUNTS:
+        keys = [os.urandom(util.DERIVED_KEY_SIZE) for _ in range(hops)]
+        modes_under_test = {
+            # the two ends of the circuit each keep their own streams.
+            "cbc": (cbc_seal, cbc_open, [key[:32] for key in keys],
+                    [key[:32] for key in keys]),
+            "ctr": (ctr_seal, ctr_open,
+                    [util.LayerCipher(key) for key in keys],
+                    [util.LayerCipher(key) for key in keys]),
+        }
+        for name, (seal, peel, relay_side, client_side) in \
+                modes_under_test.items():
+            start = time.perf_counter()
+            wires = [seal(relay_side, chunk) for chunk in chunks]
+            seal_time = time.perf_counter() - start
+            start = time.perf_counter()
+            peeled = [peel(client_side, wire) for wire in wires]
+            peel_time = time.perf_counter() - start
+            assert b"".join(peeled) == body
+            print(f"{hops:>4} {name:>7} "
+                  f"{megabytes * hops / seal_time:>10.1f} "
+                  f"{megabytes / seal_time:>11.1f} "
+                  f"{megabytes / peel_time:>11.1f}")
+
+
+def bench_peel():
+    """Client decryption of a streamed response, frame by frame with
+    Client.chain_decryptor against runs of frames with Client._peel_run."""
+    body = os.urandom(CRYPTO_BODY_SIZE)
+    chunks = [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+    megabytes = len(body) / 1e6
+    print(f"{'hops':>4} {'frames/run':>10} {'client MB/s':>11}")
+    for hops in CRYPTO_HOP_COUNTS:
+        keys = [os.urandom(util.DERIVED_KEY_SIZE) for _ in range(hops)]
+        relay_side = [util.LayerCipher(key) for key in keys]
+        wires = [ctr_seal(relay_side, chunk) for chunk in chunks]
+
+        my_client = Client()
+
+        def reset_streams():
+            """Give the client a fresh set of streams to peel with."""
+            my_client.relay_list = [
+                types.SimpleNamespace(cipher=util.LayerCipher(key))
+                for key in keys]
+            my_client.run_buffer = bytearray()
+
+        reset_streams()
+        start = time.perf_counter()
+        peeled = b"".join(
+            Client.chain_decryptor(my_client.relay_list, wire).payload
+            for wire in wires)
+        peel_time = time.perf_counter() - start
+        assert peeled == body
+        print(f"{hops:>4} {'per frame':>10} {megabytes / peel_time:>11.1f}")
+
+        for run_length in PEEL_RUN_LENGTHS:
+            reset_streams()
+            start = time.perf_counter()
+            peeled = bytearray()
+            for i in range(0, len(wires), run_length):
+                for _, payload in my_client._peel_run(  # pylint: disable=protected-access
+                        wires[i:i + run_length]):
+                    peeled += payload
+            peel_time = time.perf_counter() - start
+            assert peeled == body
+            print(f"{hops:>4} {run_length:>10} {megabytes / peel_time:>11.1f}")
+
+
+def send_sliced(client_reference, sock, body):
+    """Frame and send a response the way the exit relay used to: slice
+    4096 bytes off the front of a bytearray at a time, encrypt each chunk
+    as a cell and send header and body joined together."""
+    payload_bytes = bytearray(body)
+    while payload_bytes:
+        out_cell = Relay.seal(
+            client_reference,
+            Cell(bytes(payload_bytes[:CHUNK_SIZE]), ctype=CellType.CONTINUE))
+        sock.sendall(pack_header(CellType.CONTINUE, len(out_cell)) + out_cell)
+        del payload_bytes[:CHUNK_SIZE]
+
+
+def send_gathered(client_reference, sock, body):
+    """Frame and send a response the way the exit relay does now."""
+    body = memoryview(body)
+    # the first piece stands in for the response head.
+    pieces = (body[i:i + RESPONSE_READ_SIZE]
+              for i in range(0, len(body), RESPONSE_READ_SIZE))
+    for frames in Relay.response_frames(client_reference, pieces):
+        send_frames(sock, frames)
+
+
+def drain(sock):
+    """Read and drop everything until the other end hangs up."""
+    buffer = bytearray(1 << 20)
+    while sock.recv_into(buffer):
+        pass
+
+
+def bench_send():
+    """Exit relay framing and sending of large responses over a local
+    socket, slicing a bytearray against gathered memoryview frames."""
+    senders = {"sliced": send_sliced, "gathered": send_gathered}
+    print(f"{'MB':>4} {'sender':>9} {'seconds':>8} {'MB/s':>8}")
+    for megabytes in SEND_BODY_SIZES:
+        body = os.urandom(megabytes * 1000 * 1000)
+        for name, sender in senders.items():
+            client_reference = {
+                "cipher": util.LayerCipher(os.urandom(util.DERIVED_KEY_SIZE))}
+            sending, receiving = socket.socketpair()
+            reader = threading.Thread(target=drain, args=(receiving,))
+            reader.start()
+            start = time.perf_counter()
+            # the relay prints a line for every frame it sends.
+            with open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                sender(client_reference, sending, body)
+            sending.shutdown(socket.SHUT_WR)
+            reader.join()
+            elapsed = time.perf_counter() - start
+            sending.close()
+            receiving.close()
+            print(f"{megabytes:>4} {name:>9} {elapsed:>8.3f} "
+                  f"{megabytes / elapsed:>8.1f}")
+
+
+def start_origin(body_size, keep_alive=False, cache_control=None):
+    """Serve a random body of body_size bytes, returning the server and URL.
+    With keep_alive, connections stay open between requests; cache_control
+    is sent as the Cache-Control header, if given."""
+    body = os.urandom(body_size)
+
+    class OriginHandler(BaseHTTPRequestHandler):
+        """Answers every GET with the same body"""
+        protocol_version = "HTTP/1.1" if keep_alive else "HTTP/1.0"
+        disable_nagle_algorithm = True  # headers and body go out apart
+
+        def do_GET(self):
+            """Get request response method"""
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            if cache_control is not None:
+                self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler,
+                                 max(LOAD_CIRCUITS))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def port_open(port):
+    """Whether something is listening on a local port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+def wait_for_port(port, timeout=60):
+    """Block until a spawned server is listening on port."""
+    deadline = time.monotonic() + timeout
+    while not port_open(port):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Nothing came up on port {port}")
+        time.sleep(0.1)
+
+
+def network_running():
+    """Whether a directory is already up, complaining if so."""
+    if port_open(DIRECTORY_ADDRESS[1]):
+        print("A directory is already running, stop it first.",
+              file=sys.stderr)
+        return True
+    return False
+
+
+def spawn(*args):
+    """Run one of the scripts next to this one, without its output."""
+    return subprocess.Popen([sys.executable] + list(args), cwd=HERE,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def start_network(relay_options=()):
+    """Spawn a directory and the load test relays, returning the processes."""
+    processes = [spawn("directory.py")]
+    wait_for_port(DIRECTORY_ADDRESS[1])
+    for name in LOAD_RELAYS:
+        processes.append(spawn("relay.py", name, *relay_options))
+    for port in LOAD_RELAYS.values():
+        wait_for_port(port)
+    time.sleep(0.5)  # let the relays register with the directory
+    return processes
+
+
+def stop_network(processes):
+    """Stop everything spawned by start_network."""
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def run_load(url, circuits, requests_per_circuit):
+    """Make requests over many circuits at once.
+    Returns the wall time, the latency of each request and the failures.
+    Every circuit takes the relays in the same order, so runs compare."""
+    clients = [Client.build_circuit(DIRECTORY_ADDRESS, len(LOAD_RELAYS),
+                                    "fixed")
+               for _ in range(circuits)]
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(circuits + 1)
+
+    def worker(my_client):
+        barrier.wait()
+        for _ in range(requests_per_circuit):
+            start = time.perf_counter()
+            response = my_client.req(url)
+            elapsed = time.perf_counter() - start
+            with lock:
+                if isinstance(response, str):
+                    failures.append(elapsed)
+                else:
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(my_client,))
+               for my_client in clients]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+    for my_client in clients:
+        my_client.close()
+    return wall_time, latencies, failures
+
+
+def load_test(modes):
+    """Run the concurrent circuit load test against each relay mode.
+    modes maps a label to the extra arguments given to relay.py."""
+    if network_running():
+        return
+    origin, url = start_origin(LOAD_BODY_SIZE)
+    print(f"{'mode':>8} {'circuits':>8} {'req/s':>8} {'MB/s':>7} "
+          f"{'p50 ms':>8} {'max ms':>8} {'failed':>6}")
+    try:
+        for label, relay_options in modes.items():
+            processes = start_network(relay_options)
+            try:
+                for circuits in LOAD_CIRCUITS:
+                    wall_time, latencies, failures = run_load(
+                        url, circuits, LOAD_REQUESTS)
+                    latencies.sort()
+                    done = len(latencies)
+                    p50 = latencies[done // 2] * 1000 if done else 0
+                    slowest = latencies[-1] * 1000 if done else 0
+                    print(f"{label:>8} {circuits:>8} "
+                          f"{done / wall_time:>8.1f} "
+                          f"{done * LOAD_BODY_SIZE / wall_time / 1e6:>7.2f} "
+                          f"{p50:>8.0f} {slowest:>8.0f} {len(failures):>6}")
+            finally:
+                stop_network(processes)
+    finally:
+        origin.shutdown()
+
+
+def bench_relay():
+    """Concurrent circuit throughput of the select loop and asyncio relays."""
+    load_test({"select": (), "async": ("--async",)})
+
+
+def build_inline(relay_list):
+    """Build a circuit the old way, making each hop's handshake only
+    when its turn comes."""
+    my_client = Client()
+    for i, relay in enumerate(relay_list):
+        my_client.connect_relay(
+            relay["ip_addr"], relay["port"], relay["public_key"], i)
+    return my_client
+
+
+def bench_build():
+    """Where the time goes when building a 3 hop circuit."""
+    if network_running():
+        return
+    processes = start_network()
+    try:
+        directory = DirectoryCache(DIRECTORY_ADDRESS)
+        relay_list = directory.refresh()
+        stage_times = {}
+        for _ in range(BUILD_REPEATS):
+            my_client = Client.build_circuit(
+                DIRECTORY_ADDRESS, len(LOAD_RELAYS), directory_cache=directory)
+            assert len(my_client.relay_list) == len(LOAD_RELAYS)
+            my_client.close()
+            for stage, seconds in my_client.build_timings.items():
+                stage_times[stage] = stage_times.get(stage, 0) + seconds
+        start = time.perf_counter()
+        for _ in range(BUILD_REPEATS):
+            build_inline(relay_list).close()
+        inline_time = time.perf_counter() - start
+    finally:
+        stop_network(processes)
+    print(f"{'stage':>10} {'ms':>8}")
+    for stage, seconds in stage_times.items():
+        print(f"{stage:>10} {seconds / BUILD_REPEATS * 1000:>8.2f}")
+    print(f"{'inline':>10} {inline_time / BUILD_REPEATS * 1000:>8.2f}")
+
+
+def handshake_burst(rsa_public_key, count):
+    """Start count handshakes back to back, returning the seconds taken."""
+    start = time.perf_counter()
+    for _ in range(count):
+        Client.make_first_connect_cell(rsa_public_key)
+    return time.perf_counter() - start
+
+
+def bench_keypool():
+    """Handshake bursts with ephemeral keys from a warmed pool, and made
+    on the spot as they used to be."""
+    rsa_public_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=4096,
+        backend=default_backend()).public_key()
+    pooled_keys = Client.ephemeral_keys
+    print(f"{'burst':>6} {'inline ms':>10} {'pooled ms':>10} {'drawn':>6}")
+    try:
+        for count in KEYPOOL_BURSTS:
+            Client.ephemeral_keys = util.EphemeralKeyPool(0)
+            inline_time = handshake_burst(rsa_public_key, count)
+            Client.ephemeral_keys = util.EphemeralKeyPool()
+            Client.ephemeral_keys.start()
+            while Client.ephemeral_keys.stats()["available"] \
+                    < Client.ephemeral_keys.size:
+                time.sleep(0.01)
+            pooled_time = handshake_burst(rsa_public_key, count)
+            stats = Client.ephemeral_keys.stats()
+            drawn = stats["taken"] - stats["inline"]
+            print(f"{count:>6} {inline_time / count * 1000:>10.3f} "
+                  f"{pooled_time / count * 1000:>10.3f} {drawn:>6}")
+    finally:
+        Client.ephemeral_keys = pooled_keys
+
+
+def bench_handshake():
+    """Handshakes per second on one core for each suite, with every
+    ephemeral key made on the spot so its cost is counted."""
+    pooled_keys = Client.ephemeral_keys, Client.x25519_keys
+    Client.ephemeral_keys = util.EphemeralKeyPool(0)
+    Client.x25519_keys = util.EphemeralKeyPool(
+        0, make_key_pair=util.x25519_key_pair)
+    print(f"{'suite':>8} {'relay/s':>9} {'client/s':>9}")
+    try:
+        for suite in util.HANDSHAKE_SUITES:
+            relay = Relay(0, "0", None, 0, suite)
+            relay.relay_socket.close()
+            public_key = relay.true_private_key.public_key()
+            relay_time = client_time = 0
+            for _ in range(HANDSHAKE_REPEATS):
+                start = time.perf_counter()
+                body, private_key = Client.make_first_connect_cell(public_key)
+                middle = time.perf_counter()
+                _, derived_key, reply = relay.make_key_reply(
+                    relay.open_handshake(body))
+                end = time.perf_counter()
+                assert Client.check_signature_and_derive(
+                    Cell.from_bytes(reply), public_key,
+                    private_key) == derived_key
+                client_time += middle - start + time.perf_counter() - end
+                relay_time += end - middle
+            print(f"{suite:>8} {HANDSHAKE_REPEATS / relay_time:>9.0f} "
+                  f"{HANDSHAKE_REPEATS / client_time:>9.0f}")
+    finally:
+        Client.ephemeral_keys, Client.x25519_keys = pooled_keys
+
+
+def build_burst(count):
+    """Build count circuits at once, returning the seconds it took and how
+    many of them reached every relay."""
+    directory = DirectoryCache(DIRECTORY_ADDRESS)
+    directory.refresh()
+    clients = []
+    lock = threading.Lock()
+
+    def build():
+        my_client = Client.build_circuit(
+            DIRECTORY_ADDRESS, len(LOAD_RELAYS), "fixed", directory)
+        with lock:
+            clients.append(my_client)
+
+    threads = [threading.Thread(target=build) for _ in range(count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    built = sum(len(my_client.relay_list) == len(LOAD_RELAYS)
+                for my_client in clients)
+    for my_client in clients:
+        my_client.close()
+    return elapsed, built
+
+
+def bench_workers():
+    """Circuits built per second when every relay runs several worker
+    processes. Only helps with more than one core to spread them over."""
+    if network_running():
+        return
+    print(f"{os.cpu_count()} cores")
+    print(f"{'workers':>8} {'builds/s':>9} {'built':>6}")
+    for workers in RELAY_WORKERS:
+        processes = start_network((f"--workers={workers}",))
+        try:
+            elapsed, built = build_burst(WORKER_BUILDS)
+        finally:
+            stop_network(processes)
+        print(f"{workers:>8} {built / elapsed:>9.1f} {built:>6}")
+
+
+def handshake_storm(port, bodies, done):
+    """Open a circuit to a relay for every prepared handshake body and
+    close it as soon as the relay answers."""
+    for body in bodies:
+        sock = socket.create_connection(("127.0.0.1", port))
+        with contextlib.closing(sock):
+            send_frames(sock, [(CellType.ADD_CON, body)])
+            FrameReader(sock).read_frame()
+        done.append(body)
+
+
+def bench_offload():
+    """Latency of requests on an established circuit while a storm of new
+    handshakes hits its first relay, with the handshakes answered in the
+    relay's loop and by crypto worker processes."""
+    if network_running():
+        return
+    origin, url = start_origin(STORM_BODY_SIZE)
+    print(f"{'mode':>8} {'hs/s':>6} {'requests':>8} {'p50 ms':>8} "
+          f"{'max ms':>8}")
+    try:
+        for label, relay_options in (("inline", ()),
+                                     ("offload", ("--crypto-workers=2",))):
+            processes = start_network(relay_options)
+            try:
+                first = DirectoryCache(DIRECTORY_ADDRESS).refresh()[0]
+                my_client = Client.build_circuit(
+                    DIRECTORY_ADDRESS, len(LOAD_RELAYS), "fixed")
+                my_client.req(url)  # also lets the crypto workers start
+                bodies = [Client.make_first_connect_cell(
+                    first["public_key"])[0]
+                          for _ in range(STORM_HANDSHAKES)]
+                done = []
+                threads = [threading.Thread(
+                    target=handshake_storm,
+                    args=(first["port"], bodies[i::STORM_THREADS], done))
+                           for i in range(STORM_THREADS)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                latencies = []
+                while any(thread.is_alive() for thread in threads):
+                    request_start = time.perf_counter()
+                    my_client.req(url)
+                    latencies.append(time.perf_counter() - request_start)
+                for thread in threads:
+                    thread.join()
+                storm_time = time.perf_counter() - start
+                my_client.close()
+            finally:
+                stop_network(processes)
+            latencies.sort()
+            print(f"{label:>8} {len(done) / storm_time:>6.1f} "
+                  f"{len(latencies):>8} "
+                  f"{latencies[len(latencies) // 2] * 1000:>8.1f} "
+                  f"{latencies[-1] * 1000:>8.1f}")
+    finally:
+        origin.shutdown()
+
+
+def register_fake_relays(count, first_port):
+    """Register count relays with the directory, all with the same key,
+    keeping their connections open. Returns the sockets."""
+    key = rsa.generate_private_key(
+        public_exponent=65537, key_size=4096, backend=default_backend())
+    salt = os.urandom(128)
+    directory_cell = Cell(
+        key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo),
+        signature=key.sign(salt, padding.PSS(
+            mgf=padding.MGF1(hashes.SHA256()),
+            salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256()),
+        salt=salt, ctype=CellType.GIVE_DIRECT)
+    socks = []
+    for port in range(first_port, first_port + count):
+        directory_cell.port = port
+        sock = socket.create_connection(DIRECTORY_ADDRESS)
+        send_frames(sock, [(CellType.GIVE_DIRECT, directory_cell.to_bytes())])
+        socks.append(sock)
+    return socks
+
+
+def fetch_listings(deadline, results):
+    """Fetch the directory listing over and over until the deadline,
+    without parsing it."""
+    request = Cell(b"", ctype=CellType.GET_DIRECT).to_bytes()
+    fetched = size = 0
+    while time.perf_counter() < deadline:
+        sock = socket.create_connection(DIRECTORY_ADDRESS)
+        with contextlib.closing(sock):
+            send_frames(sock, [(CellType.GET_DIRECT, request)])
+            frame = FrameReader(sock).read_frame()
+        fetched += 1
+        size = len(frame[2])
+    results.append((fetched, size))
+
+
+def bench_directory():
+    """Registrations and listings per second with thousands of relays
+    registered with the directory."""
+    if network_running():
+        return
+    util.raise_open_file_limit()
+    print(f"{'relays':>7} {'reg/s':>8} {'listings/s':>10} {'MB':>6}")
+    for count in DIRECTORY_SIZES:
+        directory = spawn("directory.py")
+        socks = []
+        try:
+            wait_for_port(DIRECTORY_ADDRESS[1])
+            start = time.perf_counter()
+            socks = register_fake_relays(count, 1)
+            while len(Client.get_directory_items(DIRECTORY_ADDRESS)) < count:
+                time.sleep(0.05)
+            registration_time = time.perf_counter() - start
+            results = []
+            deadline = time.perf_counter() + LISTING_SECONDS
+            threads = [threading.Thread(target=fetch_listings,
+                                        args=(deadline, results))
+                       for _ in range(LISTING_THREADS)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            listing_time = time.perf_counter() - start
+        finally:
+            for sock in socks:
+                sock.close()
+            directory.terminate()
+            directory.wait()
+        fetched = sum(fetched for fetched, _ in results)
+        print(f"{count:>7} {count / registration_time:>8.0f} "
+              f"{fetched / listing_time:>10.1f} {results[0][1] / 1e6:>6.2f}")
+
+
+def fetch_update_size(epoch=None, since=0):
+    """Bytes and frames the directory sends to bring a listing at version
+    since of epoch up to date, and the update itself."""
+    request = Cell(util.pack_directory_request(epoch, since),
+                   ctype=CellType.GET_DIRECT).to_bytes()
+    sock = socket.create_connection(DIRECTORY_ADDRESS)
+    size = frames = 0
+    with contextlib.closing(sock):
+        send_frames(sock, [(CellType.GET_DIRECT, request)])
+        reader = FrameReader(sock)
+        while True:
+            frame = reader.read_frame()
+            update = util.unpack_directory_update(
+                Cell.from_bytes(frame[2]).payload)
+            size += len(frame[2])
+            frames += 1
+            if not update["more"]:
+                return size, frames, update
+
+
+def bench_churn():
+    """Bytes a client downloads to refresh its listing, as a full snapshot
+    or as a diff, when a share of the relays has been replaced."""
+    if network_running():
+        return
+    util.raise_open_file_limit()
+    print(f"{'relays':>7} {'churn':>6} {'full KB':>9} {'frames':>6} "
+          f"{'diff KB':>9} {'frames':>6}")
+    for count in CHURN_SIZES:
+        directory = spawn("directory.py")
+        socks = []
+        try:
+            wait_for_port(DIRECTORY_ADDRESS[1])
+            socks = register_fake_relays(count, 1)
+            while len(Client.get_directory_items(DIRECTORY_ADDRESS)) < count:
+                time.sleep(0.05)
+            next_port = count + 1
+            for rate in CHURN_RATES:
+                _, _, update = fetch_update_size()
+                epoch, since = update["epoch"], update["version"]
+                replaced = max(int(count * rate), 1)
+                for sock in socks[:replaced]:
+                    sock.close()
+                socks = socks[replaced:] \
+                    + register_fake_relays(replaced, next_port)
+                next_port += replaced
+                # wait for the directory to see every change.
+                while fetch_update_size()[2]["version"] < since + 2 * replaced:
+                    time.sleep(0.05)
+                full_size, full_frames, _ = fetch_update_size()
+                diff_size, diff_frames, _ = fetch_update_size(epoch, since)
+                print(f"{count:>7} {rate:>6.1%} {full_size / 1e3:>9.1f} "
+                      f"{full_frames:>6} {diff_size / 1e3:>9.1f} "
+                      f"{diff_frames:>6}")
+        finally:
+            for sock in socks:
+                sock.close()
+            directory.terminate()
+            directory.wait()
+
+
+def fetch_consensus_documents(address, deadline, results):
+    """Fetch the consensus document from address over and over until the
+    deadline, without checking it."""
+    request = Cell(b"", ctype=CellType.GET_CONSENSUS).to_bytes()
+    fetched = size = 0
+    while time.perf_counter() < deadline:
+        sock = socket.create_connection(address)
+        with contextlib.closing(sock):
+            send_frames(sock, [(CellType.GET_CONSENSUS, request)])
+            frame = FrameReader(sock).read_frame()
+        fetched += 1
+        size = len(frame[2])
+    results.append((fetched, size))
+
+
+def process_cpu_seconds(pid):
+    """CPU time a process has used so far (Linux only)."""
+    with open(f"/proc/{pid}/stat") as stat_file:
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def bench_consensus():
+    """Time to sign a consensus document, and the directory's CPU time while
+    clients fetch it from the directory itself or from a mirror."""
+    if network_running():
+        return
+    util.raise_open_file_limit()
+    key = consensus.load_directory_key()
+    public_bytes = key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    relays = [{"ip_addr": "127.0.0.1", "port": port, "key": public_bytes}
+              for port in range(CONSENSUS_RELAYS)]
+    start = time.perf_counter()
+    document = consensus.pack_consensus(key, "epoch", 1, relays)
+    print(f"signing {CONSENSUS_RELAYS} relays: "
+          f"{(time.perf_counter() - start) * 1000:.0f} ms, "
+          f"{len(document) / 1e6:.2f} MB")
+
+    directory_key = consensus.load_directory_public_key()
+    directory = spawn("directory.py")
+    mirror = None
+    socks = []
+    try:
+        wait_for_port(DIRECTORY_ADDRESS[1])
+        socks = register_fake_relays(CONSENSUS_RELAYS, 1)
+        mirror = spawn("mirror.py")
+        wait_for_port(MIRROR_ADDRESS[1])
+        # wait for the mirror to serve the whole listing.
+        while True:
+            try:
+                document = Client.get_consensus(MIRROR_ADDRESS, directory_key)
+                if len(document["relays"]) == CONSENSUS_RELAYS:
+                    break
+            except (OSError, ValueError):
+                pass
+            time.sleep(0.5)
+        print(f"{'from':>10} {'fetches/s':>10} {'directory CPU s':>16}")
+        for label, address in (("directory", DIRECTORY_ADDRESS),
+                               ("mirror", MIRROR_ADDRESS)):
+            results = []
+            deadline = time.perf_counter() + LISTING_SECONDS
+            threads = [threading.Thread(target=fetch_consensus_documents,
+                                        args=(address, deadline, results))
+                       for _ in range(LISTING_THREADS)]
+            cpu_start = process_cpu_seconds(directory.pid)
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            cpu = process_cpu_seconds(directory.pid) - cpu_start
+            fetched = sum(fetched for fetched, _ in results)
+            print(f"{label:>10} {fetched / elapsed:>10.1f} {cpu:>16.2f}")
+    finally:
+        for sock in socks:
+            sock.close()
+        for process in (mirror, directory):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+
+def bench_paths():
+    """Simulated throughput of circuits placed on relays of mixed capacity,
+    picking paths uniformly or weighted by the relays' reported load.
+    A circuit gets the smallest share of bandwidth along its path."""
+    rng = random.Random(1)
+    low, high = PATH_BANDWIDTHS
+    capacities = [low * (high / low) ** rng.random()
+                  for _ in range(PATH_RELAYS)]
+    print(f"{'paths':>9} {'p50 KB/s':>9} {'p10 KB/s':>9} {'min KB/s':>9}")
+    for label in ("uniform", "weighted"):
+        random.seed(2)
+        relays = [{"ip_addr": "127.0.0.1", "port": port,
+                   "bandwidth": int(capacity), "circuits": 0}
+                  for port, capacity in enumerate(capacities)]
+        paths = []
+        for _ in range(PATH_CIRCUITS):
+            if label == "uniform":
+                path = random.sample(relays, 3)
+            else:
+                path = choose_path(relays, 3)
+            for relay in path:
+                relay["circuits"] += 1  # as the relays would report
+            paths.append(path)
+        rates = sorted(min(relay["bandwidth"] / relay["circuits"]
+                           for relay in path) for path in paths)
+        print(f"{label:>9} {rates[len(rates) // 2] / 1e3:>9.1f} "
+              f"{rates[len(rates) // 10] / 1e3:>9.1f} {rates[0] / 1e3:>9.1f}")
+
+
+def open_sockets(processes):
+    """Sockets the given processes hold open (Linux only)."""
+    count = 0
+    for process in processes:
+        fd_dir = f"/proc/{process.pid}/fd"
+        for fd in os.listdir(fd_dir):
+            with contextlib.suppress(OSError):
+                if os.readlink(os.path.join(fd_dir, fd)).startswith("socket:"):
+                    count += 1
+    return count
+
+
+def bench_links():
+    """Time to build a circuit while the relays still have to connect to
+    each other and once their links are open, sockets the relays hold for
+    many circuits over the same path, and requests per second with many
+    streams in flight on a single circuit."""
+    if network_running():
+        return
+    origin, url = start_origin(LOAD_BODY_SIZE)
+    processes = start_network()
+    try:
+        relays = processes[1:]
+        idle = open_sockets(relays)
+        for label in ("cold", "warm"):
+            start = time.perf_counter()
+            my_client = Client.build_circuit(DIRECTORY_ADDRESS,
+                                             len(LOAD_RELAYS), "fixed")
+            print(f"{label} links: built a circuit in "
+                  f"{(time.perf_counter() - start) * 1000:.1f} ms")
+            my_client.close()
+        print(f"{'circuits':>8} {'relay sockets':>14} {'one per hop':>12}")
+        for circuits in LINK_CIRCUITS:
+            clients = [Client.build_circuit(DIRECTORY_ADDRESS,
+                                            len(LOAD_RELAYS), "fixed")
+                       for _ in range(circuits)]
+            time.sleep(0.3)  # let the relays accept everything
+            # every circuit used to cost each relay a socket for each
+            # neighbour it talks to.
+            print(f"{circuits:>8} {open_sockets(relays) - idle:>14} "
+                  f"{circuits * (2 * len(LOAD_RELAYS) - 1):>12}")
+            for my_client in clients:
+                my_client.close()
+            time.sleep(0.5)
+
+        my_client = Client.build_circuit(DIRECTORY_ADDRESS, len(LOAD_RELAYS),
+                                         "fixed")
+        print(f"{'streams':>8} {'req/s':>8} {'MB/s':>7} {'failed':>6}")
+        for streams in LINK_STREAMS:
+            failures = []
+
+            def worker():
+                for _ in range(LOAD_REQUESTS):
+                    if isinstance(my_client.req(url), str):
+                        failures.append(1)
+
+            threads = [threading.Thread(target=worker) for _ in range(streams)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            done = streams * LOAD_REQUESTS - len(failures)
+            print(f"{streams:>8} {done / elapsed:>8.1f} "
+                  f"{done * LOAD_BODY_SIZE / elapsed / 1e6:>7.2f} "
+                  f"{len(failures):>6}")
+        my_client.close()
+    finally:
+        stop_network(processes)
+        origin.shutdown()
+
+
+def fetch_all(fetch, url, threads):
+    """Fetch url FETCH_REPEATS times over some threads, reading every
+    body to the end, and return the seconds it took."""
+    def worker(count):
+        for _ in range(count):
+            for _ in fetch(url):
+                pass
+
+    workers = [threading.Thread(target=worker,
+                                args=(FETCH_REPEATS // threads,))
+               for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def fetch_unpooled(url):
+    """Fetch the way the exit relay used to, with a connection per fetch."""
+    with requests.get(url, stream=True) as req:
+        yield req.status_code
+        yield from req.iter_content(RESPONSE_READ_SIZE)
+
+
+def bench_fetch():
+    """Fetches per second of small pages from a local website, making a
+    connection for each fetch or keeping them open in the exit's session."""
+    origin, url = start_origin(FETCH_BODY_SIZE, keep_alive=True)
+    relay = Relay(0, "0", None, 0)
+    relay.relay_socket.close()
+    print(f"{'threads':>7} {'fresh/s':>8} {'pooled/s':>9} {'reused':>7}")
+    try:
+        with contextlib.redirect_stdout(None):  # the relay's chatter
+            results = []
+            for threads in FETCH_THREADS:
+                fresh = fetch_all(fetch_unpooled, url, threads)
+                relay.counters["fetches"] = relay.counters["fetches_reused"] = 0
+                pooled = fetch_all(relay.fetch, url, threads)
+                results.append((threads, fresh, pooled,
+                                relay.counters["fetches_reused"]
+                                / relay.counters["fetches"]))
+        for threads, fresh, pooled, reused in results:
+            print(f"{threads:>7} {FETCH_REPEATS / fresh:>8.0f} "
+                  f"{FETCH_REPEATS / pooled:>9.0f} {reused:>7.0%}")
+    finally:
+        origin.shutdown()
+
+
+def bench_cache():
+    """Fetches per second of a cacheable page at the exit, going to the
+    website every time or answered from the exit's cache."""
+    print(f"{'body KB':>7} {'website/s':>10} {'cache/s':>8} {'hit ratio':>9}")
+    for body_size in CACHE_BODY_SIZES:
+        origin, url = start_origin(body_size, keep_alive=True,
+                                   cache_control="max-age=3600")
+        try:
+            with contextlib.redirect_stdout(None):  # the relay's chatter
+                uncached = Relay(0, "0", None, 0)
+                uncached.relay_socket.close()
+                cached = Relay(0, "0", None, 0, cache=httpcache.HttpCache())
+                cached.relay_socket.close()
+                website = fetch_all(uncached.fetch, url, 1)
+                cache = fetch_all(cached.fetch, url, 1)
+            print(f"{body_size // 1024:>7} {FETCH_REPEATS / website:>10.0f} "
+                  f"{FETCH_REPEATS / cache:>8.0f} "
+                  f"{cached.cache.stats()['hit_ratio']:>9.3f}")
+        finally:
+            origin.shutdown()
+
+
+def revisit(url, count):
+    """Load url through the client's proxy count times, returning the
+    average seconds a load took."""
+    proxy_url = f"http://127.0.0.1:{PROXY_PORT}/?" \
+        + urllib.parse.urlencode({"url": url})
+    start = time.perf_counter()
+    for _ in range(count):
+        with urllib.request.urlopen(proxy_url) as response:
+            response.read()
+    return (time.perf_counter() - start) / count
+
+
+def bench_revisit():
+    """Time the browser takes to load a page it has been to before,
+    through circuits every time or from the client's cache."""
+    if network_running():
+        return
+    origin, url = start_origin(LOAD_BODY_SIZE, cache_control="max-age=3600")
+    processes = start_network()
+    print(f"{'client cache':>12} {'first ms':>9} {'revisit ms':>11}")
+    try:
+        for label, options in (("off", ("--cache=0",)), ("on", ())):
+            client_process = spawn("client.py", *options)
+            try:
+                wait_for_port(PROXY_PORT)
+                first = revisit(url, 1)
+                again = revisit(url, REVISITS)
+            finally:
+                client_process.terminate()
+                client_process.wait()
+            print(f"{label:>12} {first * 1000:>9.1f} {again * 1000:>11.1f}")
+    finally:
+        stop_network(processes)
+        origin.shutdown()
+
+
+BENCHMARKS = {
+    "cells": bench_cells,
+    "crypto": bench_crypto,
+    "peel": bench_peel,
+    "send": bench_send,
+    "relay": bench_relay,
+    "build": bench_build,
+    "keypool": bench_keypool,
+    "handshake": bench_handshake,
+    "workers": bench_workers,
+    "offload": bench_offload,
+    "directory": bench_directory,
+    "churn": bench_churn,
+    "consensus": bench_consensus,
+    "paths": bench_paths,
+    "links": bench_links,
+    "fetch": bench_fetch,
+    "cache": bench_cache,
+    "revisit": bench_revisit,
+}
+
+
+def main():
+    """Main function"""
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Usage: python benchmark.py ["
+                  + "|".join(BENCHMARKS) + "]", file=sys.stderr)
+            return
+        print(f"== {name}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
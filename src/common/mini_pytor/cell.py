@@ -1,6 +1,17 @@
 """Cell class definition"""
+import struct
 from enum import Enum
 
+# type, flags, circuit id, next hop port
+CELL_HEADER = struct.Struct("!BBIH")
+IV_SIZE = 16
+# flags marking which optional header fields follow the fixed header
+HAS_IV = 1
+HAS_SALT = 2
+HAS_SIGNATURE = 4
+HAS_ADDR = 8
+HAS_STREAM = 16
+
 
 class CellType(Enum):
     """Cell type enum"""
@@ -14,17 +25,108 @@ class CellType(Enum):
     GET_DIRECT = 7
     CONTINUE = 8
     FINISHED = 9
+    GET_CONSENSUS = 10
+    RELAY_STATUS = 11
+    DESTROY = 12  # tears down the circuit a frame's circuit id names
 
 
 class Cell():
     """Cell class"""
+    __slots__ = ("payload", "signature", "init_vector", "salt", "type",
+                 "circ_id", "ip_addr", "port", "stream_id")
 
-    def __init__(self, payload, IV=None, salt=None, signature=None, ctype=None):
+    def __init__(self, payload, IV=None, salt=None, signature=None, ctype=None,
+                 circ_id=0, stream_id=None):
         self.payload = payload
         self.signature = signature
         self.init_vector = IV  # save the IV since it's a connection cell.
         self.salt = salt
+        self.circ_id = circ_id
+        # which of the requests on a circuit a REQ cell or its answer is for.
+        self.stream_id = stream_id
+        self.ip_addr = None  # next hop, if the cell is to be passed along
+        self.port = None
         if ctype is None:
             raise Exception("SHIT GONE WRONG!")  # that is very true.
         elif isinstance(ctype, CellType):
             self.type = ctype
+
+    def to_bytes(self):
+        """Pack the cell into its wire format.
+        A fixed header is followed by the optional fields named in its flags,
+        and the rest of the bytes are the payload."""
+        flags = 0
+        fields = []
+        if self.init_vector is not None:
+            flags |= HAS_IV
+            fields.append(self.init_vector)
+        if self.salt is not None:
+            flags |= HAS_SALT
+            fields.append(struct.pack("!H", len(self.salt)))
+            fields.append(self.salt)
+        if self.signature is not None:
+            flags |= HAS_SIGNATURE
+            fields.append(struct.pack("!H", len(self.signature)))
+            fields.append(self.signature)
+        if self.ip_addr is not None:
+            flags |= HAS_ADDR
+            ip_bytes = self.ip_addr.encode()
+            fields.append(struct.pack("!B", len(ip_bytes)))
+            fields.append(ip_bytes)
+        if self.stream_id is not None:
+            flags |= HAS_STREAM
+            fields.append(struct.pack("!H", self.stream_id))
+        header = CELL_HEADER.pack(self.type.value, flags, self.circ_id,
+                                  self.port or 0)
+        return b"".join([header] + fields + [self.payload])
+
+    @staticmethod
+    def from_bytes(data):
+        """Unpack a cell from its wire format.
+        Raises struct.error if the bytes are not a valid cell."""
+        cell, offset = Cell.unpack_header(data)
+        cell.payload = bytes(data[offset:])
+        return cell
+
+    @staticmethod
+    def unpack_header(data):
+        """Unpack everything but the payload of a cell.
+        Returns the cell, with an empty payload, and the offset its payload
+        starts at, so a large buffer can be read without copying it."""
+        ctype, flags, circ_id, port = CELL_HEADER.unpack_from(data)
+        try:
+            ctype = CellType(ctype)
+        except ValueError:
+            raise struct.error(f"Unknown cell type {ctype}")
+        offset = CELL_HEADER.size
+        init_vector = salt = signature = ip_addr = stream_id = None
+        if flags & HAS_IV:
+            init_vector = bytes(data[offset:offset + IV_SIZE])
+            offset += IV_SIZE
+        if flags & HAS_SALT:
+            salt, offset = Cell._unpack_field("!H", data, offset)
+        if flags & HAS_SIGNATURE:
+            signature, offset = Cell._unpack_field("!H", data, offset)
+        if flags & HAS_ADDR:
+            ip_bytes, offset = Cell._unpack_field("!B", data, offset)
+            try:
+                ip_addr = ip_bytes.decode()
+            except UnicodeDecodeError:
+                raise struct.error("Cell address is not text")
+        if flags & HAS_STREAM:
+            (stream_id,) = struct.unpack_from("!H", data, offset)
+            offset += 2
+        if offset > len(data):
+            raise struct.error("Cell is truncated")
+        cell = Cell(b"", IV=init_vector, salt=salt, signature=signature,
+                    ctype=ctype, circ_id=circ_id, stream_id=stream_id)
+        cell.ip_addr = ip_addr
+        cell.port = port or None
+        return cell, offset
+
+    @staticmethod
+    def _unpack_field(length_format, data, offset):
+        """Read a length-prefixed field, returning it and the new offset."""
+        (length,) = struct.unpack_from(length_format, data, offset)
+        offset += struct.calcsize(length_format)
+        return bytes(data[offset:offset + length]), offset + length
@@ -1,40 +1,139 @@
 """Client class file"""
 
-import pickle
 import sys
+import hashlib
+import heapq
 import json
+import queue
 import struct
+import select
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from random import sample
+from random import random, shuffle
+from socketserver import ThreadingMixIn
 
 import urllib
 import requests
-from cryptography.hazmat.primitives.asymmetric import padding, rsa, ec
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, ec, x25519
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.exceptions import InvalidSignature
 
+import consensus
+import httpcache
 import util
 from cell import Cell, CellType
+from framing import FrameReader, FramingError, send_frame
 
 DEFAULT_DIRECTORY_ADDRESS = ("127.0.0.1", 50000)
 RANDOM_RELAY_ORDER = "random"
 
+# circuit pool defaults
+POOL_LENGTHS = (3,)  # circuit lengths that are pre-built on startup
+POOL_SIZE = 2  # idle circuits kept ready for each length
+POOL_MAX_AGE = 300  # seconds before a circuit is retired
+POOL_MAX_USES = 50  # requests served before a circuit is retired
+POOL_CHECK_INTERVAL = 5  # seconds between health checks of idle circuits
+MAX_STREAMS = 4  # requests carried by one circuit at once
+
+HANDSHAKE_WORKERS = 4  # threads preparing the handshakes of a circuit
+
+# directory cache defaults
+DIRECTORY_TTL = 60  # seconds a relay listing is used for
+DIRECTORY_REFRESH_INTERVAL = 20  # seconds between background refreshes
+FAILURE_COOLDOWN = 60  # seconds a relay that failed a build is left out
+
+# path selection
+UNMEASURED_BANDWIDTH = 65536  # bytes per second assumed of an idle relay
+
+RUN_SIZE = 1 << 20  # most response bytes the client decrypts in one pass
+STREAM_ID_LIMIT = 0xFFFF  # stream ids on a circuit run from 1 to this
+
+# proxy front end defaults
+MAX_IN_FLIGHT = 16  # browser requests answered at once
+# headers describing the origin's connection rather than the response;
+# the body reaches the browser decoded and without a length.
+UNFORWARDED_HEADERS = ("connection", "keep-alive", "transfer-encoding",
+                       "content-encoding", "content-length", "date",
+                       "server")
+CACHE_SIZE = 32 * 1024 * 1024  # bytes of responses kept for the browser
+
+
+def relay_weight(relay):
+    """How likely a relay is to be picked for a path: the share of its
+    bandwidth a new circuit could expect, going by what it reported to the
+    directory. Relays that have carried little count as a modest one."""
+    bandwidth = max(relay.get("bandwidth", 0), UNMEASURED_BANDWIDTH)
+    return bandwidth / (1 + relay.get("circuits", 0))
+
+
+def choose_path(relays, count, avoid=()):
+    """Pick count different relays at random, weighted by relay_weight.
+    Relays whose (ip, port) is in avoid are only used if there are not
+    enough others."""
+    candidates = [relay for relay in relays
+                  if (relay["ip_addr"], relay["port"]) not in avoid]
+    if len(candidates) < count:
+        candidates = relays
+    # weighted sampling without replacement: the relays with the highest
+    # random() ** (1 / weight) win.
+    return heapq.nlargest(
+        count, candidates,
+        key=lambda relay: random() ** (1 / relay_weight(relay)))
+
+
+class RequestFailed(Exception):
+    """The exit relay could not get the website. The circuit itself is
+    fine and can carry other requests."""
+
 
 class Client:
     """Client class"""
+    # prepares handshakes for every circuit built by this process.
+    handshake_executor = ThreadPoolExecutor(HANDSHAKE_WORKERS)
+    # ephemeral keys for those handshakes, one pool per suite.
+    ephemeral_keys = util.EphemeralKeyPool()
+    x25519_keys = util.EphemeralKeyPool(make_key_pair=util.x25519_key_pair)
 
     def __init__(self):
         self.relay_list = []
-        # generate RSA public private key pair
-        self.private_key = rsa.generate_private_key(
-            backend=default_backend(), public_exponent=65537, key_size=3072)
-        self.public_key = self.private_key.public_key()
-        # serialised RSA public key.
-        self.serialised_public_key = self.public_key.public_bytes(
+        self.reader = None  # frame reader on the first relay's socket
+        self.run_buffer = bytearray()  # reused by _peel_run
+        self.build_timings = {}  # seconds taken by each stage of the build
+        self._private_key = None
+        # requests running on the circuit, by stream id.
+        self.streams = {}
+        self.next_stream_id = 1
+        # taken to send a request; also guards streams and dead.
+        self.send_lock = threading.Lock()
+        self.demux = None  # thread reading the answers, once there are any
+        self.dead = False  # the circuit broke while the demux was reading
+
+    @property
+    def private_key(self):
+        """The client's RSA key, generated the first time it is needed.
+        Building a circuit does not use it, so it stays off that path."""
+        if self._private_key is None:
+            # generate RSA public private key pair
+            self._private_key = rsa.generate_private_key(
+                backend=default_backend(), public_exponent=65537,
+                key_size=3072)
+        return self._private_key
+
+    @property
+    def public_key(self):
+        """The public half of private_key."""
+        return self.private_key.public_key()
+
+    @property
+    def serialised_public_key(self):
+        """serialised RSA public key."""
+        return self.public_key.public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         )
@@ -42,28 +141,69 @@ class Client:
     @staticmethod
     def get_directory_items(directory_address=DEFAULT_DIRECTORY_ADDRESS):
         """Method to obtain items from directory"""
+        return Client.get_directory_update(directory_address)["added"]
+
+    @staticmethod
+    def get_directory_update(directory_address=DEFAULT_DIRECTORY_ADDRESS,
+                             epoch=None, since=0):
+        """Obtain the relays that joined or left the directory since version
+        since of its listing from the given epoch. If the directory can't
+        tell, the update is "full" and lists every relay under "added"."""
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # connect to directory
         sock.connect(directory_address)
-        sock.send(pickle.dumps(Cell("", ctype=CellType.GET_DIRECT)))
-        received_cell = sock.recv(32768)
-        received_cell = pickle.loads(received_cell)
-        # if isinstance(received_cell.payload, list) and util.CLIENT_DEBUG:
-        #     print(received_cell.payload)
-        return received_cell.payload
+        try:
+            send_frame(sock, CellType.GET_DIRECT, Cell(
+                util.pack_directory_request(epoch, since),
+                ctype=CellType.GET_DIRECT).to_bytes())
+            reader = FrameReader(sock)
+            update = None
+            while update is None or update["more"]:
+                frame = reader.read_frame()
+                if frame is None:
+                    raise ConnectionResetError("Directory closed mid-update")
+                chunk = util.unpack_directory_update(
+                    Cell.from_bytes(frame[2]).payload)
+                if update is None:
+                    update = chunk
+                else:
+                    # big listings come in several frames.
+                    update["added"] += chunk["added"]
+                    update["removed"] += chunk["removed"]
+                    update["more"] = chunk["more"]
+        finally:
+            sock.close()
+        return update
+
+    @staticmethod
+    def get_consensus(address, directory_key):
+        """Obtain the signed consensus document from the directory or one of
+        its mirrors, and check that the directory signed it."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(address)
+        try:
+            send_frame(sock, CellType.GET_CONSENSUS,
+                       Cell(b"", ctype=CellType.GET_CONSENSUS).to_bytes())
+            frame = FrameReader(sock).read_frame()
+        finally:
+            sock.close()
+        if frame is None or frame[0] != CellType.GET_CONSENSUS:
+            raise ConnectionResetError("No consensus document to be had")
+        return consensus.unpack_consensus(frame[2], directory_key)
 
     @staticmethod
     def make_first_connect_cell(rsa_public_key):
-        """Create the cell that is used to initiate a connection with any relay."""
-        ec_privkey = ec.generate_private_key(
-            ec.SECP384R1(), default_backend())  # elliptic curve
-        dh_pubkey_bytes = ec_privkey.public_key().public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
+        """Create the cell that is used to initiate a connection with any relay.
+        The relay's identity key decides the handshake suite."""
+        if util.suite_of(rsa_public_key) == util.SUITE_X25519:
+            # nothing to hide: the relay signs this key back to us.
+            x25519_privkey, x25519_pubkey_bytes = Client.x25519_keys.take()
+            return Cell(x25519_pubkey_bytes,
+                        ctype=CellType.ADD_CON).to_bytes(), x25519_privkey
+        ec_privkey, dh_pubkey_bytes = Client.ephemeral_keys.take()
         # send the initialising cell, by sending the DHpublicKeyBytes
         sending_cell = Cell(dh_pubkey_bytes, ctype=CellType.ADD_CON)
-        readied_cell = pickle.dumps(sending_cell)
+        readied_cell = sending_cell.to_bytes()
         if util.CLIENT_DEBUG:
             print("First connect actual cell (encrypted bytes) ")
             print(readied_cell)
@@ -83,15 +223,25 @@ class Client:
         """given a cell, attempt to verify payload. Afterwards, derive shared key."""
         signature = provided_cell.signature
         try:
-            # verify that the cell was signed using their key.
-            util.rsa_verify(rsa_key, signature, provided_cell.salt)
-            # load up their half of the ECDHE key
-            their_ecdhe_key = serialization.load_pem_public_key(
-                provided_cell.payload, backend=default_backend())
-            shared_key = private_ecdhe.exchange(ec.ECDH(), their_ecdhe_key)
+            if util.suite_of(rsa_key) == util.SUITE_X25519:
+                # the signature covers both keys as well as the salt.
+                rsa_key.verify(signature, util.x25519_transcript(
+                    util.x25519_public_bytes(private_ecdhe),
+                    provided_cell.payload, provided_cell.salt))
+                their_key = x25519.X25519PublicKey.from_public_bytes(
+                    provided_cell.payload)
+                shared_key = private_ecdhe.exchange(their_key)
+            else:
+                # verify that the cell was signed using their key.
+                util.rsa_verify(rsa_key, signature, provided_cell.salt)
+                # load up their half of the ECDHE key
+                their_ecdhe_key = serialization.load_pem_public_key(
+                    provided_cell.payload, backend=default_backend())
+                shared_key = private_ecdhe.exchange(
+                    ec.ECDH(), their_ecdhe_key)
             derived_key = HKDF(
                 algorithm=hashes.SHA256(),
-                length=32,
+                length=util.DERIVED_KEY_SIZE,
                 salt=provided_cell.salt,
                 info=None,
                 backend=default_backend()
@@ -100,33 +250,118 @@ class Client:
             # derived key is returned
             return derived_key
 
-        except InvalidSignature:
+        except (InvalidSignature, ValueError):
             if util.CLIENT_DEBUG:
                 print("Something went wrong.. Signature was invalid.",
                       file=sys.stderr)
             return None
 
-    def connect_relay(self, gonnect, gonnectport, rsa_key, connect_mode):
-        """Wrapper function for easier use"""
+    @staticmethod
+    def circuit_length(num_of_relays, available):
+        """How many hops a circuit asked to have num_of_relays gets, given
+        how many relays the directory lists. Counts it can't meet get 3."""
+        if num_of_relays < 3 or num_of_relays > available:
+            return 3
+        return num_of_relays
+
+    @staticmethod
+    def build_circuit(directory_address, num_of_relays,
+                      order=RANDOM_RELAY_ORDER, directory_cache=None):
+        """Create a client and connect it through num_of_relays relays.
+        Relays come from directory_cache if one is given, otherwise
+        straight from the directory.
+        The handshakes for all hops are prepared together up front, so only
+        the round trips go one hop at a time. The time spent in each stage
+        is left in the client's build_timings."""
+        my_client = Client()
+        timings = my_client.build_timings
+        build_start = stage_start = time.perf_counter()
+        # get references from directories.
+        if directory_cache is None:
+            relay_list = Client.get_directory_items(directory_address)
+        else:
+            relay_list = directory_cache.get()
+
+        num_of_relays = Client.circuit_length(num_of_relays, len(relay_list))
+
+        if order == RANDOM_RELAY_ORDER:
+            relay_list = choose_path(
+                relay_list, num_of_relays,
+                directory_cache.recently_failed() if directory_cache else ())
+        relay_list = relay_list[:num_of_relays]
+        stage_start = Client._end_stage(timings, "directory", stage_start)
+
+        pubkeys = [relay.get("public_key")
+                   or serialization.load_pem_public_key(
+                       relay["key"], backend=default_backend())
+                   for relay in relay_list]
+        # ephemeral keys and RSA wrapped ADD_CON cells for every hop.
+        handshakes = list(Client.handshake_executor.map(
+            Client.make_first_connect_cell, pubkeys))
+        stage_start = Client._end_stage(timings, "prepare", stage_start)
+
+        for i, relay in enumerate(relay_list):
+            my_client.connect_relay(
+                relay["ip_addr"], relay["port"], pubkeys[i], i, handshakes[i])
+            stage_start = Client._end_stage(timings, f"hop_{i + 1}",
+                                            stage_start)
+            if len(my_client.relay_list) != i + 1:
+                if directory_cache is not None:
+                    directory_cache.mark_failed(relay)
+                break  # cannot extend past a hop that failed
+        timings["total"] = time.perf_counter() - build_start
+        return my_client
+
+    @staticmethod
+    def _end_stage(timings, stage, stage_start):
+        """Record how long a stage of a build took; returns the time now."""
+        now = time.perf_counter()
+        timings[stage] = now - stage_start
+        return now
+
+    def is_alive(self):
+        """Check that the circuit is connected and has nothing pending."""
+        if not self.relay_list or self.dead:
+            return False
+        if self.demux is not None:
+            return True  # it would have noticed the circuit break
+        sock = self.relay_list[0].sock
+        try:
+            # an idle circuit should never be readable;
+            # readable means the relay hung up or sent junk.
+            read_ready, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not read_ready
+
+    def connect_relay(self, gonnect, gonnectport, rsa_key, connect_mode,
+                      handshake=None):
+        """Wrapper function for easier use.
+        handshake is what make_first_connect_cell returned for this relay,
+        if it was prepared in advance."""
         if connect_mode == 0:
-            self.first_connect(gonnect, gonnectport, rsa_key)
+            self.first_connect(gonnect, gonnectport, rsa_key, handshake)
         else:
-            self.more_connect(gonnect, gonnectport, rsa_key, connect_mode)
+            self.more_connect(gonnect, gonnectport, rsa_key, connect_mode,
+                              handshake)
 
-    def first_connect(self, gonnect, gonnectport, rsa_key):
+    def first_connect(self, gonnect, gonnectport, rsa_key, handshake=None):
         """Connect to the first relay of the trio"""
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.connect((gonnect, gonnectport))
-            encrypted_cell, ec_privkey = Client.make_first_connect_cell(
-                rsa_key)
+            encrypted_cell, ec_privkey = handshake \
+                or Client.make_first_connect_cell(rsa_key)
             if util.CLIENT_DEBUG:
                 print("First connect actual cell (encrypted)")
                 print(encrypted_cell)
             # send out the generated ECDHE key
-            sock.send(encrypted_cell)
-            their_cell = sock.recv(4096)
-            their_cell = pickle.loads(their_cell)
+            send_frame(sock, CellType.ADD_CON, encrypted_cell)
+            reader = FrameReader(sock)
+            frame = reader.read_frame()
+            if frame is None:
+                raise ConnectionResetError
+            their_cell = Cell.from_bytes(frame[2])
             # check the signature and derive their key.
             derived_key = self.check_signature_and_derive(
                 their_cell, rsa_key, ec_privkey)
@@ -135,6 +370,7 @@ class Client:
                 if util.CLIENT_DEBUG:
                     print("Connected successfully to relay @ " + gonnect
                           + "   Port: " + str(gonnectport))
+                self.reader = reader
                 self.relay_list.append(
                     RelayData(gonnect, sock, derived_key,
                               ec_privkey, rsa_key, gonnectport)
@@ -143,13 +379,16 @@ class Client:
                 # Verification error or UnpackingError occurred
                 print("Verification of signature failed"
                       + "/Invalid cell was received.")
-        except (struct.error, ConnectionResetError, ConnectionRefusedError):
+        except (struct.error, ConnectionResetError, ConnectionRefusedError,
+                FramingError):
             print("Disconnected or relay is not online/ connection was "
                   + "refused.", file=sys.stderr)
 
-    def more_connect(self, gonnect, gonnectport, rsa_key, connect_mode):
+    def more_connect(self, gonnect, gonnectport, rsa_key, connect_mode,
+                     handshake=None):
         """Connect to the next relay through my 2 connected relays."""
-        encrypted_cell, ec_privkey = Client.make_first_connect_cell(rsa_key)
+        encrypted_cell, ec_privkey = handshake \
+            or Client.make_first_connect_cell(rsa_key)
         if util.CLIENT_DEBUG:
             print("Innermost cell with keys (encrypted)")
             print(encrypted_cell)
@@ -161,13 +400,10 @@ class Client:
         sending_cell.ip_addr = gonnect
         sending_cell.port = gonnectport
         # inform of next port of call.
-        encrypted_cell, init_vector = util.aes_encryptor(
-            intermediate_relays[connect_mode - 1].key,
-            sending_cell
-        )
+        encrypted_cell = intermediate_relays[connect_mode - 1] \
+            .cipher.forward.update(sending_cell.to_bytes())
         # encrypt using said keys.
-        sending_cell = Cell(encrypted_cell, IV=init_vector,
-                            ctype=CellType.RELAY_CONNECT)
+        sending_cell = Cell(encrypted_cell, ctype=CellType.RELAY_CONNECT)
 
         if connect_mode >= 2:
             for i in range(connect_mode - 1, 0, -1):
@@ -175,48 +411,35 @@ class Client:
                 sending_cell.ip_addr = intermediate_relays[i].ip_addr
                 sending_cell.port = intermediate_relays[i].port
                 # inform of next port of call again.
-                sending_cell = Cell(pickle.dumps(sending_cell),
+                sending_cell = Cell(sending_cell.to_bytes(),
                                     ctype=CellType.RELAY)
-                encrypted_cell, init_vector = util.aes_encryptor(
-                    intermediate_relays[i - 1].key,
-                    sending_cell
-                )
-                sending_cell = Cell(encrypted_cell, IV=init_vector,
+                encrypted_cell = intermediate_relays[i - 1] \
+                    .cipher.forward.update(sending_cell.to_bytes())
+                sending_cell = Cell(encrypted_cell,
                                     ctype=CellType.RELAY)  # Outermost layer
                 sending_cell.ip_addr = intermediate_relays[i - 1].ip_addr
                 sending_cell.port = intermediate_relays[i - 1].port
 
         try:
             sock = intermediate_relays[0].sock
-            sock.send(pickle.dumps(sending_cell))  # send over the cell
+            # send over the cell
+            send_frame(sock, CellType.RELAY, sending_cell.to_bytes())
             if util.CLIENT_DEBUG:
                 print("Cell sent: ")
-                print(pickle.dumps(sending_cell))
-            their_cell = sock.recv(4096)  # await answer
+                print(sending_cell.to_bytes())
+            frame = self.reader.read_frame()  # await answer
+            if frame is None:
+                raise ConnectionResetError
             # you now receive a cell with encrypted payload.
             if util.CLIENT_DEBUG:
-                print(their_cell)
-            their_cell = pickle.loads(their_cell)
-            if util.CLIENT_DEBUG:
-                print(their_cell.payload)
-            counter = 0
-            while counter < len(intermediate_relays):
-                decrypted = util.aes_decryptor(
-                    intermediate_relays[counter].key, their_cell)
-                if util.CLIENT_DEBUG:
-                    print(decrypted)
-                their_cell = pickle.loads(decrypted)
-                if util.CLIENT_DEBUG:
-                    print(their_cell.payload)
-                counter += 1
-                if counter < len(intermediate_relays):
-                    their_cell = their_cell.payload
-            their_cell = pickle.loads(their_cell.payload)
+                print(frame)
+            their_cell = Client.chain_decryptor(intermediate_relays, frame[2])
+            their_cell = Cell.from_bytes(their_cell.payload)
 
             if their_cell.type == CellType.FAILED:
                 if util.CLIENT_DEBUG:
                     print("FAILED AT CONNECTION!", file=sys.stderr)
-                if their_cell.payload == "CONNECTIONREFUSED":
+                if their_cell.payload == b"CONNECTIONREFUSED":
                     print(
                         "Connection was refused. Is the relay online yet?", file=sys.stderr)
                 return
@@ -230,111 +453,221 @@ class Client:
                 print("Connected successfully to relay @ " + gonnect
                       + "   Port: " + str(gonnectport))
 
-        except (ConnectionResetError, ConnectionRefusedError, struct.error):
+        except (ConnectionResetError, ConnectionRefusedError, struct.error,
+                FramingError):
             print("Socket error.", file=sys.stderr)
             del self.relay_list[connect_mode - 1]  # remove it from the list
             if util.CLIENT_DEBUG:
                 print("REMOVED relay 0 DUE TO FAILED CONNECTION", file=sys.stderr)
 
     @staticmethod
-    def req_wrapper(request, relay_list):
+    def req_wrapper(request, relay_list, stream_id=None):
         """Generate a encrypted cell for sending that contains the request"""
-        sending_cell = Cell(request, ctype=CellType.REQ)
+        sending_cell = Cell(request.encode(), ctype=CellType.REQ,
+                            stream_id=stream_id)
         for i in range(len(relay_list) - 1, -1, -1):
-            encrypted_cell, init_vector = util.aes_encryptor(
-                relay_list[i].key, sending_cell)
-            sending_cell = Cell(encrypted_cell, IV=init_vector,
-                                ctype=CellType.RELAY)
+            encrypted_cell = relay_list[i].cipher.forward.update(
+                sending_cell.to_bytes())
+            sending_cell = Cell(encrypted_cell, ctype=CellType.RELAY)
             sending_cell.ip_addr = relay_list[i].ip_addr
             sending_cell.port = relay_list[i].port
             if i != 0:
-                sending_cell = Cell(pickle.dumps(
-                    sending_cell), ctype=CellType.RELAY)
+                sending_cell = Cell(sending_cell.to_bytes(),
+                                    ctype=CellType.RELAY)
 
         return sending_cell
 
     @staticmethod
-    def chain_decryptor(list_of_intermediate_relays, provided_cell):
-        """Decrypt the provided cell given a list of intermediate relays"""
-        counter = 0
-        while counter < len(list_of_intermediate_relays):
-            decrypted = util.aes_decryptor(
-                list_of_intermediate_relays[counter].key,
-                provided_cell
-            )
-            provided_cell = pickle.loads(decrypted)
-            counter += 1
-            if counter < len(list_of_intermediate_relays):
-                provided_cell = provided_cell.payload
-
-        return provided_cell
+    def chain_decryptor(list_of_intermediate_relays, body):
+        """Peel every relay's layer off a frame body, returning the cell
+        the last relay sent."""
+        for relay in list_of_intermediate_relays:
+            body = relay.cipher.backward.update(body)
+        return Cell.from_bytes(body)
 
-    def req(self, request):
-        """send out stuff in router."""
+    def stream(self, request):
+        """Send a request through the circuit and yield the answer as it
+        comes back: first the response head, then the body in chunks.
+        Several threads may stream over one circuit at once.
+        Raises ConnectionResetError if the circuit fails, RequestFailed if
+        only the website does."""
         if util.CLIENT_DEBUG:
             print("REQUEST SENDING TEST")
-        # must send IV and a cell that is encrypted with the next public key
-        # public key list will have to be accessed in order with list of relays
-        # connection type. exit node always knows
-        intermediate_relays = self.relay_list
-        sending_cell = Client.req_wrapper(request, intermediate_relays)
-        # calculate packet size using number of relays
-        pack_size = util.BASE_PACKET_SIZE \
-            + util.WRAPPER_SIZE * (len(intermediate_relays) - 1)
+        stream_id, events = self._open_stream(request)
         try:
-            # get first packet
-            sock = intermediate_relays[0].sock
-            sock.send(pickle.dumps(sending_cell))
-            recv_cell = sock.recv(pack_size)
-            their_cell = pickle.loads(recv_cell)
+            while True:
+                event, value = events.get()
+                if event == "error":
+                    raise ConnectionResetError(value)
+                if event == "failed":
+                    raise RequestFailed(value)
+                if event == "end":
+                    return
+                yield value
+        finally:
+            with self.send_lock:
+                self.streams.pop(stream_id, None)
+
+    def _open_stream(self, request):
+        """Send a request on a stream of its own. Returns the stream id and
+        the queue the demux thread passes the answer on through."""
+        stream = {"events": queue.Queue(), "head": False, "done": False}
+        with self.send_lock:
+            if self.dead:
+                raise ConnectionResetError("Circuit is closed")
+            stream_id = self.next_stream_id
+            while stream_id in self.streams:
+                stream_id = stream_id % STREAM_ID_LIMIT + 1
+            self.next_stream_id = stream_id % STREAM_ID_LIMIT + 1
+            self.streams[stream_id] = stream
+            # the forward keystreams must see cells in the order they go out,
+            # so the cell is encrypted and sent in one go.
+            sending_cell = Client.req_wrapper(
+                request, self.relay_list, stream_id)
+            try:
+                send_frame(self.relay_list[0].sock, CellType.RELAY,
+                           sending_cell.to_bytes())
+            except OSError:
+                del self.streams[stream_id]
+                raise
+            if self.demux is None:
+                self.demux = threading.Thread(target=self._demux_loop,
+                                              daemon=True)
+                self.demux.start()
+        return stream_id, stream["events"]
+
+    def _demux_loop(self):
+        """Body of the demux thread: read the answers coming back on the
+        circuit and hand them to their streams, until the circuit closes."""
+        try:
+            while True:
+                frames = self._read_run()
+                destroyed = frames[-1][0] == CellType.DESTROY
+                if destroyed:  # carries no cell, only ever ends a run
+                    frames.pop()
+                self._dispatch(frames)
+                if destroyed:
+                    raise ConnectionResetError("Circuit was torn down")
+        except (struct.error, OSError, FramingError) as error:
+            with self.send_lock:
+                self.dead = True
+                streams = list(self.streams.values())
+            for stream in streams:
+                self._end_stream(stream, "error", f"Circuit closed: {error}")
+
+    @staticmethod
+    def _end_stream(stream, event, value=None):
+        """Hand a stream its last event."""
+        if not stream["done"]:
+            stream["done"] = True
+            stream["events"].put((event, value))
+
+    def _dispatch(self, frames):
+        """Peel a run of frames and pass them to their streams.
+        The response to a request comes back as CONTINUE frames, the first
+        one holding the head, followed by a single FINISHED frame. Each
+        stream gets the body it has in the run as one chunk."""
+        bodies = {}  # stream -> body bytes in this run not yet handed over
+        cells = self._peel_run([frame[2] for frame in frames])
+        for (ctype, _, _), (their_cell, payload) in zip(frames, cells):
             if util.CLIENT_DEBUG:
-                print("received cell")
-                print(len(recv_cell))
-                print(recv_cell)
-                print("received cell payload")
-                print(their_cell.payload)
-            their_cell = Client.chain_decryptor(
-                intermediate_relays, their_cell)
+                print(f"Received {ctype}, length {len(payload)}, "
+                      + f"stream {their_cell.stream_id}")
+            stream = self.streams.get(their_cell.stream_id)
+            if stream is None or stream["done"]:
+                continue  # given up on by whoever was reading it
             if their_cell.type == CellType.FAILED:
                 print("FAILED AT CONNECTION!", file=sys.stderr)
-                return Client.failure()  # return failure
+                bodies.pop(id(stream), None)
+                self._end_stream(
+                    stream, "failed", bytes(payload).decode(errors="replace")
+                    or "Request failed at the exit relay")
+                continue
+            if not stream["head"]:
+                if ctype != CellType.CONTINUE:
+                    self._end_stream(stream, "error", "Response has no head")
+                    continue
+                try:
+                    head = util.unpack_response_head(bytes(payload))
+                except (ValueError, struct.error):
+                    self._end_stream(stream, "error", "Response head is bad")
+                    continue
+                stream["head"] = True
+                stream["events"].put(("head", head))
+            elif ctype == CellType.CONTINUE:
+                # payload is only good until the next run is peeled.
+                bodies.setdefault(id(stream), (stream, bytearray()))[1] \
+                    .extend(payload)
+            if ctype != CellType.CONTINUE:
+                self._flush_body(bodies.pop(id(stream), None))
+                self._end_stream(stream, "end")
+        for pending in bodies.values():
+            self._flush_body(pending)
 
-            if their_cell.type == CellType.CONTINUE:
-                if util.CLIENT_DEBUG:
-                    print("Information is being streamed.")
-                recv_bytes_arr = []
-                cont_loop = True
-                # get whole TCP stream and store it in array
-                while cont_loop:
-                    recv_bytes = sock.recv(pack_size * 5)  # await answer
-                    print(len(recv_bytes))
-                    if len(recv_bytes) < pack_size:
-                        cont_loop = False
-                    recv_bytes_arr.append(recv_bytes)
-                total_payload = b"".join(recv_bytes_arr)
-                if util.CLIENT_DEBUG:
-                    print(f"Total length: {len(total_payload)}")
-                # partition the entire payload to pack_size each
-                # and process them accordingly
-                decrypted_bytes = [their_cell.payload]
-                for i in range(0, len(total_payload), pack_size):
-                    recv_cell = total_payload[i:i + pack_size]
-                    their_cell = pickle.loads(recv_cell)
-                    if util.CLIENT_DEBUG:
-                        print(f"Received packet, length {len(recv_cell)}")
-                    their_cell = Client.chain_decryptor(
-                        intermediate_relays, their_cell)
-                    decrypted_bytes.append(their_cell.payload)
-                # join all the bytes together
-                resp = bytes(b"".join(decrypted_bytes))
-                # unpickle the final concatenated bytes
-                resp = pickle.loads(resp)
-                return Client._check_response(resp)
-
-            resp = pickle.loads(their_cell.payload)
-            return Client._check_response(resp)
-        except struct.error:
+    @staticmethod
+    def _flush_body(pending):
+        """Hand a stream the body bytes gathered for it."""
+        if pending is not None and pending[1]:
+            pending[0]["events"].put(("body", pending[1]))
+
+    def _read_run(self):
+        """Read the next frame of a response, and any more of it that are
+        already buffered behind it, so they can be decrypted together."""
+        frame = self.reader.read_frame()
+        if frame is None:
+            raise ConnectionResetError("Circuit closed mid-response")
+        frames = [frame]
+        run_size = len(frame[2])
+        while frame[0] == CellType.CONTINUE and run_size < RUN_SIZE \
+                and self.reader.pending():
+            frame = self.reader.read_frame()
+            frames.append(frame)
+            run_size += len(frame[2])
+        return frames
+
+    def _peel_run(self, bodies):
+        """Peel every relay's layer off a run of frame bodies at once.
+        The bodies are copied into one reused buffer and each layer is
+        decrypted in place with a single pass over it.
+        Yields every cell along with its payload, as a memoryview into the
+        buffer that is only good until the next run is peeled."""
+        total = sum(len(body) for body in bodies)
+        if len(self.run_buffer) < total + util.CTR_SLACK:
+            self.run_buffer = bytearray(total + util.CTR_SLACK)
+        view = memoryview(self.run_buffer)
+        offset = 0
+        for body in bodies:
+            view[offset:offset + len(body)] = body
+            offset += len(body)
+        for relay in self.relay_list:
+            relay.cipher.backward.update_into(view[:total], self.run_buffer)
+        offset = 0
+        for body in bodies:
+            end = offset + len(body)
+            their_cell, start = Cell.unpack_header(view[offset:end])
+            yield their_cell, view[offset + start:end]
+            offset = end
+
+    def req(self, request):
+        """send out stuff in router."""
+        try:
+            chunks = self.stream(request)
+            head = next(chunks)
+            content = bytearray()
+            for chunk in chunks:
+                content += chunk
+        except (struct.error, OSError, FramingError, ValueError,
+                RequestFailed):
             print("socketerror", file=sys.stderr)
+            return Client.failure()
+        response = requests.models.Response()
+        response.url = request
+        response.status_code = head["status_code"]
+        response.reason = head["reason"]
+        response.headers = requests.structures.CaseInsensitiveDict(
+            head["headers"])
+        response._content = bytes(content)  # pylint: disable=protected-access
+        return Client._check_response(response)
 
     @staticmethod
     def _check_response(response):
@@ -354,6 +687,11 @@ class Client:
     def close(self):  # to close things.
         """Run at the end of a client call to CLOSE all sockets"""
         for i in self.relay_list:
+            try:
+                # wakes the demux thread up if it is waiting on the socket.
+                i.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             i.sock.close()
 
     @staticmethod
@@ -365,60 +703,143 @@ class Client:
 
 
 class Responder(BaseHTTPRequestHandler):
-    """Mini HTTP server"""
+    """Mini HTTP server.
+    Fresh responses kept in the cache, if there is one, are answered
+    without going through a circuit, so the browser's back and forward
+    navigation costs no round trips."""
 
-    def __init__(self, directory_address, *args):
+    def __init__(self, directory_address, pool, cache, *args):
         self.directory_address = directory_address
+        self.pool = pool
+        self.cache = cache
         BaseHTTPRequestHandler.__init__(self, *args)
 
     def do_GET(self):
         """Get request response method"""
-        my_client = Client()
         if self.path == "/favicon.ico":
             return
+        if self.path == "/stats":
+            stats = self.pool.stats()
+            stats["front_end"] = self.server.stats()
+            stats["ephemeral_keys"] = Client.ephemeral_keys.stats()
+            stats["x25519_keys"] = Client.x25519_keys.stats()
+            if self.cache is not None:
+                stats["cache"] = self.cache.stats()
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(stats).encode())
+            return
 
         url, order, num_of_relays = Responder._handle_url(self.path)
 
         if url is None or order is None:
-            print("Producing invalid reply", file=sys.stderr)
-            self.send_response(404)
-            answer = ""
-            my_client.close()
-        else:
-            # get references from directories.
-            relay_list = Client.get_directory_items(self.directory_address)
-
-            if num_of_relays < 3 or num_of_relays > len(relay_list):
-                num_of_relays = 3
+            self._invalid_reply(b"")
+            return
+        if self.cache is not None:
+            # stale entries cannot be revalidated, since only the url
+            # goes through the circuit; they are fetched again instead.
+            entry, fresh = self.cache.lookup(url)
+            if fresh:
+                print(f"URL: {url} (from the cache)")
+                self._send_head(entry["status_code"], entry["reason"],
+                                entry["headers"])
+                self.wfile.write(entry["body"])
+                return
+        my_client = self.pool.acquire(num_of_relays, order)
 
-            if order == RANDOM_RELAY_ORDER:
-                relay_list = sample(relay_list, num_of_relays)
+        print(f"Num of relays: {len(my_client.relay_list)}")
+        print(f"URL: {url}")
 
-            for i in range(num_of_relays):
-                relay = relay_list[i]
-                pubkey = serialization.load_pem_public_key(
-                    relay["key"], backend=default_backend())
-                my_client.connect_relay(
-                    relay["ip_addr"], relay["port"], pubkey, i)
-
-            print(f"Num of relays: {len(my_client.relay_list)}")
-            print(f"URL: {url}")
-
-            obtained_response = my_client.req(url)
-            if isinstance(obtained_response, str):
-                print("Producing invalid reply", file=sys.stderr)
-                self.send_response(404)
-                answer = obtained_response.encode()
-                my_client.close()
+        healthy = False
+        try:
+            if my_client.relay_list:
+                healthy = self._stream_reply(my_client, url)
             else:
-                print("Producing valid reply")
-                self.send_response(obtained_response.status_code)
-                my_client.close()
-                answer = bytes(obtained_response.content)
+                self._invalid_reply(Client.failure().encode())
+        finally:
+            # never hand a broken circuit back to the pool.
+            self.pool.release(my_client, healthy=healthy)
+
+    def _invalid_reply(self, answer):
+        print("Producing invalid reply", file=sys.stderr)
+        self.send_response(404)
         self.send_header('Content-type', 'text/html')
         self.end_headers()
         self.wfile.write(answer)
 
+    def _stream_reply(self, my_client, url):
+        """Pass the response on to the browser as it comes off the circuit.
+        Returns whether the circuit can be used again, which it can unless
+        the circuit itself failed."""
+        chunks = my_client.stream(url)
+        try:
+            head = next(chunks)
+        except RequestFailed:
+            # the website is unreachable, the circuit is not to blame.
+            self._to_browser(self._invalid_reply, Client.failure().encode())
+            return True
+        except (struct.error, OSError, FramingError, ValueError):
+            self._to_browser(self._invalid_reply, Client.failure().encode())
+            return False
+        print("Producing valid reply")
+        if not self._to_browser(self._send_head, head["status_code"],
+                                head["reason"], head["headers"]):
+            chunks.close()
+            return True
+        # the body is only collected if it can be kept.
+        body = bytearray() if self.cache is not None \
+            and self.cache.storable(head["status_code"], head["headers"]) \
+            else None
+        while True:
+            try:
+                chunk = next(chunks, None)
+            except RequestFailed:
+                # the website broke off; the browser already has the head,
+                # so all we can do is stop. The circuit is fine.
+                print("Website broke off part way", file=sys.stderr)
+                return True
+            except (struct.error, OSError, FramingError):
+                # the browser already has the head, all we can do is stop.
+                print("Response broke off part way", file=sys.stderr)
+                return False
+            if chunk is None:
+                break
+            if not self._to_browser(self.wfile.write, chunk):
+                chunks.close()  # the rest of it is dropped as it comes in
+                return True
+            if body is not None:
+                body += chunk
+                if len(body) > self.cache.max_entry_bytes:
+                    body = None
+        if body is not None:
+            self.cache.store(url, head["status_code"], head["reason"],
+                             head["headers"], body)
+        return True
+
+    def _to_browser(self, write, *args):
+        """Call write(*args) to send something to the browser. Returns
+        False instead of raising if the browser has hung up, which is no
+        fault of the circuit."""
+        try:
+            write(*args)
+        except OSError:
+            print("Browser hung up part way", file=sys.stderr)
+            self.close_connection = True
+            return False
+        return True
+
+    def _send_head(self, status_code, reason, headers):
+        """Send the browser a response's status line and headers."""
+        self.send_response(status_code, reason)
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in UNFORWARDED_HEADERS]
+        if not any(name.lower() == "content-type" for name, _ in headers):
+            headers.append(("Content-type", "text/html"))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+
     @staticmethod
     def _handle_url(url_path):
         query = urllib.parse.parse_qs(url_path[2:])
@@ -436,14 +857,496 @@ class Responder(BaseHTTPRequestHandler):
         return url, order, count
 
 
+class DirectoryCache:
+    """Client side copy of the directory's relay listing.
+    A background thread keeps it fresh, so building a circuit needs no
+    round trip to the directory, and each relay's key is parsed once.
+    Refreshes only download the relays that joined or left since the
+    version of the listing already held. Given mirrors, the signed
+    consensus is fetched from them instead, and the directory is only
+    asked when none of them has a good one."""
+
+    def __init__(self, directory_address=DEFAULT_DIRECTORY_ADDRESS,
+                 ttl=DIRECTORY_TTL, refresh_interval=DIRECTORY_REFRESH_INTERVAL,
+                 mirrors=None):
+        self.directory_address = directory_address
+        self.mirrors = list(mirrors or [])
+        self.directory_key = consensus.load_directory_public_key() \
+            if self.mirrors else None
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.relays = []
+        self.by_address = {}  # the same relays, by (ip, port)
+        self.epoch = None  # the directory's, along with the listing version
+        self.version = 0
+        self.fetched = None  # when the listing was last downloaded
+        # parsed public keys, by relay ip, port and key fingerprint.
+        self.keys = {}
+        self.failures = {}  # (ip, port) -> when a build last failed there
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "refreshes": 0,
+            "full_refreshes": 0,
+            "mirror_refreshes": 0,
+            "mirror_failures": 0,
+            "refresh_failures": 0,
+            "relays_added": 0,
+            "relays_removed": 0,
+            "keys_parsed": 0,
+            "relay_failures": 0
+        }
+
+    def start(self):
+        """Keep the listing fresh in the background from now on."""
+        refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+        refresher.start()
+
+    def get(self):
+        """The relay listing, downloaded first if it is stale or empty.
+        Every relay in it has its parsed key under "public_key"."""
+        with self.lock:
+            fresh = bool(self.relays) \
+                and time.monotonic() - self.fetched < self.ttl
+            self.counters["hits" if fresh else "misses"] += 1
+            if fresh:
+                return self.relays
+        return self.refresh()
+
+    def refresh(self):
+        """Bring the listing up to date, reusing the keys already parsed."""
+        with self.lock:
+            epoch, since = self.epoch, self.version
+        update = self.fetch_from_mirrors() if self.mirrors else None
+        if update is None:
+            update = Client.get_directory_update(
+                self.directory_address, epoch, since)
+        parsed = 0
+        for relay in update["added"]:
+            relay["cache_key"] = (relay["ip_addr"], relay["port"],
+                                  hashlib.sha256(relay["key"]).hexdigest())
+            public_key = self.keys.get(relay["cache_key"])
+            if public_key is None:
+                public_key = serialization.load_pem_public_key(
+                    relay["key"], backend=default_backend())
+                parsed += 1
+            relay["public_key"] = public_key
+        with self.lock:
+            self.counters["refreshes"] += 1
+            self.counters["keys_parsed"] += parsed
+            if update["epoch"] == self.epoch \
+                    and update["version"] < self.version:
+                # another refresh (or the directory) had a newer listing.
+                self.fetched = time.monotonic()
+                return self.relays
+            if update["full"]:
+                self.counters["full_refreshes"] += 1
+                by_address = {}
+            elif update["epoch"] == self.epoch:
+                by_address = dict(self.by_address)
+            else:
+                return self.relays  # a diff against a listing we dropped
+            for address in update["removed"]:
+                by_address.pop(address, None)
+            for relay in update["added"]:
+                by_address[(relay["ip_addr"], relay["port"])] = relay
+            self.counters["relays_added"] += len(update["added"])
+            self.counters["relays_removed"] += len(update["removed"])
+            self.by_address = by_address
+            self.relays = list(by_address.values())
+            # forget relays that have left
+            self.keys = {relay["cache_key"]: relay["public_key"]
+                         for relay in self.relays}
+            self.epoch = update["epoch"]
+            self.version = update["version"]
+            self.fetched = time.monotonic()
+            return self.relays
+
+    def mark_failed(self, relay):
+        """Leave a relay out of paths for a while after a build failed there."""
+        with self.lock:
+            self.failures[(relay["ip_addr"], relay["port"])] = time.monotonic()
+            self.counters["relay_failures"] += 1
+
+    def recently_failed(self):
+        """The (ip, port) of the relays to leave out of paths for now."""
+        now = time.monotonic()
+        with self.lock:
+            self.failures = {address: failed_at
+                             for address, failed_at in self.failures.items()
+                             if now - failed_at < FAILURE_COOLDOWN}
+            return set(self.failures)
+
+    def fetch_from_mirrors(self):
+        """The consensus from the first mirror, tried in random order, to
+        have a good one, as a full update. None if none of them does."""
+        mirrors = list(self.mirrors)
+        shuffle(mirrors)  # spread clients over the mirrors
+        for mirror in mirrors:
+            try:
+                document = Client.get_consensus(mirror, self.directory_key)
+            except (OSError, struct.error, FramingError, ValueError,
+                    KeyError, InvalidSignature):
+                with self.lock:
+                    self.counters["mirror_failures"] += 1
+                continue
+            with self.lock:
+                self.counters["mirror_refreshes"] += 1
+            return {"epoch": document["epoch"],
+                    "version": document["version"], "full": True,
+                    "added": document["relays"], "removed": [],
+                    "more": False}
+        return None
+
+    def _refresh_loop(self):
+        """Download the listing every refresh_interval seconds."""
+        while True:
+            try:
+                self.refresh()
+            except (OSError, struct.error, FramingError, ValueError):
+                # keep the old listing, it is still good until the TTL.
+                with self.lock:
+                    self.counters["refresh_failures"] += 1
+            time.sleep(self.refresh_interval)
+
+    def stats(self):
+        """Snapshot of the cache counters."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["relays"] = len(self.relays)
+            stats["version"] = self.version
+            stats["avoided"] = len(self.failures)
+            stats["age"] = time.monotonic() - self.fetched \
+                if self.fetched is not None else None
+        return stats
+
+
+class CircuitPool:
+    """Long-lived pool of pre-built circuits, keyed by circuit length.
+    A circuit that is handed out can be handed out again, for up to
+    max_streams requests at once, before a new one is built."""
+
+    def __init__(self, directory_address=DEFAULT_DIRECTORY_ADDRESS,
+                 lengths=POOL_LENGTHS, size=POOL_SIZE, max_age=POOL_MAX_AGE,
+                 max_uses=POOL_MAX_USES, mirrors=None,
+                 max_streams=MAX_STREAMS):
+        self.directory_address = directory_address
+        self.directory = DirectoryCache(directory_address, mirrors=mirrors)
+        self.directory.start()
+        Client.ephemeral_keys.start()
+        self.size = size
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.max_streams = max_streams
+        # idle circuits per length, each entry holds the client and its usage.
+        self.idle = {length: [] for length in lengths}
+        # circuits that are handed out, keyed by client.
+        self.in_use = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "shared": 0,  # handed out while already carrying requests
+            "built": 0,
+            "build_failures": 0,
+            "retired": 0,
+            "unhealthy": 0,
+            "build_time_total": 0.0,
+            "build_time_max": 0.0,
+            "build_time_last": 0.0
+        }
+        # total seconds and count of every build stage, see build_circuit.
+        self.stage_times = {}
+        refiller = threading.Thread(target=self._refill_loop, daemon=True)
+        refiller.start()
+
+    def _build(self, num_of_relays, order=RANDOM_RELAY_ORDER):
+        """Build a circuit, recording how long it took."""
+        start = time.monotonic()
+        try:
+            my_client = Client.build_circuit(
+                self.directory_address, num_of_relays, order, self.directory)
+        except (ValueError, OSError, struct.error, FramingError):
+            # not enough relays, or the directory is unreachable.
+            my_client = None
+        elapsed = time.monotonic() - start
+        with self.lock:
+            if my_client is None or not my_client.relay_list:
+                self.counters["build_failures"] += 1
+            else:
+                self.counters["built"] += 1
+                self.counters["build_time_total"] += elapsed
+                self.counters["build_time_last"] = elapsed
+                self.counters["build_time_max"] = max(
+                    self.counters["build_time_max"], elapsed)
+                for stage, seconds in my_client.build_timings.items():
+                    total, count = self.stage_times.get(stage, (0.0, 0))
+                    self.stage_times[stage] = (total + seconds, count + 1)
+        if util.CLIENT_DEBUG and my_client is not None:
+            stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds
+                               in my_client.build_timings.items())
+            print(f"Built circuit of {num_of_relays} in {elapsed:.3f}s "
+                  + f"({stages})")
+        return my_client
+
+    def _expired(self, entry):
+        """Whether a circuit has reached its age or use limit."""
+        return entry["uses"] >= self.max_uses \
+            or time.monotonic() - entry["created"] >= self.max_age
+
+    def _retire(self, entry, healthy=True):
+        """Close a circuit that will not be used again."""
+        entry["client"].close()
+        with self.lock:
+            if healthy:
+                self.counters["retired"] += 1
+            else:
+                self.counters["unhealthy"] += 1
+
+    def acquire(self, num_of_relays, order=RANDOM_RELAY_ORDER):
+        """Hand out a ready circuit, building one if none is available."""
+        # pool under the length the circuit will really have, so a count
+        # the directory can't meet doesn't get a length of its own.
+        try:
+            available = len(self.directory.get())
+        except (ValueError, OSError, struct.error, FramingError):
+            # the directory is unreachable, go by the listing last held.
+            available = len(self.directory.relays)
+        num_of_relays = Client.circuit_length(num_of_relays, available)
+        entry = None
+        if order == RANDOM_RELAY_ORDER:
+            while True:
+                with self.lock:
+                    idle = self.idle.setdefault(num_of_relays, [])
+                    candidate = idle.pop() if idle else None
+                if candidate is None:
+                    break
+                if self._expired(candidate):
+                    self._retire(candidate)
+                elif not candidate["client"].is_alive():
+                    self._retire(candidate, healthy=False)
+                else:
+                    entry = candidate
+                    break
+
+        if entry is None and order == RANDOM_RELAY_ORDER:
+            shared = self._share(num_of_relays)
+            if shared is not None:
+                return shared["client"]
+
+        with self.lock:
+            self.counters["hits" if entry else "misses"] += 1
+        if entry is None:
+            my_client = self._build(num_of_relays, order)
+            if my_client is None:
+                # hand back an empty client, req() will report the failure.
+                my_client = Client()
+            entry = self._new_entry(my_client, num_of_relays, order)
+        with self.lock:
+            entry["uses"] += 1
+            entry["streams"] += 1
+            self.in_use[entry["client"]] = entry
+        # top the pool back up in the background.
+        self.wakeup.set()
+        return entry["client"]
+
+    @staticmethod
+    def _new_entry(my_client, length, order=RANDOM_RELAY_ORDER):
+        """Pool record of a newly built circuit."""
+        return {"client": my_client, "created": time.monotonic(),
+                "uses": 0, "length": length, "order": order,
+                "streams": 0,  # requests it is carrying right now
+                "healthy": True}
+
+    def _share(self, num_of_relays):
+        """Hand out the least busy circuit in use that has room for another
+        request, if there is one."""
+        with self.lock:
+            candidates = [
+                entry for entry in self.in_use.values()
+                if entry["length"] == num_of_relays
+                and entry["order"] == RANDOM_RELAY_ORDER
+                and entry["healthy"]
+                and entry["streams"] < self.max_streams
+                and not self._expired(entry)
+                and entry["client"].is_alive()]
+            if not candidates:
+                return None
+            entry = min(candidates, key=lambda entry: entry["streams"])
+            entry["uses"] += 1
+            entry["streams"] += 1
+            self.counters["shared"] += 1
+        return entry
+
+    def release(self, my_client, healthy=True):
+        """Return a circuit after use, retiring it if it is spent.
+        A circuit still carrying other requests is left to the last of
+        them to return."""
+        with self.lock:
+            entry = self.in_use.get(my_client)
+            if entry is not None:
+                entry["streams"] -= 1
+                entry["healthy"] = entry["healthy"] and healthy
+                if entry["streams"]:
+                    return
+                del self.in_use[my_client]
+                healthy = entry["healthy"]
+        if entry is None:
+            my_client.close()
+            return
+        if not healthy or not my_client.is_alive():
+            self._retire(entry, healthy=False)
+            return
+        if entry["order"] != RANDOM_RELAY_ORDER or self._expired(entry):
+            self._retire(entry)
+            return
+        if not self._add_idle(entry):
+            # pool is already full.
+            self._retire(entry)
+
+    def _add_idle(self, entry):
+        """Park a circuit in the idle pool, if there is room for it."""
+        with self.lock:
+            idle = self.idle.setdefault(entry["length"], [])
+            if len(idle) < self.size:
+                idle.append(entry)
+                return True
+        return False
+
+    def _check_idle(self):
+        """Drop idle circuits that have expired or died."""
+        with self.lock:
+            entries = [(length, entry) for length, idle in self.idle.items()
+                       for entry in idle]
+        for length, entry in entries:
+            expired = self._expired(entry)
+            if expired or not entry["client"].is_alive():
+                with self.lock:
+                    if entry not in self.idle[length]:
+                        continue  # handed out in the meantime
+                    self.idle[length].remove(entry)
+                self._retire(entry, healthy=expired)
+
+    def _refill_loop(self):
+        """Keep every length topped up to the pool size."""
+        while True:
+            self._check_idle()
+            with self.lock:
+                missing = [length for length, idle in self.idle.items()
+                           for _ in range(self.size - len(idle))]
+            failed = set()
+            for length in missing:
+                if length in failed:
+                    continue
+                my_client = self._build(length)
+                if my_client is None or len(my_client.relay_list) != length:
+                    if my_client is not None:
+                        my_client.close()
+                    # network is not ready, retry this length next round.
+                    failed.add(length)
+                    continue
+                entry = self._new_entry(my_client, length)
+                if not self._add_idle(entry):
+                    my_client.close()
+            self.wakeup.wait(POOL_CHECK_INTERVAL)
+            self.wakeup.clear()
+
+    def stats(self):
+        """Snapshot of the pool counters."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["idle"] = {str(length): len(idle)
+                             for length, idle in self.idle.items()}
+            stats["in_use"] = len(self.in_use)
+            # average seconds spent in each stage of a build.
+            stats["build_stages"] = {
+                stage: total / count
+                for stage, (total, count) in self.stage_times.items()}
+        requests_served = stats["hits"] + stats["misses"] + stats["shared"]
+        # requests that did not have to wait for a circuit to be built.
+        stats["hit_rate"] = (stats["hits"] + stats["shared"]) \
+            / requests_served if requests_served else 0.0
+        stats["build_time_avg"] = stats["build_time_total"] / stats["built"] \
+            if stats["built"] else 0.0
+        stats["directory"] = self.directory.stats()
+        return stats
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering each request in its own thread.
+    At most max_in_flight requests are answered at once; past that the
+    server stops accepting, so further connections wait in the listen
+    backlog instead of piling up threads and circuits."""
+    daemon_threads = True
+    request_queue_size = 64  # listen backlog
+
+    def __init__(self, server_address, handler, max_in_flight=MAX_IN_FLIGHT):
+        HTTPServer.__init__(self, server_address, handler)
+        self.max_in_flight = max_in_flight
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.counters = {
+            "in_flight": 0,
+            "peak_in_flight": 0,
+            "served": 0,
+            "throttled": 0,  # times a request had to wait for a free slot
+        }
+
+    def process_request(self, request, client_address):
+        """Wait for a free slot, then answer the request in a thread."""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.counters["throttled"] += 1
+            self.slots.acquire()
+        with self.lock:
+            self.counters["in_flight"] += 1
+            self.counters["peak_in_flight"] = max(
+                self.counters["peak_in_flight"], self.counters["in_flight"])
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            # no thread was started to give the slot back.
+            self._finished()
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        """Answer the request, then give its slot back."""
+        try:
+            ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            self._finished()
+
+    def _finished(self):
+        with self.lock:
+            self.counters["in_flight"] -= 1
+            self.counters["served"] += 1
+        self.slots.release()
+
+    def stats(self):
+        """Snapshot of the front end counters."""
+        with self.lock:
+            stats = dict(self.counters)
+        stats["max_in_flight"] = self.max_in_flight
+        return stats
+
+
 class CustomHTTPServer:
     """Custom HTTP Server instance to inject directory IP"""
 
-    def __init__(self, directory_address=DEFAULT_DIRECTORY_ADDRESS):
+    def __init__(self, directory_address=DEFAULT_DIRECTORY_ADDRESS,
+                 max_in_flight=MAX_IN_FLIGHT, mirrors=None,
+                 max_streams=MAX_STREAMS, cache=None):
+        pool = CircuitPool(directory_address, mirrors=mirrors,
+                           max_streams=max_streams)
+
         def handler(*args):
             """Override the default handler to pass in the address"""
-            Responder(directory_address, *args)
-        server = HTTPServer(('', 27182), handler)
+            Responder(directory_address, pool, cache, *args)
+        server = ThreadingHTTPServer(('', 27182), handler, max_in_flight)
         server.serve_forever()
 
 
@@ -456,6 +1359,7 @@ class RelayData:
         self.ip_addr = given_ip
         self.sock = provided_socket
         self.key = derived_key
+        self.cipher = util.LayerCipher(derived_key)
         self.ec_key_ = ec_privkey
         self.rsa_key = given_rsa_key
         self.port = given_port
@@ -463,12 +1367,46 @@ class RelayData:
 
 def main():
     """Main function"""
-    if len(sys.argv) == 3:
-        CustomHTTPServer((sys.argv[1], int(sys.argv[2])))
-    elif len(sys.argv) == 2:
-        CustomHTTPServer((sys.argv[1], 50000))
+    options = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    max_in_flight = MAX_IN_FLIGHT
+    max_streams = MAX_STREAMS
+    mirrors = []
+    cache_size = CACHE_SIZE
+    cache_directory = None
+    for option in options:
+        if option.startswith("--max-in-flight="):
+            max_in_flight = int(option.split("=", 1)[1])
+        elif option.startswith("--max-streams="):
+            # requests one circuit carries at once; 1 for a circuit each.
+            max_streams = int(option.split("=", 1)[1])
+        elif option.startswith("--mirrors="):
+            # ip:port,ip:port of the directory mirrors to fetch from.
+            for mirror in option.split("=", 1)[1].split(","):
+                mirror_ip, mirror_port = mirror.rsplit(":", 1)
+                mirrors.append((mirror_ip, int(mirror_port)))
+        elif option.startswith("--ephemeral-pool="):
+            pool_size = int(option.split("=", 1)[1])
+            Client.ephemeral_keys = util.EphemeralKeyPool(pool_size)
+            Client.x25519_keys = util.EphemeralKeyPool(
+                pool_size, make_key_pair=util.x25519_key_pair)
+        elif option.startswith("--cache="):
+            # megabytes of responses kept for the browser; 0 for none.
+            cache_size = int(float(option.split("=", 1)[1]) * 1024 * 1024)
+        elif option.startswith("--cache-dir="):
+            cache_directory = option.split("=", 1)[1]
+    # only this browser's responses, so private ones can be kept too.
+    cache = httpcache.HttpCache(cache_size, cache_directory, shared=False) \
+        if cache_size > 0 else None
+    if len(args) == 2:
+        CustomHTTPServer((args[0], int(args[1])), max_in_flight, mirrors,
+                         max_streams, cache)
+    elif len(args) == 1:
+        CustomHTTPServer((args[0], 50000), max_in_flight, mirrors,
+                         max_streams, cache)
     else:
-        CustomHTTPServer()
+        CustomHTTPServer(max_in_flight=max_in_flight, mirrors=mirrors,
+                         max_streams=max_streams, cache=cache)
 
 
 if __name__ == "__main__":
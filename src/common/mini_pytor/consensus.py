@@ -0,0 +1,141 @@
+"""Signed consensus documents: the directory's relay listing, signed by the
+directory so that mirrors can cache and serve it without being trusted"""
+
+import json
+import mmap
+import os
+import struct
+import time
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.backends import default_backend
+
+import util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DIRECTORY_PRIVATE_KEY = os.path.join(HERE, "privates", "directory.pem")
+DIRECTORY_PUBLIC_KEY = os.path.join(HERE, "publics", "directory.pem")
+DEFAULT_CONSENSUS_FILE = "consensus.bin"
+CONSENSUS_LIFETIME = 60  # seconds a document is good for after publication
+SIGNATURE_LENGTH = struct.Struct("!H")
+
+
+def load_directory_key(private_path=DIRECTORY_PRIVATE_KEY,
+                       public_path=DIRECTORY_PUBLIC_KEY):
+    """The directory's signing key. It is not checked in: it is generated
+    and saved on first use, readable only by its owner, along with the
+    public half that clients and mirrors check against."""
+    if os.path.exists(private_path):
+        with open(private_path, "rb") as key_file:
+            return serialization.load_pem_private_key(
+                key_file.read(), password=None, backend=default_backend())
+    key = rsa.generate_private_key(
+        backend=default_backend(),
+        public_exponent=65537,
+        key_size=4096
+    )
+    os.makedirs(os.path.dirname(private_path), exist_ok=True)
+    with os.fdopen(os.open(private_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                           0o600), "wb") as key_file:
+        key_file.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()))
+    with open(public_path, "wb") as key_file:
+        key_file.write(key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo))
+    return key
+
+
+def load_directory_public_key(path=DIRECTORY_PUBLIC_KEY):
+    """The key consensus documents must be signed with."""
+    with open(path, "rb") as key_file:
+        return serialization.load_pem_public_key(
+            key_file.read(), backend=default_backend())
+
+
+def pack_consensus(key, epoch, version, relays, lifetime=CONSENSUS_LIFETIME):
+    """Sign a listing of relays as a consensus document.
+    The document is the signature, behind its length, then the listing."""
+    published = time.time()  # wall clock, other hosts check it
+    body = json.dumps({
+        "epoch": epoch,
+        "version": version,
+        "published": published,
+        "valid_until": published + lifetime,
+        "relays": [util.relay_entry(relay) for relay in relays]
+    }, separators=(",", ":")).encode()
+    signature = key.sign(body, padding.PSS(
+        mgf=padding.MGF1(hashes.SHA256()),
+        salt_length=padding.PSS.MAX_LENGTH), hashes.SHA256())
+    return SIGNATURE_LENGTH.pack(len(signature)) + signature + body
+
+
+def unpack_consensus(document, public_key):
+    """Check a consensus document's signature and age, returning what it
+    says. Raises InvalidSignature if it was not signed with public_key,
+    ValueError if it has expired and struct.error if it is truncated."""
+    (length,) = SIGNATURE_LENGTH.unpack_from(document)
+    start = SIGNATURE_LENGTH.size + length
+    if start > len(document):
+        raise struct.error("Consensus document is truncated")
+    body = bytes(document[start:])
+    util.rsa_verify(public_key, bytes(document[SIGNATURE_LENGTH.size:start]),
+                    body)
+    consensus = json.loads(body.decode())
+    if consensus["valid_until"] < time.time():
+        raise ValueError("Consensus document has expired")
+    util.read_relay_entries(consensus["relays"])
+    return consensus
+
+
+class ConsensusFile:
+    """A consensus document kept on disk and served from a memory map of
+    the file, so answering a request never copies it into the process.
+    A new document replaces the file whole; connections still sending the
+    old one keep their mapping of it."""
+
+    def __init__(self, path=DEFAULT_CONSENSUS_FILE):
+        self.path = path
+        self.document = None  # memoryview of the mapped file
+        self.counters = {
+            "published": 0,
+            "served": 0
+        }
+
+    def publish(self, document):
+        """Write document over the one on disk and serve it from now on."""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(document)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, self.path)  # never leave half a document
+        self.load()
+        self.counters["published"] += 1
+
+    def load(self):
+        """Map the document on disk. Returns False if there is none."""
+        try:
+            with open(self.path, "rb") as document_file:
+                mapped = mmap.mmap(document_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # missing, or empty
+            return False
+        self.document = memoryview(mapped)
+        return True
+
+    def serve(self):
+        """The document to send for a GET_CONSENSUS request, or None."""
+        if self.document is not None:
+            self.counters["served"] += 1
+        return self.document
+
+    def stats(self):
+        """Snapshot of the counters."""
+        stats = dict(self.counters)
+        stats["size"] = len(self.document) \
+            if self.document is not None else 0
+        return stats
@@ -20,7 +20,10 @@ def main():
             sys.stderr.write("No nodes currently available.")
 
         for datum in results:
-            print(datum["ip_addr"] + ":" + str(datum["port"]))
+            print(datum["ip_addr"] + ":" + str(datum["port"])
+                  + " (" + datum["suite"] + ", "
+                  + str(datum["bandwidth"] // 1024) + " KB/s, "
+                  + str(datum["circuits"]) + " circuits)")
     except ConnectionRefusedError:
         sys.stderr.write("Directory offline.")
 
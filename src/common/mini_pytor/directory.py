@@ -1,141 +1,382 @@
 """Directory Server Class file"""
 
-import socket
-import select
-import pickle
+import asyncio
+import collections
+import os
+import struct
+import sys
+import time
 
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.exceptions import InvalidSignature
-from cryptography.hazmat.primitives.asymmetric import rsa
 
+import consensus
 import util
 from cell import Cell, CellType
+from framing import FramingError, read_frame_async, write_frame, write_frames
 
+HANDSHAKE_TIMEOUT = 1  # seconds allowed for a peer to send its first frame
+DIRECTORY_PORT = 50000
+LISTEN_BACKLOG = 1024  # connections waiting to be accepted
+DIFF_HISTORY = 4096  # membership changes remembered for sending diffs
+UPDATE_CHUNK = 256  # relays sent per GET_DIRECT frame
+CONSENSUS_INTERVAL = 1  # seconds between checks for a consensus to publish
+# a relay's reported load only makes a new listing version once it has
+# moved by this share, and by more than the floors below.
+STATUS_CHANGE = 0.2
+BANDWIDTH_FLOOR = 16384  # bytes per second
+CIRCUITS_FLOOR = 4
+
+
+def moved(old, new, floor):
+    """Whether a reported figure has changed enough to tell clients."""
+    return abs(new - old) > max(floor, STATUS_CHANGE * max(old, new))
 
-class DirectoryServer:
-    """Directory server class"""
+
+class RelayRegistry:
+    """The relays a directory lists, indexed by (ip, port) and by the file
+    descriptor of the connection that registered them, so adding and
+    removing one takes constant time. The GET_DIRECT replies are kept
+    serialised and only rebuilt once the membership has changed.
+    Recent changes are remembered, so a client that says which version
+    of the listing it has is sent only the relays that joined or left."""
 
     def __init__(self):
-        self.key = rsa.generate_private_key(
-            backend=default_backend(),
-            public_exponent=65537,
-            key_size=4096
-        )  # used for signing, etc.
+        self.relays = {}  # (ip, port) -> relay data, oldest first
+        self.connections = {}  # registration connection fd -> (ip, port)
+        # versions only mean something within one run of the directory.
+        self.epoch = os.urandom(8).hex()
+        self.version = 0  # bumped on every change to the membership
+        self.changes = collections.deque(maxlen=DIFF_HISTORY)
+        self.listing_version = None
+        self.listing_bytes = None
+        self.updates_version = None
+        self.updates = {}  # version asked for -> frames, for this version
+        self.counters = {
+            "listing_builds": 0,
+            "listing_hits": 0,  # listings served without a rebuild
+            "full_updates": 0,
+            "diff_updates": 0,
+            "update_hits": 0,  # updates served without a rebuild
+            "status_reports": 0,
+            "status_changes": 0  # reports that made a new version
+        }
+
+    def __len__(self):
+        return len(self.relays)
+
+    def add(self, relay_data, fileno):
+        """List a relay registered through the connection with fd fileno.
+        A relay that registers again takes over its entry from the old
+        connection, which may not have been seen to close yet."""
+        address = (relay_data["ip_addr"], relay_data["port"])
+        old_data = self.relays.pop(address, None)
+        if old_data is not None:
+            del self.connections[old_data["fileno"]]
+        relay_data["fileno"] = fileno
+        self.relays[address] = relay_data
+        self.connections[fileno] = address
+        self.changed(address)
+
+    def remove(self, fileno):
+        """Unlist the relay registered through fd fileno, returning it,
+        or None if it has since registered again elsewhere."""
+        address = self.connections.pop(fileno, None)
+        if address is None:
+            return None
+        relay_data = self.relays.pop(address)
+        self.changed(address)
+        return relay_data
+
+    def report(self, fileno, bandwidth, circuits):
+        """Take in the load reported by the relay registered through fd
+        fileno. Small changes are kept back, so relays that report steady
+        figures don't make clients download them over and over."""
+        self.counters["status_reports"] += 1
+        address = self.connections.get(fileno)
+        if address is None:
+            return
+        relay_data = self.relays[address]
+        if not moved(relay_data.get("bandwidth", 0), bandwidth,
+                     BANDWIDTH_FLOOR) \
+                and not moved(relay_data.get("circuits", 0), circuits,
+                              CIRCUITS_FLOOR):
+            return
+        self.counters["status_changes"] += 1
+        # a new record, since the consensus may be reading the old one.
+        self.relays[address] = dict(relay_data, bandwidth=bandwidth,
+                                    circuits=circuits)
+        self.changed(address)
+
+    def changed(self, address):
+        """Move on to the next version after the relay at address joined,
+        left or changed its key."""
+        self.version += 1
+        self.changes.append((self.version, address))
+
+    def diff_base(self):
+        """The oldest version a diff can still be worked out from."""
+        if len(self.changes) < self.changes.maxlen:
+            return 0
+        return self.changes[0][0] - 1
+
+    def listing(self):
+        """The body of the GET_DIRECT frame listing every relay."""
+        if self.listing_version != self.version:
+            self.listing_bytes = Cell(
+                util.pack_relay_list(self.relays.values()),
+                ctype=CellType.GET_DIRECT).to_bytes()
+            self.listing_version = self.version
+            self.counters["listing_builds"] += 1
+        else:
+            self.counters["listing_hits"] += 1
+        return self.listing_bytes
+
+    def update(self, epoch, since):
+        """The GET_DIRECT frame bodies answering a client that has version
+        since of the listing from the given epoch: the relays that joined
+        or left since then, or every relay if that can't be worked out."""
+        if self.updates_version != self.version:
+            self.updates = {}
+            self.updates_version = self.version
+        full = epoch != self.epoch \
+            or not self.diff_base() <= since <= self.version
+        cache_key = None if full else since
+        frames = self.updates.get(cache_key)
+        if frames is not None:
+            self.counters["update_hits"] += 1
+            return frames
+
+        if full:
+            self.counters["full_updates"] += 1
+            added = list(self.relays.values())
+            removed = []
+        else:
+            self.counters["diff_updates"] += 1
+            # only where each relay ended up matters, not how it got there.
+            touched = {address for version, address in self.changes
+                       if version > since}
+            added = [self.relays[address] for address in touched
+                     if address in self.relays]
+            removed = [address for address in touched
+                       if address not in self.relays]
+        frames = []
+        # the relays that left all go in the first frame.
+        for start in range(0, max(len(added), 1), UPDATE_CHUNK):
+            payload = util.pack_directory_update(
+                self.epoch, self.version, full,
+                added[start:start + UPDATE_CHUNK],
+                [] if start else removed,
+                start + UPDATE_CHUNK < len(added))
+            frames.append(Cell(payload, ctype=CellType.GET_DIRECT).to_bytes())
+        self.updates[cache_key] = frames
+        return frames
+
+    def stats(self):
+        """Snapshot of the registry's counters."""
+        stats = dict(self.counters)
+        stats["relays"] = len(self.relays)
+        stats["version"] = self.version
+        stats["diff_base"] = self.diff_base()
+        return stats
+
+
+class DirectoryServer:
+    """Directory server class.
+    Every connection is served by its own task on an asyncio event loop, so
+    registrations, listings and relays going away never wait on each other.
+    A relay stays listed for as long as its registration connection is open.
+    The listing is also published as a signed consensus document, which
+    mirrors can copy and serve in the directory's place."""
+
+    def __init__(self, port=DIRECTORY_PORT,
+                 consensus_path=consensus.DEFAULT_CONSENSUS_FILE):
+        self.key = consensus.load_directory_key()  # used for signing, etc.
 
         self.public_bytes = self.key.public_key().public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         )
-        self.registered_relays = []
-        self.relay_sockets = []
-        self.connected_relays = []
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # now you have a signature of your own public key.
+        self.registry = RelayRegistry()
+        self.consensus = consensus.ConsensusFile(consensus_path)
+        self.port = port
+        self.loop = None
+        self.counters = {
+            "registrations": 0,
+            "rejected": 0,  # registrations with a bad signature
+            "listings": 0,
+            "updates": 0,  # listings asked for by version
+            "publish_failures": 0
+        }
+
+    def run(self):
+        """Start up directory"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
         # better be "" or it'll listen only on localhost
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind(("", 50000))
-        self.socket.listen(100)
+        server = self.loop.run_until_complete(asyncio.start_server(
+            self.handle_conn, "", self.port, backlog=LISTEN_BACKLOG))
+        publisher = self.loop.create_task(self.publish_loop())
+        try:
+            self.loop.run_forever()
+        finally:
+            publisher.cancel()
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+
+    async def publish_loop(self):
+        """Publish a new consensus document whenever the membership has
+        changed, and often enough that the last one never expires.
+        Signing and writing it out happen off the event loop."""
+        published_version = None
+        published_at = 0
+        while True:
+            if self.registry.version != published_version \
+                    or time.monotonic() - published_at \
+                    > consensus.CONSENSUS_LIFETIME / 2:
+                published_version = self.registry.version
+                published_at = time.monotonic()
+                try:
+                    await self.loop.run_in_executor(
+                        None, self.publish_consensus, self.registry.epoch,
+                        published_version, list(self.registry.relays.values()))
+                except OSError as error:
+                    self.counters["publish_failures"] += 1
+                    print(f"Could not publish the consensus: {error}")
+            await asyncio.sleep(CONSENSUS_INTERVAL)
 
-    def handle_conn(self):
+    def publish_consensus(self, epoch, version, relays):
+        """Sign the listing and replace the consensus document on disk."""
+        self.consensus.publish(consensus.pack_consensus(
+            self.key, epoch, version, relays))
+
+    async def handle_conn(self, reader, writer):
         """Handle an incoming connection to the server."""
-        print("Got a connection request.")
-        relay_socket, _ = self.socket.accept()
-        obtained = relay_socket.recv(4096)
         try:
-            received_cell = pickle.loads(obtained)
-        except (pickle.PickleError, pickle.PicklingError, pickle.UnpicklingError):
-            relay_socket.close()
-            return
-
-        if not isinstance(received_cell, Cell):
-            relay_socket.close()
+            frame = await asyncio.wait_for(
+                read_frame_async(reader), HANDSHAKE_TIMEOUT)
+            if frame is None:
+                raise ConnectionResetError
+            received_cell = Cell.from_bytes(frame[2])
+        except (asyncio.TimeoutError, struct.error, FramingError, OSError):
+            writer.close()
             return
 
         if received_cell.type == CellType.GIVE_DIRECT:
-            base_bytearray = received_cell.salt
-            signature = received_cell.signature
-            pubkey_bytes = received_cell.payload
-            port_num = received_cell.init_vector
-            their_pubkey = serialization.load_pem_public_key(
-                pubkey_bytes, backend=default_backend())
-            try:
-                util.rsa_verify(their_pubkey, signature, base_bytearray)
-            except InvalidSignature:
-                # reject connection, signature validation failed
-                relay_socket.close()
-                return
-
-            # obtain the ip and port of that server.
-            ip_address, _ = relay_socket.getpeername()
-            relay_data = {
-                "ip_addr": ip_address,
-                "port": port_num,
-                "key": their_pubkey,
-                "sock":  relay_socket
-            }
-            if relay_data not in self.connected_relays:
-                self.connected_relays.append(relay_data)
-
-            registered_relay_data = {
-                "ip_addr": ip_address,
-                "port": port_num,
-                "key": pubkey_bytes
-            }
-            if registered_relay_data not in self.registered_relays:
-                self.registered_relays.append(registered_relay_data)
-            if relay_socket not in self.relay_sockets:
-                self.relay_sockets.append(relay_socket)
-            print(f"Added -> ({str(ip_address)}, {str(port_num)})")
-            print(self.registered_relays, end="\n\n")
+            await self.register(received_cell, reader, writer)
         elif received_cell.type == CellType.GET_DIRECT:
-            print("Got a directory request")
-            relay_socket.settimeout(0.03)  # ensure we don't block forever
-            relay_socket.send(pickle.dumps(
-                Cell(self.registered_relays, ctype=CellType.GET_DIRECT)))
-            relay_socket.recv(4096)
-            relay_socket.close()
+            if received_cell.payload:
+                try:
+                    epoch, since = util.unpack_directory_request(
+                        received_cell.payload)
+                except (ValueError, KeyError, TypeError):
+                    writer.close()
+                    return
+                self.counters["updates"] += 1
+                write_frames(writer, [
+                    (CellType.GET_DIRECT, frame)
+                    for frame in self.registry.update(epoch, since)])
+            else:
+                # an old client, wanting the whole listing in one frame.
+                self.counters["listings"] += 1
+                write_frame(writer, CellType.GET_DIRECT,
+                            self.registry.listing())
+            try:
+                await writer.drain()
+            except OSError:
+                pass
+            writer.close()
+        elif received_cell.type == CellType.GET_CONSENSUS:
+            document = self.consensus.serve()
+            if document is not None:
+                write_frame(writer, CellType.GET_CONSENSUS, document)
+                try:
+                    await writer.drain()
+                except OSError:
+                    pass
+            writer.close()
         else:
             # reject connection as it does not contain a valid cell.
-            relay_socket.close()
+            writer.close()
 
-    def handle_closed_conn(self, provided_socket):
-        """Handle a closed connection"""
-        reference = None
-        reference2 = None
+    @staticmethod
+    def verify_registration(received_cell):
+        """The public key of a relay's GIVE_DIRECT cell, or None if the
+        cell is not signed with it."""
         try:
-            provided_socket.send(b"Hello")
-        except (ConnectionResetError, ConnectionError):
-            # search for the socket, as it must be part of both lists.
-            for k in self.connected_relays:
-                if k["sock"] == provided_socket:
-                    reference = k
-
-            for k in self.registered_relays:
-                if k["ip_addr"] == reference["ip_addr"] \
-                        and k["port"] == reference["port"]:
-                    reference2 = k
-
-            self.connected_relays.remove(reference)
-            self.registered_relays.remove(reference2)
-            self.relay_sockets.remove(provided_socket)
-            print(f"Removed relay ({str(reference['ip_addr'])}, "
-                  + f"{str(reference['port'])}): Socket closed or timed-out")
-            print(self.registered_relays, end="\n\n")
-            provided_socket.close()
+            their_pubkey = serialization.load_pem_public_key(
+                received_cell.payload, backend=default_backend())
+            util.verify_signature(their_pubkey, received_cell.signature,
+                                  received_cell.salt)
+        except (InvalidSignature, ValueError, TypeError):
+            return None
+        return their_pubkey
 
-    def run(self):
-        """Start up directory"""
-        while True:
-            read_ready, _, _ = select.select(
-                [self.socket] + self.relay_sockets, [], [])
-            for i in read_ready:
-                if i == self.socket:  # is receiving a new connection request.
-                    self.handle_conn()
-                else:
-                    self.handle_closed_conn(i)
+    async def register(self, received_cell, reader, writer):
+        """List a relay until its connection closes."""
+        their_pubkey = self.verify_registration(received_cell)
+        if their_pubkey is None:
+            # reject connection, signature validation failed
+            self.counters["rejected"] += 1
+            writer.close()
+            return
+
+        # obtain the ip and port of that server.
+        ip_address = writer.get_extra_info("peername")[0]
+        port_num = received_cell.port
+        fileno = writer.get_extra_info("socket").fileno()
+        self.registry.add({
+            "ip_addr": ip_address,
+            "port": port_num,
+            "key": received_cell.payload,
+            # the suite clients must use, going by the identity key.
+            "suite": util.suite_of(their_pubkey)
+        }, fileno)
+        self.counters["registrations"] += 1
+        print(f"Added -> ({str(ip_address)}, {str(port_num)})")
+        try:
+            # relays only send their load from now on, until they hang up.
+            while True:
+                frame = await read_frame_async(reader)
+                if frame is None:
+                    break
+                if frame[0] == CellType.RELAY_STATUS:
+                    self.registry.report(fileno, *util.unpack_relay_status(
+                        Cell.from_bytes(frame[2]).payload))
+        except (OSError, FramingError, struct.error, ValueError, KeyError,
+                TypeError):
+            pass
+        finally:
+            if self.registry.remove(fileno) is not None:
+                print(f"Removed relay ({str(ip_address)}, {str(port_num)}): "
+                      + "Socket closed or timed-out")
+            writer.close()
+
+    def stats(self):
+        """Snapshot of the directory's counters."""
+        stats = dict(self.counters)
+        stats.update(self.registry.stats())
+        stats["consensus"] = self.consensus.stats()
+        return stats
+
+
+def main():
+    """Main function"""
+    # every listed relay holds a connection open.
+    util.raise_open_file_limit()
+    consensus_path = consensus.DEFAULT_CONSENSUS_FILE
+    for option in sys.argv[1:]:
+        if option.startswith("--consensus="):
+            consensus_path = option.split("=", 1)[1]
+    directory = DirectoryServer(consensus_path=consensus_path)
+    try:
+        directory.run()
+    except KeyboardInterrupt:
+        pass
+    print(f"Directory stats: {directory.stats()}")
 
 
 if __name__ == "__main__":
-    DIRECTORY = DirectoryServer()
-    DIRECTORY.run()
+    main()
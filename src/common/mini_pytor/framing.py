@@ -0,0 +1,162 @@
+"""Length-prefixed framing for cells sent over a socket"""
+
+import asyncio
+import itertools
+import struct
+
+from cell import CellType
+
+# body length, cell type, circuit id
+FRAME_HEADER = struct.Struct("!IBI")
+MAX_FRAME_SIZE = 1 << 24  # refuse anything bigger than 16 MiB
+RECV_SIZE = 65536
+MAX_BUFFERS = 1024  # buffers handed to a single sendmsg(), the usual IOV_MAX
+
+
+class FramingError(Exception):
+    """Raised when the peer sends something that is not a valid frame"""
+
+
+def pack_header(ctype, length, circ_id=0):
+    """Build the header that goes in front of a body of length bytes."""
+    return FRAME_HEADER.pack(length, ctype.value, circ_id)
+
+
+def send_frame(sock, ctype, body, circ_id=0):
+    """Send body as a single frame."""
+    send_frames(sock, [(ctype, body)], circ_id)
+
+
+def send_frames(sock, frames, circ_id=0):
+    """Send a list of (ctype, body) frames with as few system calls as
+    possible. Bodies may be memoryviews; they are not copied."""
+    buffers = []
+    for ctype, body in frames:
+        buffers.append(pack_header(ctype, len(body), circ_id))
+        buffers.append(body)
+    send_buffers(sock, buffers)
+
+
+def send_buffers(sock, buffers):
+    """sendall() for a list of buffers, gathered by sendmsg() where the
+    platform has it instead of being joined into one bytes object."""
+    if not hasattr(sock, "sendmsg"):  # Windows
+        sock.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(buffer) for buffer in buffers]
+    first = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first + MAX_BUFFERS])
+        # skip past whatever went out, which may end mid-buffer.
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+
+
+def send_queued(sock, queue):
+    """Send buffers off the front of a deque on a non-blocking socket until
+    it would block, leaving whatever did not go out at the front.
+    Returns the number of bytes sent."""
+    total = 0
+    while queue:
+        buffers = list(itertools.islice(queue, MAX_BUFFERS))
+        try:
+            if hasattr(sock, "sendmsg"):
+                sent = sock.sendmsg(buffers)
+            else:  # Windows
+                sent = sock.send(buffers[0])
+        except (BlockingIOError, InterruptedError):
+            break
+        total += sent
+        # drop whatever went out, which may end mid-buffer.
+        while queue and sent >= len(queue[0]):
+            sent -= len(queue[0])
+            queue.popleft()
+        if sent:
+            queue[0] = memoryview(queue[0])[sent:]
+    return total
+
+
+class FrameReader:
+    """Buffered reader that splits a socket's byte stream back into frames"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def _frame_length(self):
+        """Total length of the frame at the front of the buffer, if known."""
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+        length, _, _ = FRAME_HEADER.unpack_from(self.buffer)
+        if length > MAX_FRAME_SIZE:
+            raise FramingError(f"Frame of {length} bytes is too large")
+        return FRAME_HEADER.size + length
+
+    def pending(self):
+        """Whether a complete frame is already buffered."""
+        total = self._frame_length()
+        return total is not None and len(self.buffer) >= total
+
+    def read_frame(self):
+        """Read one frame, returning (ctype, circ_id, body).
+        Returns None if the peer closed the connection between frames."""
+        while not self.pending():
+            received = self.sock.recv(RECV_SIZE)
+            if not received:
+                if self.buffer:
+                    raise ConnectionResetError("Connection closed mid-frame")
+                return None
+            self.buffer += received
+
+        length, ctype, circ_id = FRAME_HEADER.unpack_from(self.buffer)
+        end = FRAME_HEADER.size + length
+        body = bytes(self.buffer[FRAME_HEADER.size:end])
+        del self.buffer[:end]
+        try:
+            ctype = CellType(ctype)
+        except ValueError:
+            raise FramingError(f"Unknown cell type {ctype}")
+        return ctype, circ_id, body
+
+
+async def read_frame_async(reader):
+    """Read one frame from an asyncio StreamReader.
+    Same return values as FrameReader.read_frame."""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as error:
+        if error.partial:
+            raise ConnectionResetError("Connection closed mid-frame")
+        return None
+    length, ctype, circ_id = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FramingError(f"Frame of {length} bytes is too large")
+    try:
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError("Connection closed mid-frame")
+    try:
+        ctype = CellType(ctype)
+    except ValueError:
+        raise FramingError(f"Unknown cell type {ctype}")
+    return ctype, circ_id, body
+
+
+def write_frame(writer, ctype, body, circ_id=0):
+    """Queue body as a single frame on an asyncio StreamWriter.
+    The caller is expected to drain() the writer."""
+    write_frames(writer, [(ctype, body)], circ_id)
+
+
+def write_frames(writer, frames, circ_id=0):
+    """Queue a list of (ctype, body) frames on an asyncio StreamWriter.
+    The caller is expected to drain() the writer."""
+    buffers = []
+    for ctype, body in frames:
+        buffers.append(pack_header(ctype, len(body), circ_id))
+        if body:  # some transports never get past an empty buffer
+            buffers.append(body)
+    writer.writelines(buffers)
@@ -0,0 +1,371 @@
+"""HTTP response cache, used by the exit relay and the client's proxy.
+Responses are kept by URL in memory, least recently used first out once
+their bodies take more than the cache's size, and optionally on disk too.
+Freshness follows the response's Cache-Control, Expires and Last-Modified
+headers; stale responses with an ETag or Last-Modified are revalidated
+with a conditional request instead of being fetched again."""
+
+import collections
+import email.utils
+import hashlib
+import json
+import os
+import stat
+import struct
+import threading
+import time
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024  # bytes of bodies kept in memory
+DISK_CACHE_FACTOR = 8  # the disk holds this many times the memory's worth
+MAX_ENTRY_SHARE = 8  # a response may fill at most 1/8th of the cache
+HEURISTIC_SHARE = 0.1  # of a page's age it is assumed to stay fresh for
+MAX_HEURISTIC_LIFETIME = 24 * 3600
+# responses kept without being told how long they stay fresh.
+CACHEABLE_STATUSES = (200, 203, 300, 301, 308, 404, 410)
+# headers of a 304 that do not describe the body kept.
+UNMERGED_HEADERS = ("connection", "keep-alive", "transfer-encoding",
+                    "content-encoding", "content-length")
+ENTRY_HEADER = struct.Struct("!I")  # length of an entry file's metadata
+
+
+def header_value(headers, name):
+    """Value of a header in a list of (name, value) pairs, or None."""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def parse_cache_control(value):
+    """Cache-Control directives, as {directive: argument or None}."""
+    directives = {}
+    for directive in (value or "").split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def parse_http_date(value):
+    """Timestamp of an HTTP date, or None if it is missing or unreadable."""
+    try:
+        parsed = email.utils.parsedate_tz(value) if value else None
+    except (TypeError, ValueError):
+        parsed = None
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+
+def seconds(argument):
+    """A delta-seconds directive argument, or 0 if it is not a number."""
+    try:
+        return max(0, int(argument))
+    except (TypeError, ValueError):
+        return 0
+
+
+def freshness_lifetime(status_code, headers, shared, now=None):
+    """Seconds a response stays fresh from now, or None if it may not be
+    kept at all. A shared cache, such as the exit's, serves many users and
+    so keeps neither private responses nor ones setting cookies."""
+    now = time.time() if now is None else now
+    directives = parse_cache_control(header_value(headers, "Cache-Control"))
+    if "no-store" in directives or header_value(headers, "Vary") == "*":
+        return None
+    if shared and ("private" in directives
+                   or header_value(headers, "Set-Cookie") is not None):
+        return None
+    date = parse_http_date(header_value(headers, "Date")) or now
+    last_modified = parse_http_date(header_value(headers, "Last-Modified"))
+    expires = header_value(headers, "Expires")
+    if shared and "s-maxage" in directives:
+        lifetime = seconds(directives["s-maxage"])
+    elif "max-age" in directives:
+        lifetime = seconds(directives["max-age"])
+    elif expires is not None:
+        # an unreadable date means already expired.
+        lifetime = (parse_http_date(expires) or date) - date
+    elif status_code in CACHEABLE_STATUSES and last_modified is not None:
+        lifetime = min(HEURISTIC_SHARE * (date - last_modified),
+                       MAX_HEURISTIC_LIFETIME)
+    else:
+        lifetime = 0
+    if status_code not in CACHEABLE_STATUSES \
+            and "max-age" not in directives and "s-maxage" not in directives \
+            and expires is None:
+        return None
+    if "no-cache" in directives:
+        lifetime = 0
+    lifetime -= seconds(header_value(headers, "Age"))
+    if lifetime <= 0 and header_value(headers, "ETag") is None \
+            and last_modified is None:
+        return None  # stale at once, and no way to revalidate it
+    return max(0, lifetime)
+
+
+class HttpCache:
+    """Responses kept by URL, see the module docstring.
+    Entries are dicts holding the status code, reason, headers as
+    [name, value] pairs and body of a response, and when it goes stale.
+    Safe to use from several threads."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE, directory=None,
+                 shared=True, max_disk_bytes=None):
+        """directory, if given, keeps entries on disk as well, up to
+        max_disk_bytes (by default DISK_CACHE_FACTOR times max_bytes), so
+        they survive restarts and being pushed out of memory.
+        shared says whether the cache serves more than one user."""
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // MAX_ENTRY_SHARE
+        self.shared = shared
+        self.directory = directory
+        self.max_disk_bytes = max_bytes * DISK_CACHE_FACTOR \
+            if max_disk_bytes is None else max_disk_bytes
+        self.entries = collections.OrderedDict()  # url -> entry, oldest first
+        self.size = 0  # bytes of the bodies in memory
+        self.on_disk = collections.OrderedDict()  # file name -> file size
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            "lookups": 0,
+            "hits": 0,  # answered while fresh
+            "revalidated": 0,  # answered after the website said unchanged
+            "stored": 0,
+            "evicted": 0,  # pushed out of memory to make room
+            "bytes_saved": 0  # of bodies answered from the cache
+        }
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.scan_directory()
+
+    def scan_directory(self):
+        """Index the entry files left on disk, oldest used first."""
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                status = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            if not stat.S_ISREG(status.st_mode):
+                continue  # such as the directories of forked workers
+            found.append((status.st_mtime, name, status.st_size))
+        for _, name, size in sorted(found):
+            self.on_disk[name] = size
+            self.disk_size += size
+
+    def for_worker(self, index):
+        """A cache like this one for forked worker number index. On disk it
+        keeps to a directory of its own, so no two processes count the
+        same files towards their max_disk_bytes."""
+        directory = None if self.directory is None \
+            else os.path.join(self.directory, f"worker{index}")
+        return HttpCache(self.max_bytes, directory, self.shared,
+                         self.max_disk_bytes)
+
+    @staticmethod
+    def file_name(url):
+        """Name of the file an entry for url is kept in."""
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def lookup(self, url):
+        """The entry kept for url and whether it is still fresh, or
+        (None, False). An entry that is not fresh can still be revalidated."""
+        with self.lock:
+            self.counters["lookups"] += 1
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+        if entry is None and self.directory is not None:
+            entry = self.load(url)
+        if entry is None:
+            return None, False
+        fresh = time.time() < entry["expires"]
+        if fresh:
+            with self.lock:
+                self.counters["hits"] += 1
+                self.counters["bytes_saved"] += len(entry["body"])
+        return entry, fresh
+
+    @staticmethod
+    def validators(entry):
+        """Headers making a request conditional on entry having changed."""
+        headers = {}
+        etag = header_value(entry["headers"], "ETag")
+        last_modified = header_value(entry["headers"], "Last-Modified")
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    @staticmethod
+    def headers_with_age(entry):
+        """An entry's headers, with an Age header saying how long it has
+        been kept, so a cache further along does not keep it fresh for
+        longer than it should be."""
+        age = int(time.time() - entry["stored"]) \
+            + seconds(header_value(entry["headers"], "Age"))
+        return [[name, value] for name, value in entry["headers"]
+                if name.lower() != "age"] + [["Age", str(age)]]
+
+    def storable(self, status_code, headers):
+        """Whether a response is worth collecting the body of to store."""
+        length = header_value(headers, "Content-Length")
+        if length is not None and length.isdigit() \
+                and int(length) > self.max_entry_bytes:
+            return False
+        return freshness_lifetime(status_code, headers, self.shared) \
+            is not None
+
+    def store(self, url, status_code, reason, headers, body):
+        """Keep a response, if its headers allow it. Returns the entry,
+        or None if it was not kept."""
+        headers = [[name, value] for name, value in headers]
+        lifetime = freshness_lifetime(status_code, headers, self.shared)
+        if lifetime is None or len(body) > self.max_entry_bytes:
+            return None
+        entry = {
+            "url": url,
+            "status_code": status_code,
+            "reason": reason,
+            "headers": headers,
+            "body": bytes(body),
+            "stored": time.time(),
+            "expires": time.time() + lifetime
+        }
+        self.keep(entry)
+        with self.lock:
+            self.counters["stored"] += 1
+        return entry
+
+    def revalidated(self, entry, headers):
+        """Refresh an entry the website answered 304 Not Modified for,
+        with the headers of that answer. Returns the refreshed entry."""
+        fresh_headers = [[name, value] for name, value in headers
+                         if name.lower() not in UNMERGED_HEADERS]
+        replaced = {name.lower() for name, _ in fresh_headers}
+        merged = [[name, value] for name, value in entry["headers"]
+                  if name.lower() not in replaced] + fresh_headers
+        lifetime = freshness_lifetime(entry["status_code"], merged,
+                                      self.shared)
+        entry = dict(entry, headers=merged, stored=time.time(),
+                     expires=time.time() + (lifetime or 0))
+        if lifetime is None:
+            self.forget(entry["url"])
+        else:
+            self.keep(entry)
+        with self.lock:
+            self.counters["revalidated"] += 1
+            self.counters["bytes_saved"] += len(entry["body"])
+        return entry
+
+    def keep(self, entry):
+        """Put an entry in memory, and on disk if there is one, making
+        room for it."""
+        with self.lock:
+            self._remember(entry)
+        if self.directory is not None:
+            self.save(entry)
+
+    def _remember(self, entry):
+        """Put an entry in memory, evicting the least recently used ones
+        to make room. The caller holds the lock."""
+        old = self.entries.pop(entry["url"], None)
+        if old is not None:
+            self.size -= len(old["body"])
+        self.entries[entry["url"]] = entry
+        self.size += len(entry["body"])
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted["body"])
+            self.counters["evicted"] += 1
+
+    def forget(self, url):
+        """Drop whatever is kept for url."""
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.size -= len(old["body"])
+        if self.directory is not None:
+            self.remove_file(self.file_name(url))
+
+    def save(self, entry):
+        """Write an entry to its file, then drop the files used least
+        recently until the disk holds no more than max_disk_bytes."""
+        meta = dict(entry)
+        body = meta.pop("body")
+        meta = json.dumps(meta).encode()
+        name = self.file_name(entry["url"])
+        path = os.path.join(self.directory, name)
+        # unique, since other threads or workers may save the same url.
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as entry_file:
+                entry_file.write(ENTRY_HEADER.pack(len(meta)))
+                entry_file.write(meta)
+                entry_file.write(body)
+            os.replace(temp_path, path)  # never leave half an entry
+        except OSError:
+            return
+        size = ENTRY_HEADER.size + len(meta) + len(body)
+        with self.lock:
+            self.disk_size += size - self.on_disk.pop(name, 0)
+            self.on_disk[name] = size
+            dropped = []
+            while self.disk_size > self.max_disk_bytes and self.on_disk:
+                old_name, old_size = self.on_disk.popitem(last=False)
+                self.disk_size -= old_size
+                dropped.append(old_name)
+        for old_name in dropped:
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except OSError:
+                pass
+
+    def load(self, url):
+        """Read the entry for url back from disk into memory, or None."""
+        name = self.file_name(url)
+        try:
+            with open(os.path.join(self.directory, name), "rb") as entry_file:
+                data = entry_file.read()
+            meta_length, = ENTRY_HEADER.unpack_from(data)
+            entry = json.loads(
+                data[ENTRY_HEADER.size:ENTRY_HEADER.size + meta_length])
+        except (OSError, ValueError, struct.error):
+            return None
+        if entry.get("url") != url:
+            return None
+        entry["body"] = data[ENTRY_HEADER.size + meta_length:]
+        with self.lock:
+            if name in self.on_disk:
+                self.on_disk.move_to_end(name)
+            if len(entry["body"]) <= self.max_entry_bytes:
+                self._remember(entry)
+        return entry
+
+    def remove_file(self, name):
+        """Delete an entry's file."""
+        with self.lock:
+            self.disk_size -= self.on_disk.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def stats(self):
+        """Snapshot of the cache's counters."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.size
+            stats["disk_bytes"] = self.disk_size
+        stats["hit_ratio"] = hit_ratio(stats)
+        return stats
+
+
+def hit_ratio(stats):
+    """Share of the lookups answered from the cache, given its stats."""
+    answered = stats["hits"] + stats["revalidated"]
+    return round(answered / stats["lookups"], 3) if stats["lookups"] else 0
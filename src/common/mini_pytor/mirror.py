@@ -0,0 +1,155 @@
+"""Directory mirror: serves copies of the directory's consensus document"""
+
+import asyncio
+import struct
+import sys
+
+from cryptography.exceptions import InvalidSignature
+
+import consensus
+import util
+from cell import Cell, CellType
+from framing import FramingError, read_frame_async, write_frame
+
+DEFAULT_DIRECTORY_ADDRESS = ("127.0.0.1", 50000)
+MIRROR_PORT = 50001
+MIRROR_CONSENSUS_FILE = "consensus-mirror.bin"
+MIRROR_REFRESH_INTERVAL = 5  # seconds between downloads from the directory
+REQUEST_TIMEOUT = 1  # seconds allowed for a peer to send its request
+LISTEN_BACKLOG = 1024
+
+
+class ConsensusMirror:
+    """Keeps a copy of the directory's consensus document and serves it,
+    so clients can fetch the listing without loading the directory.
+    Documents are only kept once their signature has been checked against
+    the directory's public key, and the last one survives restarts."""
+
+    def __init__(self, port=MIRROR_PORT,
+                 directory_address=DEFAULT_DIRECTORY_ADDRESS,
+                 consensus_path=MIRROR_CONSENSUS_FILE):
+        self.port = port
+        self.directory_address = directory_address
+        self.directory_key = consensus.load_directory_public_key()
+        self.consensus = consensus.ConsensusFile(consensus_path)
+        self.epoch = None  # of the document being served
+        self.version = None
+        self.loop = None
+        self.counters = {
+            "downloads": 0,
+            "download_failures": 0,
+            "unchanged": 0
+        }
+
+    def run(self):
+        """Serve until interrupted."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # the last document downloaded, unless it has expired meanwhile.
+        checked = self.check(self.consensus.document) \
+            if self.consensus.load() else None
+        if checked is None:
+            self.consensus.document = None
+        else:
+            self.epoch, self.version = checked["epoch"], checked["version"]
+        server = self.loop.run_until_complete(asyncio.start_server(
+            self.handle_conn, "", self.port, backlog=LISTEN_BACKLOG))
+        fetcher = self.loop.create_task(self.fetch_loop())
+        try:
+            self.loop.run_forever()
+        finally:
+            fetcher.cancel()
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+
+    def check(self, document):
+        """What a document says, or None if it is not one to serve."""
+        try:
+            return consensus.unpack_consensus(document, self.directory_key)
+        except (InvalidSignature, ValueError, KeyError, struct.error):
+            return None
+
+    async def fetch_loop(self):
+        """Download the consensus from the directory every
+        MIRROR_REFRESH_INTERVAL seconds."""
+        while True:
+            try:
+                await self.fetch()
+            except (OSError, FramingError):
+                self.counters["download_failures"] += 1
+            await asyncio.sleep(MIRROR_REFRESH_INTERVAL)
+
+    async def fetch(self):
+        """Download the directory's consensus, and serve it if it checks out."""
+        reader, writer = await asyncio.open_connection(*self.directory_address)
+        try:
+            write_frame(writer, CellType.GET_CONSENSUS,
+                        Cell(b"", ctype=CellType.GET_CONSENSUS).to_bytes())
+            await writer.drain()
+            frame = await read_frame_async(reader)
+        finally:
+            writer.close()
+        if frame is None or frame[0] != CellType.GET_CONSENSUS:
+            raise ConnectionResetError("Directory sent no consensus")
+        document = frame[2]
+        # parsing a big listing takes a while; keep serving meanwhile.
+        checked = await self.loop.run_in_executor(None, self.check, document)
+        if checked is None:
+            self.counters["download_failures"] += 1
+            return
+        self.counters["downloads"] += 1
+        if (checked["epoch"], checked["version"]) == (self.epoch, self.version):
+            # same listing, but the new signature is good for longer.
+            self.counters["unchanged"] += 1
+        self.epoch, self.version = checked["epoch"], checked["version"]
+        await self.loop.run_in_executor(None, self.consensus.publish, document)
+
+    async def handle_conn(self, reader, writer):
+        """Answer GET_CONSENSUS requests; anything else is turned away."""
+        try:
+            frame = await asyncio.wait_for(
+                read_frame_async(reader), REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, FramingError, OSError):
+            frame = None
+        document = self.consensus.serve() \
+            if frame is not None and frame[0] == CellType.GET_CONSENSUS \
+            else None
+        if document is not None:
+            write_frame(writer, CellType.GET_CONSENSUS, document)
+            try:
+                await writer.drain()
+            except OSError:
+                pass
+        writer.close()
+
+    def stats(self):
+        """Snapshot of the mirror's counters."""
+        stats = dict(self.counters)
+        stats["version"] = self.version
+        stats["consensus"] = self.consensus.stats()
+        return stats
+
+
+def main():
+    """Main function: python mirror.py [port] (directory ip) (directory port)"""
+    util.raise_open_file_limit()
+    options = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    consensus_path = MIRROR_CONSENSUS_FILE
+    for option in options:
+        if option.startswith("--consensus="):
+            consensus_path = option.split("=", 1)[1]
+    port = int(args[0]) if args else MIRROR_PORT
+    directory_address = (args[1], int(args[2])) if len(args) == 3 \
+        else DEFAULT_DIRECTORY_ADDRESS
+    mirror = ConsensusMirror(port, directory_address, consensus_path)
+    try:
+        mirror.run()
+    except KeyboardInterrupt:
+        pass
+    print(f"Mirror stats: {mirror.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,92 +1,88 @@
 """Relay server class file"""
 
-import pickle
+import asyncio
+import collections
+import errno
+import http.cookiejar
+import json
+import multiprocessing
 import os
 import select
+import signal
 import sys
 import socket
 import struct
+import threading
 import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 
 import requests
+import requests.adapters
 import cryptography.hazmat.primitives.asymmetric.padding
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa, x25519
 
+import httpcache
 import util
 from cell import Cell, CellType
+from framing import (FRAME_HEADER, FrameReader, FramingError, pack_header,
+                     send_frame, send_queued, read_frame_async, write_frames)
 
+HANDSHAKE_TIMEOUT = 0.3  # seconds a new client has to send its first cell
+CIRCUIT_TIMEOUT = 60  # seconds an established circuit may block a send/recv
+RESPONSE_READ_SIZE = 65536  # bytes read from the website at a time
+RESPONSE_CHUNK_SIZE = 4096  # body bytes carried by each frame
+# a CONTINUE cell is its fixed header followed by the chunk.
+CONTINUE_HEADER = Cell(b"", ctype=CellType.CONTINUE).to_bytes()
+WORKER_STATS_INTERVAL = 5  # seconds between stats reports from each worker
+STATUS_INTERVAL = 5  # seconds between load reports to the directory
+BANDWIDTH_WINDOW = 12  # reports the reported bandwidth is the best of
+CIRC_ID_LIMIT = (1 << 32) - 1  # circuit ids on a link run from 1 to this
+FETCH_AHEAD = 4  # pieces a fetching thread may read ahead of the relay
+LINK_IDLE_TIMEOUT = 60  # seconds a link to another relay is kept unused
+LINK_SWEEP_INTERVAL = 5  # seconds between looks for idle links
+LINK_CIRCUITS = 64  # circuits a link carries before another one is opened
+MAX_PEER_LINKS = 4  # links kept open to the same relay
+FETCH_TIMEOUT = (10, 30)  # seconds to connect to a website, and to wait on it
+FETCH_POOL_HOSTS = 32  # websites the exit keeps connections open to
+FETCH_POOL_SIZE = 16  # connections kept open to each of them
+FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 "
+                  + "(Windows NT 10.0; Win64; x64) "
+                  + "AppleWebKit/537.36 (KHTML, like Gecko) "
+                  + "Chrome/70.0.3538.77 Safari/537.36"
+}
+# bytes queued on a link below which the exit fetches more for it
+OUTBOX_LOW_WATER = 1 << 20
+# handed over by a fetching thread in place of a piece if the website
+# broke off part way.
+FETCH_FAILED = object()
 
-class ClientData:
-    """Client data class"""
 
-    def __init__(self, sock, key, generated_key):
-        self.sock = sock
-        self.key = key  # the derived key
-        # the generated elliptic curve diffie hellman key.
-        self.generated_key = generated_key
-        self.bounce_ip = None
-        self.bounce_port = None
-        self.bounce_socket = None
+class HandshakeResponder:
+    """The identity key and ephemeral keys a relay answers handshakes with.
+    Kept apart from the rest of the relay so that crypto worker processes
+    can hold a copy of their own."""
 
-
-class Relay():
-    """Relay class"""
-    CLIENTS = []
-    CLIENT_SOCKS = []
-
-    def __init__(self, port_number, identity=None, directory_address=("127.0.0.1", 50000)):
-        pem_file = os.path.join(
-            os.path.dirname(__file__),
-            "privates/privatetest" + str(identity) + ".pem"
-        )
-        if identity:  # if identity was provided
-            temp_open = open(pem_file, "rb")
-            self.true_private_key = serialization.load_pem_private_key(
-                temp_open.read(), password=None, backend=default_backend())
-
-        else:  # no provided identity. Generate a key.
-            self.true_private_key = rsa.generate_private_key(
-                backend=default_backend(),
-                public_exponent=65537,
-                key_size=4096
-            )
-        self.sendingpublickey = self.true_private_key.public_key()
-
-        serialised_public_key = self.sendingpublickey.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo)
-        # obtain the serialised public key for directory
-        base_bytearray = os.urandom(128)
-        # generate random bytearray with 128 bytes.
-        signedbytearray = self.sign(base_bytearray)
-
-        directory_cell = Cell(serialised_public_key,
-                              signature=signedbytearray,
-                              salt=base_bytearray,
-                              IV=port_number,
-                              ctype=CellType.GIVE_DIRECT)
-        # store the byte array, signed version, serialised public key,
-        # and actual port number for sending.
-
-        self.directory_socket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
-        self.directory_socket.connect(directory_address)
-        # connect to the directory server.
-        self.directory_socket.send(pickle.dumps(directory_cell))
-
-        # begin listening for clientele.
-        self.relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.relay_socket.bind(("", port_number))
-        self.relay_socket.listen(100)
+    def __init__(self, private_key, suite=util.SUITE_RSA,
+                 ephemeral_pool_size=util.EPHEMERAL_POOL_SIZE):
+        self.suite = suite
+        self.true_private_key = private_key
+        self.ephemeral_keys = util.EphemeralKeyPool(
+            ephemeral_pool_size,
+            make_key_pair=util.x25519_key_pair
+            if suite == util.SUITE_X25519 else util.ecdh_key_pair)
+        self.ephemeral_keys.start()
 
     def sign(self, given_bytes):
         """Signs stuff."""
+        if self.suite == util.SUITE_X25519:
+            return self.true_private_key.sign(given_bytes)
         signed_bytes = self.true_private_key.sign(  # sign byte array to prove you own the key
             given_bytes, cryptography.hazmat.primitives.asymmetric.padding.PSS(
                 mgf=cryptography.hazmat.primitives.asymmetric.padding.MGF1(
@@ -109,43 +105,49 @@ class Relay():
             )
         )
 
-    def exchange_keys(self, client_sock, obtained_cell):
-        """Exchange Key with someone, obtaining a shared secret.
-        Also, generate salt and pass it back to them with your private key."""
-
-        private_key = ec.generate_private_key(
-            ec.SECP384R1(), default_backend())  # elliptic curve
-        public_key = private_key.public_key()  # duh same.
-        serialised_public_key = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        # serialise the public key that I'm going to send them
-        their_key = serialization.load_pem_public_key(
-            obtained_cell.payload, backend=default_backend())
-        shared_key = private_key.exchange(ec.ECDH(), their_key)
+    def make_key_reply(self, obtained_cell):
+        """Derive the shared key for an ADD_CON cell, and build the signed
+        CONNECT_RESP reply that lets the client derive it too."""
+        # a ready made key, with the public key that I'm going to send them
+        private_key, serialised_public_key = self.ephemeral_keys.take()
         salty = os.urandom(8)
+        if self.suite == util.SUITE_X25519:
+            their_key = x25519.X25519PublicKey.from_public_bytes(
+                obtained_cell.payload)
+            shared_key = private_key.exchange(their_key)
+            # sign both keys along with the salt.
+            signature = self.sign(util.x25519_transcript(
+                obtained_cell.payload, serialised_public_key, salty))
+        else:
+            their_key = serialization.load_pem_public_key(
+                obtained_cell.payload, backend=default_backend())
+            shared_key = private_key.exchange(ec.ECDH(), their_key)
+            signature = self.sign(salty)  # sign the random bytes
         derived_key = HKDF(
             algorithm=hashes.SHA256(),
-            length=32,
+            length=util.DERIVED_KEY_SIZE,
             salt=salty,
             info=None,
             backend=default_backend()
         ).derive(shared_key)
         reply_cell = Cell(serialised_public_key,
                           salt=salty, ctype=CellType.CONNECT_RESP)
-        signature = self.sign(salty)  # sign the random bytes
         reply_cell.signature = signature  # assign the signature.
         if util.RELAY_DEBUG:
             print("reply cell")
-            print(pickle.dumps(reply_cell))
-        # send them the serialised version.
-        client_sock.send(pickle.dumps(reply_cell))
-        return private_key, derived_key
+            print(reply_cell.to_bytes())
+        return private_key, derived_key, reply_cell.to_bytes()
 
-    def handle_client(self, client_sock):
-        """A method to handle client connections."""
-        obtained_cell = client_sock.recv(4096)
+    def open_handshake(self, obtained_cell):
+        """Decrypt the RSA encrypted body of an ADD_CON frame; x25519
+        relays get theirs in the clear.
+        Returns the ADD_CON cell, or None if it is not a valid one."""
+        if self.suite == util.SUITE_X25519:
+            obtained_cell = Cell.from_bytes(obtained_cell)
+            if obtained_cell.type != CellType.ADD_CON \
+                    or len(obtained_cell.payload) != util.X25519_KEY_SIZE:
+                return None
+            return obtained_cell
         try:
             if util.RELAY_DEBUG:
                 print("raw data obtained. (Cell)")
@@ -161,310 +163,1567 @@ class Relay():
             print("Decrypted cell with actual keys")
             print(obtained_cell)
 
-        obtained_cell = pickle.loads(obtained_cell)
+        obtained_cell = Cell.from_bytes(obtained_cell)
         if util.RELAY_DEBUG:
-            print("after pickle load")
+            print("after unpacking")
             print(obtained_cell)
         if obtained_cell.type != CellType.ADD_CON:  # wrongly generated cell!
             return None
+        return obtained_cell
 
-        generated_privkey, derived_key = self.exchange_keys(
-            client_sock, obtained_cell)
-        client_obj = {
-            "sock": client_sock,
-            "key": derived_key,
-            "generated_key": generated_privkey,
-            "bounce_ip": None,
-            "bounce_port": None,
-            "bounce_socket": None
+    def answer_handshake(self, body):
+        """All the crypto of a handshake: open the body of an ADD_CON frame
+        and make the reply. Returns the derived key and the CONNECT_RESP
+        body, or None if the handshake is not a valid one."""
+        try:
+            obtained_cell = self.open_handshake(body)
+            if obtained_cell is None:
+                return None
+            _, derived_key, reply_bytes = self.make_key_reply(obtained_cell)
+        except (struct.error, ValueError):
+            return None
+        return derived_key, reply_bytes
+
+
+# handshake responders of a crypto worker process, by identity key.
+_CRYPTO_WORKER_RESPONDERS = {}
+
+
+def load_responder(private_pem, suite, ephemeral_pool_size):
+    """The handshake responder of a crypto worker process for an identity
+    key, made the first time it is asked for."""
+    responder = _CRYPTO_WORKER_RESPONDERS.get(private_pem)
+    if responder is None:
+        private_key = serialization.load_pem_private_key(
+            private_pem, password=None, backend=default_backend())
+        responder = HandshakeResponder(private_key, suite, ephemeral_pool_size)
+        _CRYPTO_WORKER_RESPONDERS[private_pem] = responder
+    return responder
+
+
+def answer_handshake(private_pem, suite, ephemeral_pool_size, body):
+    """HandshakeResponder.answer_handshake in a crypto worker process."""
+    return load_responder(
+        private_pem, suite, ephemeral_pool_size).answer_handshake(body)
+
+
+def warm_up(private_pem, suite, ephemeral_pool_size):
+    """Load the identity key in a crypto worker ahead of its first
+    handshake, and let its key pool start filling."""
+    load_responder(private_pem, suite, ephemeral_pool_size)
+
+
+class Relay(HandshakeResponder):
+    """Relay class.
+    Circuits travel over links: one connection to each client, and a few
+    to each neighbouring relay, shared by the circuits heading there and
+    kept open for a while after the last one closes.
+    Frames name the circuit they belong to by its id on the link."""
+
+    def __init__(self, port_number, identity=None, directory_address=("127.0.0.1", 50000),
+                 ephemeral_pool_size=util.EPHEMERAL_POOL_SIZE,
+                 suite=util.SUITE_RSA, reuse_port=False, crypto_workers=0,
+                 max_peer_links=MAX_PEER_LINKS, fetch_timeout=FETCH_TIMEOUT,
+                 cache=None):
+        """directory_address may be None to run without registering.
+        reuse_port lets forked workers listen on the same port.
+        crypto_workers is the number of processes handshakes are handed
+        to, so they do not hold up established circuits; 0 for none.
+        max_peer_links caps the links opened to any one relay.
+        fetch_timeout is given to requests for every website fetched.
+        cache is an httpcache.HttpCache to answer fetches from, if any."""
+        self.port = port_number
+        self.max_peer_links = max_peer_links
+        self.fetch_timeout = fetch_timeout
+        self.session = self.new_session()
+        # sockets to websites that have carried a fetch already.
+        self.used_connections = weakref.WeakSet()
+        self.fetch_lock = threading.Lock()  # fetches run in many threads
+        self.cache = cache
+        # with crypto workers, handshakes are answered by the workers' own
+        # responders, so this one needs no key pool.
+        self.crypto_workers = crypto_workers
+        self.crypto_executor = None  # started when first needed
+        self.ephemeral_pool_size = ephemeral_pool_size
+        HandshakeResponder.__init__(
+            self, self.load_identity(identity, suite), suite,
+            0 if crypto_workers else ephemeral_pool_size)
+        self.private_pem = None  # identity key, as sent to crypto workers
+        # crypto worker future -> link and circuit id of the handshake
+        self.pending_handshakes = {}
+        self.links = {}  # socket -> link
+        self.peer_links = {}  # relay address -> links we opened to it
+        self.circuit_count = 0
+        self.fetched = collections.deque()  # pieces read by fetching threads
+        # lets the executor wake up the select loop when one is done.
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.sendingpublickey = self.true_private_key.public_key()
+        self.counters = {
+            "circuits": 0,  # handshakes completed
+            "failed_handshakes": 0,
+            "extends": 0,
+            "requests": 0,
+            "offloaded_handshakes": 0,  # answered by a crypto worker
+            "bytes_relayed": 0,  # sent back towards clients
+            "links_opened": 0,  # to other relays
+            "links_reused": 0,  # extends that found a link already open
+            "links_expired": 0,  # closed after LINK_IDLE_TIMEOUT unused
+            "fetches": 0,  # websites fetched for clients
+            "fetches_reused": 0  # over a connection kept open from before
         }
-        client_name = client_obj["sock"].getpeername()
-        self.CLIENTS.append(client_obj)
-        self.CLIENT_SOCKS.append(client_sock)
-        print(f"Connected to client:{client_name}\n\n\n")
-        return client_obj
+
+        # begin listening for clientele.
+        self.relay_socket = self.listen(port_number, reuse_port)
+        self.directory_socket = None
+        if directory_address is not None:
+            self.register(directory_address)
+
+    @staticmethod
+    def listen(port_number, reuse_port=False):
+        """Open the socket clients connect to."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", port_number))
+        sock.listen(100)
+        return sock
+
+    def register(self, directory_address):
+        """Announce this relay to the directory, which lists it for as long
+        as the connection stays open."""
+        serialised_public_key = self.sendingpublickey.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        # obtain the serialised public key for directory
+        base_bytearray = os.urandom(128)
+        # generate random bytearray with 128 bytes.
+        signedbytearray = self.sign(base_bytearray)
+
+        directory_cell = Cell(serialised_public_key,
+                              signature=signedbytearray,
+                              salt=base_bytearray,
+                              ctype=CellType.GIVE_DIRECT)
+        directory_cell.port = self.port
+        # store the byte array, signed version, serialised public key,
+        # and actual port number for sending.
+
+        self.directory_socket = socket.socket(
+            socket.AF_INET, socket.SOCK_STREAM)
+        self.directory_socket.connect(directory_address)
+        # connect to the directory server.
+        send_frame(self.directory_socket, CellType.GIVE_DIRECT,
+                   directory_cell.to_bytes())
+
+    def start_status_reports(self):
+        """Report this relay's load to the directory every STATUS_INTERVAL
+        seconds from now on, if it is registered."""
+        if self.directory_socket is None:
+            return
+        reporter = StatusReporter(self.directory_socket)
+
+        def report_loop():
+            while True:
+                time.sleep(STATUS_INTERVAL)
+                stats = self.stats()
+                try:
+                    reporter.report(stats["bytes_relayed"],
+                                    stats["open_circuits"])
+                except OSError:
+                    return  # the directory is gone, and so is our listing
+
+        threading.Thread(target=report_loop, daemon=True).start()
+
+    def after_fork(self, ephemeral_pool_size, index=0):
+        """Set up this copy of the relay in a forked worker. Threads do not
+        survive a fork, so it gets a key pool of its own, as well as its
+        own wakeup sockets for its crypto workers. Where the platform has
+        SO_REUSEPORT it gets a listening socket of its own too, so the
+        kernel spreads new connections over the workers. A disk cache gets
+        a directory per worker, index, since each one accounts for the
+        size of its files by itself."""
+        self.ephemeral_pool_size = ephemeral_pool_size
+        if self.cache is not None:
+            self.cache = self.cache.for_worker(index)
+        self.ephemeral_keys = util.EphemeralKeyPool(
+            0 if self.crypto_workers else ephemeral_pool_size,
+            make_key_pair=self.ephemeral_keys.make_key_pair)
+        self.ephemeral_keys.start()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        if hasattr(socket, "SO_REUSEPORT"):
+            inherited = self.relay_socket
+            self.relay_socket = self.listen(self.port, reuse_port=True)
+            inherited.close()
+        else:
+            # every worker waits on the one socket; the losers of a race
+            # for a new connection must not block in accept().
+            self.relay_socket.setblocking(False)
+
+    def open_circuits(self):
+        """Number of circuits being served right now."""
+        return self.circuit_count
+
+    def stats(self):
+        """Snapshot of the relay's counters."""
+        stats = dict(self.counters)
+        stats["open_circuits"] = self.open_circuits()
+        stats["open_links"] = len(self.links)
+        stats["peer_links"] = sum(len(links)
+                                  for links in self.peer_links.values())
+        stats["pending_handshakes"] = len(self.pending_handshakes)
+        stats["ephemeral_keys"] = self.ephemeral_keys.stats()
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def start_crypto_workers(self):
+        """Start the crypto worker processes, if there are to be any, and
+        get them ready for handshakes without waiting for them."""
+        if not self.crypto_workers or self.crypto_executor is not None:
+            return
+        self.private_pem = self.true_private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption())
+        try:
+            # spawned rather than forked, so the workers hold on to
+            # none of our sockets.
+            self.crypto_executor = ProcessPoolExecutor(
+                self.crypto_workers,
+                mp_context=multiprocessing.get_context("spawn"))
+        except TypeError:  # no mp_context before Python 3.7
+            self.crypto_executor = ProcessPoolExecutor(self.crypto_workers)
+        for _ in range(self.crypto_workers):
+            self.crypto_executor.submit(
+                warm_up, self.private_pem, self.suite,
+                self.ephemeral_pool_size // self.crypto_workers)
+
+    def submit_handshake(self, body):
+        """Hand a handshake to the crypto workers, starting them if need be.
+        Returns a future for what answer_handshake returns."""
+        self.start_crypto_workers()
+        self.counters["offloaded_handshakes"] += 1
+        return self.crypto_executor.submit(
+            answer_handshake, self.private_pem, self.suite,
+            self.ephemeral_pool_size // self.crypto_workers, body)
 
     @staticmethod
-    def extend_circuit(client_reference, cell_to_next, decrypted,
-                       socket_to_client):
-        """Extend the circuit"""
+    def load_identity(identity, suite):
+        """Load the relay's identity key for its handshake suite, or
+        generate one if no identity was provided."""
+        if suite == util.SUITE_X25519:
+            prefix = "privates/ed25519test"
+        else:
+            prefix = "privates/privatetest"
+        if identity:  # if identity was provided
+            pem_file = os.path.join(
+                os.path.dirname(__file__), prefix + str(identity) + ".pem")
+            with open(pem_file, "rb") as temp_open:
+                return serialization.load_pem_private_key(
+                    temp_open.read(), password=None, backend=default_backend())
+        # no provided identity. Generate a key.
+        if suite == util.SUITE_X25519:
+            return ed25519.Ed25519PrivateKey.generate()
+        return rsa.generate_private_key(
+            backend=default_backend(),
+            public_exponent=65537,
+            key_size=4096
+        )
+
+    def new_link(self, sock, peer=None):
+        """Record for a connection to a client or another relay. Any
+        number of circuits can share it, told apart by their circuit ids.
+        peer is the relay's address, for links this relay opened.
+        The socket is non-blocking: frames are queued in the outbox and
+        sent as the other end takes them, so two relays sending to each
+        other at once cannot both get stuck in a send."""
+        sock.setblocking(False)
+        return {
+            "sock": sock,
+            "reader": FrameReader(sock),
+            "circuits": {},  # circuit id on this link -> circuit
+            "peer": peer,
+            "next_circ_id": 1,
+            "closed": False,
+            "connecting": False,  # frames wait in the outbox until it is up
+            "outbox": collections.deque(),  # buffers waiting to be sent
+            "queued": 0,  # bytes in the outbox
+            "last_sent": time.monotonic(),
+            "idle_since": None,  # when a peer link was first seen unused
+            # for a new connection, when its handshake has to have come in.
+            "handshake_by": None,
+            # exit streams waiting for the outbox to empty out.
+            "waiting": []
+        }
+
+    def new_circuit(self, link, circ_id, derived_key):
+        """Record for a circuit that came in on link as circ_id."""
+        circuit = {
+            "link": link,  # towards the client
+            "circ_id": circ_id,
+            "key": derived_key,
+            "cipher": util.LayerCipher(derived_key),
+            "next": None,  # (link, circuit id) towards the next hop
+            "extending": False,  # waiting for the next hop's handshake
+            "closed": False
+        }
+        link["circuits"][circ_id] = circuit
+        self.circuit_count += 1
+        return circuit
+
+    def accept(self):
+        """Take a new connection, which has to start with a handshake."""
+        print("Client connecting...")
         try:
-            sock = socket.socket(
-                socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((cell_to_next.ip_addr, cell_to_next.port))
-            if util.RELAY_DEBUG:
-                print((cell_to_next.ip_addr, cell_to_next.port))
-                print("cell to next")
-                print(decrypted)
-                print("payload")
-                print(cell_to_next.payload)
-            # send over the cell payload
-            sock.send(cell_to_next.payload)
-            their_cell = sock.recv(4096)  # await answer
-            if util.RELAY_DEBUG:
-                print("got values")
-                print(their_cell)
-            if their_cell == b"":
-                encrypted, init_vector = util.aes_encryptor(
-                    client_reference["key"],
-                    Cell("", ctype=CellType.FAILED)
-                )
-
-                if util.RELAY_DEBUG:
-                    print("sent failed")
-                socket_to_client.send(pickle.dumps(Cell(
-                    encrypted,
-                    IV=init_vector,
-                    ctype=CellType.FAILED)))
-            else:
-                encrypted, init_vector = util.aes_encryptor(
-                    client_reference["key"],
-                    Cell(their_cell, ctype=CellType.CONNECT_RESP)
-                )
-                if util.RELAY_DEBUG:
-                    print("sent valid response")
-                socket_to_client.send(pickle.dumps(Cell(
-                    encrypted,
-                    IV=init_vector,
-                    ctype=CellType.FINISHED
-                )))
-                # Save next target addr
-                client_reference["bounce_ip"] = cell_to_next.ip_addr
-                client_reference["bounce_port"] = cell_to_next.port
-                client_reference["bounce_socket"] = sock
-                print("Connection success.\n\n\n\n\n")
+            client_sock, _ = self.relay_socket.accept()
+        except BlockingIOError:
+            return  # another worker took it
+        # its first frame is read by the select loop like any other, so a
+        # slow client holds up nobody else; read_link checks what it is.
+        link = self.new_link(client_sock)
+        link["handshake_by"] = time.monotonic() + HANDSHAKE_TIMEOUT
+        self.links[client_sock] = link
 
-        except (ConnectionRefusedError, ConnectionResetError,
-                ConnectionAbortedError, struct.error,
-                socket.timeout):
-            print("Failed to connect to other relay. "
-                  + "Sending back failure message, or timed out.",
-                  file=sys.stderr)
+    def start_handshake(self, link, circ_id, body):
+        """Answer an ADD_CON frame for a new circuit on link.
+        With crypto workers the handshake is only handed over here, and
+        finished by finish_pending_handshakes."""
+        if self.crypto_workers:
+            future = self.submit_handshake(body)
+            self.pending_handshakes[future] = (link, circ_id)
+            future.add_done_callback(self.wake)
+            return
+        self.finish_handshake(link, circ_id, self.answer_handshake(body))
 
-            inner_cell_pickle = pickle.dumps(
-                Cell("CONNECTIONREFUSED", ctype=CellType.FAILED))
-            encrypted, init_vector = util.aes_encryptor(
-                client_reference["key"],
-                Cell(inner_cell_pickle, ctype=CellType.FAILED)
-            )
-            socket_to_client.send(pickle.dumps(Cell(
-                encrypted,
-                IV=init_vector,
-                ctype=CellType.FAILED
-            )))
-            print("sent back failure message.")
+    def wake(self, _):
+        """Wake the select loop up; called from other threads."""
+        self.wakeup_writer.send(b"\0")
+
+    def finish_pending_handshakes(self):
+        """Send the replies of the handshakes the crypto workers are done with."""
+        for future in [future for future in self.pending_handshakes
+                       if future.done()]:
+            link, circ_id = self.pending_handshakes.pop(future)
+            answer = None if future.exception() else future.result()
+            if link["closed"]:
+                print("Client left before its handshake was answered",
+                      file=sys.stderr)
+                continue
+            self.finish_handshake(link, circ_id, answer)
+
+    def finish_handshake(self, link, circ_id, answer):
+        """Reply to a handshake, given what answer_handshake made of it,
+        and start serving the circuit."""
+        if answer is None:
+            self.counters["failed_handshakes"] += 1
+            if link["circuits"]:
+                # the link's other circuits are fine.
+                self.send(link, CellType.DESTROY, b"", circ_id)
+            else:
+                self.close_link(link)
+            return None
+        self.counters["circuits"] += 1
+        derived_key, reply_bytes = answer
+        # send them the serialised version.
+        self.send(link, CellType.CONNECT_RESP, reply_bytes, circ_id)
+        circuit = self.new_circuit(link, circ_id, derived_key)
+        print(f"Connected to client:{self.link_name(link)} "
+              + f"circuit {circ_id}\n\n\n")
+        return circuit
 
     @staticmethod
-    def request_processing(client_reference, cell_to_next):
-        """method to process a request."""
-        print(cell_to_next.payload)
-        if isinstance(cell_to_next.payload, str):
-            request = cell_to_next.payload
+    def link_name(link):
+        """Address of the other end of a link, for printing."""
+        try:
+            return link["sock"].getpeername()
+        except OSError:
+            return None
+
+    def send(self, link, ctype, body, circ_id):
+        """Send a frame on a link. A link that fails is closed, along with
+        its circuits, rather than taking down whoever was sending."""
+        self.send_many(link, [(ctype, body)], circ_id)
+
+    def send_many(self, link, frames, circ_id):
+        """Send frames for one circuit on a link, see send."""
+        if link["closed"]:
+            return
+        if not link["outbox"]:
+            link["last_sent"] = time.monotonic()
+        for ctype, body in frames:
+            link["outbox"].append(pack_header(ctype, len(body), circ_id))
+            link["outbox"].append(body)
+            link["queued"] += FRAME_HEADER.size + len(body)
+        self.flush(link)
+
+    def flush(self, link):
+        """Send as much of a link's outbox as it takes right now."""
+        if link["connecting"]:
+            return  # run() flushes it once the connection is up
+        try:
+            sent = send_queued(link["sock"], link["outbox"])
+        except OSError:
+            print("Link was closed or timed out.", file=sys.stderr)
+            self.close_link(link)
+            return
+        if sent:
+            link["queued"] -= sent
+            link["last_sent"] = time.monotonic()
+        if link["queued"] < OUTBOX_LOW_WATER:
+            # let the exit streams waiting on this link fetch more.
+            for stream in link["waiting"]:
+                stream["window"].release()
+            link["waiting"] = []
+
+    def close_stalled_links(self):
+        """Close the links that have taken nothing for CIRCUIT_TIMEOUT."""
+        now = time.monotonic()
+        for link in list(self.links.values()):
+            if link["outbox"] and now - link["last_sent"] > CIRCUIT_TIMEOUT:
+                print("Link was closed or timed out.", file=sys.stderr)
+                self.close_link(link)
+
+    def close_silent_links(self):
+        """Close the new connections that sent no handshake in time."""
+        now = time.monotonic()
+        for link in list(self.links.values()):
+            if link["handshake_by"] is not None \
+                    and now > link["handshake_by"]:
+                print("Client sent no handshake in time", file=sys.stderr)
+                self.close_link(link)
+
+    def close_link(self, link):
+        """Close a link and tear down every circuit that crossed it."""
+        if link["closed"]:
+            return
+        link["closed"] = True
+        self.forget_link(link)
+        for stream in link.get("waiting", ()):
+            stream["window"].release()  # lets its thread find out
+        for circuit in list(link["circuits"].values()):
+            self.destroy_circuit(circuit, link)
+        link["circuits"].clear()
+
+    def forget_link(self, link):
+        """Stop serving a closed link."""
+        self.links.pop(link["sock"], None)
+        self.forget_peer_link(link)
+        link["sock"].close()
+
+    def forget_peer_link(self, link):
+        """Take a closed link out of the links to its relay, if it is one."""
+        links = self.peer_links.get(link["peer"], [])
+        if link in links:
+            links.remove(link)
+            if not links:
+                del self.peer_links[link["peer"]]
+
+    def close_idle_links(self):
+        """Close the links to other relays that have carried no circuit
+        for LINK_IDLE_TIMEOUT. Only the relay that opened a link closes
+        it, since only it starts circuits on it."""
+        now = time.monotonic()
+        for links in list(self.peer_links.values()):
+            for link in list(links):
+                if link["circuits"]:
+                    link["idle_since"] = None
+                elif link["idle_since"] is None:
+                    link["idle_since"] = now
+                elif now - link["idle_since"] > LINK_IDLE_TIMEOUT:
+                    self.counters["links_expired"] += 1
+                    self.close_link(link)
+
+    def destroy_circuit(self, circuit, from_link):
+        """Tear down a circuit because from_link closed it or went away,
+        and tell the hop on its other side."""
+        prev_link, circ_id = circuit["link"], circuit["circ_id"]
+        if circuit["next"] is not None:
+            next_link, next_id = circuit["next"]
+            next_link["circuits"].pop(next_id, None)
+            circuit["next"] = None
+            if from_link is prev_link:
+                self.send(next_link, CellType.DESTROY, b"", next_id)
+            elif circuit["extending"]:
+                # the next hop never answered; the client may try another.
+                circuit["extending"] = False
+                self.send(prev_link, *self.extend_reply(circuit, None),
+                          circ_id)
+                return
+        if circuit["closed"]:
+            return
+        circuit["closed"] = True
+        self.circuit_count -= 1
+        prev_link["circuits"].pop(circ_id, None)
+        if from_link is not prev_link:
+            self.send(prev_link, CellType.DESTROY, b"", circ_id)
+        print("Client was closed or timed out.", file=sys.stderr)
+
+    def handle_frame(self, link, frame):
+        """Act on a frame that came in on link."""
+        ctype, circ_id, body = frame
+        circuit = link["circuits"].get(circ_id)
+        if ctype == CellType.DESTROY:
+            if circuit is not None:
+                self.destroy_circuit(circuit, link)
+        elif circuit is None:
+            # only whoever opened a link starts circuits on it.
+            if ctype == CellType.ADD_CON and link["peer"] is None:
+                self.start_handshake(link, circ_id, body)
+            else:
+                print(f"Frame for unknown circuit {circ_id}", file=sys.stderr)
+        elif circuit["link"] is link:
             try:
-                header = {
-                    "User-Agent": "Mozilla/5.0 "
-                                  + "(Windows NT 10.0; Win64; x64) "
-                                  + "AppleWebKit/537.36 (KHTML, like Gecko) "
-                                  + "Chrome/70.0.3538.77 Safari/537.36"
-                }
-                req = requests.get(request, headers=header)
-                print("Length of answer: " + str(len(req.content)))
-            except requests.exceptions.ConnectionError:
-                req = "ERROR"
-                print("Failed to receive response from website",
+                self.handle_cell(circuit, body)
+            except (struct.error, ValueError):
+                # the link carries other circuits; only this one goes.
+                print(f"Unreadable cell on circuit {circ_id}",
                       file=sys.stderr)
+                self.drop_circuit(circuit)
+        else:
+            self.handle_reply(circuit, frame)
 
-            payload_bytes = pickle.dumps(req)
-            total_length = len(payload_bytes)
-            if len(payload_bytes) > 4096:
-                payload_bytes = bytearray(payload_bytes)
-                while len(payload_bytes) > 4096:
-                    encrypted, init_vector = util.aes_encryptor(
-                        client_reference["key"],
-                        Cell(payload_bytes[:4096], ctype=CellType.CONTINUE)
-                    )
-                    out_pickle = pickle.dumps(
-                        Cell(encrypted, IV=init_vector, ctype=CellType.ADD_CON))
-                    client_reference["sock"].send(out_pickle)
-                    print(f"Sent one packet, length {len(out_pickle)}")
-                    # remove the bytes from the total bytes that have to be sent
-                    del payload_bytes[:4096]
-                    # slight delay for buffer issues
-                    time.sleep(0.001)
-
-                # encrypt and send what is left.
-                encrypted, init_vector = util.aes_encryptor(
-                    client_reference["key"],
-                    Cell(payload_bytes, ctype=CellType.CONNECT_RESP)
-                )
-                out_pickle = pickle.dumps(
-                    Cell(encrypted, IV=init_vector, ctype=CellType.FINISHED))
-                client_reference["sock"].send(out_pickle)
-                print(f"Sent last packet, length {len(out_pickle)}")
-                print("Finished sending valid replies.")
-            else:
-                encrypted, init_vector = util.aes_encryptor(
-                    client_reference["key"],
-                    Cell(payload_bytes, ctype=CellType.CONNECT_RESP)
-                )
-                out_pickle = pickle.dumps(
-                    Cell(encrypted, IV=init_vector, ctype=CellType.FINISHED))
-                client_reference["sock"].send(out_pickle)
-                print(f"Sent only packet, length {len(out_pickle)}")
-                print("Finished sending valid reply.")
-            print(f"Total length: {total_length}")
+    def drop_circuit(self, circuit):
+        """Tear down a circuit that sent a cell it cannot have meant,
+        telling the hops on both sides."""
+        if circuit["next"] is not None:
+            next_link, next_id = circuit["next"]
+            next_link["circuits"].pop(next_id, None)
+            circuit["next"] = None
+            circuit["extending"] = False
+            self.send(next_link, CellType.DESTROY, b"", next_id)
+        self.destroy_circuit(circuit, None)
+
+    def handle_cell(self, circuit, received):
+        """Decrypt a cell coming from the client's side and act on it.
+        Raises struct.error if it is not a cell."""
+        cell_to_next, _ = self.open_cell(circuit, received)
+        print("Got a packet from an existing client")
 
+        if util.RELAY_DEBUG:
+            print(f"Cell type: {cell_to_next.type}")
+
+        if cell_to_next.type == CellType.RELAY_CONNECT:
+            # is a request for a relay connect
+            self.counters["extends"] += 1
+            self.extend_circuit(circuit, cell_to_next)
+        elif cell_to_next.type == CellType.RELAY:
+            # is a cell that is to be relayed.
+            self.relay(circuit, cell_to_next)
+        elif cell_to_next.type == CellType.REQ:
+            self.counters["requests"] += 1
+            self.start_request(circuit, cell_to_next)
         else:
-            encrypted, init_vector = util.aes_encryptor(
-                client_reference["key"],
-                Cell("INVALID REQUEST DUMDUM", ctype=CellType.CONNECT_RESP)
-            )
-            client_reference["sock"].send(
-                pickle.dumps(
-                    Cell(encrypted, IV=init_vector, ctype=CellType.ADD_CON)
-                ))
-            print("INVALID REQUEST REPLIED")
+            print("Invalid cell type in relay handle_cell().",
+                  file=sys.stderr)
+
+    def handle_reply(self, circuit, frame):
+        """Pass a frame from the next hop back towards the client."""
+        if circuit["extending"]:
+            circuit["extending"] = False
+            if frame[0] != CellType.CONNECT_RESP:
+                # not a handshake reply; give up on this next hop.
+                next_link, next_id = circuit["next"]
+                next_link["circuits"].pop(next_id, None)
+                self.send(next_link, CellType.DESTROY, b"", next_id)
+                circuit["next"] = None
+                frame = None
+            self.send(circuit["link"], *self.extend_reply(circuit, frame),
+                      circuit["circ_id"])
+            if frame is not None:
+                print("Connection success.\n\n\n\n\n")
+            return
+        ctype, out_cell = self.relay_reply(circuit, frame)
+        self.send(circuit["link"], ctype, out_cell, circuit["circ_id"])
+        self.counters["bytes_relayed"] += len(out_cell)
 
     @staticmethod
-    def relay(client_reference, cell_to_next, decrypted):
-        """Method to Relay information to another relay, and stream information back."""
-        if client_reference["bounce_socket"] is None:
-            # There is no next hop registered to this client.
+    def seal(client_reference, inner_cell):
+        """Encrypt a cell for the client into a frame body."""
+        return client_reference["cipher"].backward.update(inner_cell.to_bytes())
+
+    @staticmethod
+    def open_cell(client_reference, received):
+        """Decrypt a cell received from the client."""
+        gotten_cell = Cell.from_bytes(received)
+        decrypted = client_reference["cipher"].forward.update(
+            gotten_cell.payload)
+        # decrypt the obtained cell
+        return Cell.from_bytes(decrypted), decrypted
+
+    @staticmethod
+    def extend_reply(client_reference, frame):
+        """Frame to send back to the client once the next hop answered
+        an extension (frame is None if it hung up instead)."""
+        if frame is None:
+            if util.RELAY_DEBUG:
+                print("sent failed")
+            return CellType.FAILED, Relay.seal(
+                client_reference,
+                Cell(Cell(b"", ctype=CellType.FAILED).to_bytes(),
+                     ctype=CellType.FAILED))
+        if util.RELAY_DEBUG:
+            print("sent valid response")
+        return CellType.FINISHED, Relay.seal(
+            client_reference,
+            Cell(frame[2], ctype=CellType.CONNECT_RESP))
+
+    @staticmethod
+    def extend_failure(client_reference):
+        """Frame to send back to the client if the next hop is unreachable."""
+        print("Failed to connect to other relay. "
+              + "Sending back failure message, or timed out.",
+              file=sys.stderr)
+        inner_cell_bytes = Cell(
+            b"CONNECTIONREFUSED", ctype=CellType.FAILED).to_bytes()
+        return CellType.FAILED, Relay.seal(
+            client_reference,
+            Cell(inner_cell_bytes, ctype=CellType.FAILED))
+
+    def pick_peer_link(self, address):
+        """The open link to the relay at address with the fewest circuits,
+        or None if a new one should be opened: there is none yet, or every
+        one carries LINK_CIRCUITS and there is room for another."""
+        links = self.peer_links.get(address)
+        if not links:
+            return None
+        link = min(links, key=lambda link: len(link["circuits"]))
+        if len(link["circuits"]) >= LINK_CIRCUITS \
+                and len(links) < self.max_peer_links:
+            return None
+        self.counters["links_reused"] += 1
+        return link
+
+    def add_peer_link(self, link):
+        """Start serving a link this relay opened to another one."""
+        self.peer_links.setdefault(link["peer"], []).append(link)
+        self.counters["links_opened"] += 1
+
+    def peer_link(self, address):
+        """A link to the relay at address, opening one if need be.
+        The connection is made in the background, so the frames sent on a
+        new link wait in its outbox until run() sees it come up. Raises
+        OSError if the connection cannot even be started."""
+        link = self.pick_peer_link(address)
+        if link is not None:
+            return link
+        # relays are listed by ip, so this never waits on a name lookup.
+        family, kind, proto, _, sockaddr = socket.getaddrinfo(
+            *address, type=socket.SOCK_STREAM, flags=socket.AI_NUMERICHOST)[0]
+        sock = socket.socket(family, kind, proto)
+        sock.setblocking(False)
+        error = sock.connect_ex(sockaddr)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise OSError(error, os.strerror(error))
+        link = self.new_link(sock, address)
+        link["connecting"] = error != 0
+        self.links[sock] = link
+        self.add_peer_link(link)
+        return link
+
+    def finish_connect(self, link):
+        """A link being opened became writable: it is either up, or the
+        relay could not be reached, which closes it and fails the circuits
+        extending over it."""
+        link["connecting"] = False
+        error = link["sock"].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            print(f"Failed to connect to relay {link['peer']}: "
+                  + os.strerror(error), file=sys.stderr)
+            self.close_link(link)
+
+    def extend_circuit(self, circuit, cell_to_next):
+        """Extend the circuit over the link to the next hop. The answer
+        comes back on that link, and handle_reply passes it on."""
+        if circuit["next"] is not None:
+            print("Circuit is already extended.", file=sys.stderr)
+            return
+        if not cell_to_next.ip_addr or not cell_to_next.port:
+            raise struct.error("Extend cell names no relay")
+        try:
+            link = self.peer_link((cell_to_next.ip_addr, cell_to_next.port))
+        except OSError:
+            self.send(circuit["link"], *self.extend_failure(circuit),
+                      circuit["circ_id"])
+            print("sent back failure message.")
             return
-        sock = client_reference["bounce_socket"]
+        self.attach_next(circuit, link, cell_to_next)
+
+    def attach_next(self, circuit, link, cell_to_next):
+        """Give circuit an id on the link to its next hop and send that
+        hop the handshake."""
+        next_id = link["next_circ_id"]
+        while next_id in link["circuits"]:
+            next_id = next_id % CIRC_ID_LIMIT + 1
+        link["next_circ_id"] = next_id % CIRC_ID_LIMIT + 1
+        link["circuits"][next_id] = circuit
+        circuit["next"] = (link, next_id)
+        circuit["extending"] = True
         if util.RELAY_DEBUG:
-            print("bouncing cell's decrypted..")
-            print(decrypted)
+            print((cell_to_next.ip_addr, cell_to_next.port))
             print("payload")
             print(cell_to_next.payload)
-            print(cell_to_next.type)
-            print("\n\n")
+        # send over the cell payload
+        self.send(link, CellType.ADD_CON, cell_to_next.payload, next_id)
 
-        sock.send(cell_to_next.payload)  # send over the cell
-        relay_pack_sizes = [
-            util.BASE_PACKET_SIZE + 192 * i for i in range(5)
-        ]
-        while True:
-            try:
-                recv_bytes = sock.recv(max(relay_pack_sizes) * 5)
-                if not recv_bytes:
-                    return
-            except socket.timeout:
-                their_cell = "request timed out!"
-            print("================================================")
-            print(f"Received packet, length {len(recv_bytes)}")
-            pack_size = relay_pack_sizes[0]
-            for r_pack_size in relay_pack_sizes:
-                if len(recv_bytes) % r_pack_size == 0:
-                    pack_size = r_pack_size
-            recv_cells = [
-                recv_bytes[i:i + pack_size]
-                for i in range(0, len(recv_bytes), pack_size)
-            ]
-
-            for recv_cell in recv_cells:
-                their_cell = pickle.loads(recv_cell)
-                print(their_cell.type)
-                if their_cell.type != CellType.FINISHED:
-                    # print("Got answer back.. as a relay.")
-                    encrypted, init_vector = util.aes_encryptor(
-                        client_reference["key"],
-                        Cell(their_cell, ctype=CellType.CONNECT_RESP)
-                    )
-                    out_pickle = pickle.dumps(Cell(
-                        encrypted, IV=init_vector, ctype=CellType.CONTINUE))
-                    client_reference["sock"].send(out_pickle)
-                    print(f"Relayed a packet, length {len(out_pickle)}.")
-                else:
-                    # print("Received the last packet.")
-                    encrypted, init_vector = util.aes_encryptor(
-                        client_reference["key"],
-                        Cell(their_cell, ctype=CellType.FINISHED)
-                    )
-                    out_pickle = pickle.dumps(Cell(
-                        encrypted, IV=init_vector, ctype=CellType.FINISHED))
-                    client_reference["sock"].send(out_pickle)
-                    print(f"Relayed last packet, length {len(out_pickle)}")
-                    print("Relay success.\n\n\n\n\n")
+    def relay(self, circuit, cell_to_next):
+        """Pass a cell on to the next hop; its answer comes back on the
+        next hop's link."""
+        if circuit["next"] is None or circuit["extending"]:
+            # There is no next hop registered to this client.
+            return
+        if util.RELAY_DEBUG:
+            print("bouncing cell's payload..")
+            print(cell_to_next.payload)
+        next_link, next_id = circuit["next"]
+        self.send(next_link, CellType.RELAY, cell_to_next.payload, next_id)
+
+    @staticmethod
+    def new_session():
+        """HTTP session the exit fetches websites through. It keeps
+        connections open between fetches, up to FETCH_POOL_SIZE for each
+        of the last FETCH_POOL_HOSTS websites; fetches past that make
+        their own connections and close them afterwards."""
+        session = requests.Session()
+        session.headers.update(FETCH_HEADERS)
+        # the session serves every client; cookies one website set for
+        # one of them must not go out with another's fetch.
+        session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=FETCH_POOL_HOSTS, pool_maxsize=FETCH_POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def count_fetch(self, req):
+        """Count a fetch, and whether it went over a connection that
+        was kept open from an earlier one."""
+        # a connection that was dropped is reopened on a new socket.
+        sock = getattr(getattr(req.raw, "connection", None), "sock", None)
+        with self.fetch_lock:
+            self.counters["fetches"] += 1
+            if sock is None:
+                return
+            if sock in self.used_connections:
+                self.counters["fetches_reused"] += 1
+            else:
+                self.used_connections.add(sock)
+
+    def fetch(self, request):
+        """Fetch a URL for the client without waiting for the whole body.
+        Yields the response head, then the body in chunks as they arrive.
+        Yields nothing if the website could not be reached.
+        The connection goes back to the session's pool once the whole
+        body has been read. With a cache, fresh responses are answered
+        from it, and stale ones it has are only fetched if they changed."""
+        entry = None
+        if self.cache is not None:
+            entry, fresh = self.cache.lookup(request)
+            if fresh:
+                print("Answered from the cache")
+                yield from self.cached_pieces(entry)
+                return
+        try:
+            req = self.session.get(
+                request, stream=True, timeout=self.fetch_timeout,
+                headers=self.cache.validators(entry) if entry else None)
+        except requests.exceptions.RequestException:
+            print("Failed to receive response from website",
+                  file=sys.stderr)
+            return
+        self.count_fetch(req)
+        with req:
+            if entry is not None and req.status_code == 304:
+                print("Website says the cached answer is still good")
+                entry = self.cache.revalidated(entry, req.headers.items())
+                yield from self.cached_pieces(entry)
+                return
+            yield util.pack_response_head(
+                req.status_code, req.reason, req.headers.items())
+            # the body is only collected if it can be kept.
+            body = bytearray() if self.cache is not None \
+                and self.cache.storable(req.status_code,
+                                        req.headers.items()) else None
+            total_length = 0
+            for chunk in req.iter_content(RESPONSE_READ_SIZE):
+                total_length += len(chunk)
+                if body is not None:
+                    body += chunk
+                    if len(body) > self.cache.max_entry_bytes:
+                        body = None
+                yield chunk
+        print("Length of answer: " + str(total_length))
+        if body is not None:
+            # kept under the url asked for, which lookup goes by, and after
+            # redirects under the one they led to as well.
+            body = bytes(body)
+            for url in {request, req.url}:
+                self.cache.store(url, req.status_code, req.reason,
+                                 req.headers.items(), body)
+
+    @staticmethod
+    def cached_pieces(entry):
+        """A cached response, in the pieces fetch yields."""
+        yield util.pack_response_head(
+            entry["status_code"], entry["reason"],
+            httpcache.HttpCache.headers_with_age(entry))
+        body = memoryview(entry["body"])
+        for start in range(0, len(body), RESPONSE_READ_SIZE):
+            yield body[start:start + RESPONSE_READ_SIZE]
+
+    @staticmethod
+    def seal_chunks(client_reference, piece, chunk_size,
+                    header=CONTINUE_HEADER):
+        """Encrypt a piece of the response as CONTINUE cells of up to
+        chunk_size bytes each, each behind the given cell header.
+        The cells are laid out in one buffer and encrypted in place; the
+        returned frame bodies are views into it."""
+        piece = memoryview(piece)
+        count = -(-len(piece) // chunk_size)
+        total = len(piece) + count * len(header)
+        buffer = bytearray(total + util.CTR_SLACK)
+        view = memoryview(buffer)
+        bounds = []
+        offset = 0
+        for start in range(0, len(piece), chunk_size):
+            chunk = piece[start:start + chunk_size]
+            payload_start = offset + len(header)
+            view[offset:payload_start] = header
+            view[payload_start:payload_start + len(chunk)] = chunk
+            bounds.append((offset, payload_start + len(chunk)))
+            offset = payload_start + len(chunk)
+        client_reference["cipher"].backward.update_into(view[:total], buffer)
+        return [view[start:end] for start, end in bounds]
+
+    @staticmethod
+    def piece_frames(client_reference, piece, sent, stream_id=None):
+        """Encrypt a piece read from the website into CONTINUE frames for
+        the client. sent is how many frames of the stream went before."""
+        # the head has to arrive whole, in the first frame.
+        chunk_size = RESPONSE_CHUNK_SIZE if sent else len(piece)
+        header = CONTINUE_HEADER if stream_id is None \
+            else Cell(b"", ctype=CellType.CONTINUE,
+                      stream_id=stream_id).to_bytes()
+        bodies = Relay.seal_chunks(client_reference, piece, chunk_size,
+                                   header)
+        print(f"Sent {len(bodies)} packets, length {len(piece)}")
+        return [(CellType.CONTINUE, body) for body in bodies]
+
+    @staticmethod
+    def finish_frame(client_reference, sent, stream_id=None):
+        """The empty FINISHED frame that ends a stream of sent frames.
+        Its inner type tells the client whether the response is complete."""
+        inner_type = CellType.CONNECT_RESP if sent else CellType.FAILED
+        print("Finished sending replies." if sent
+              else "Sent back failure message.")
+        return CellType.FINISHED, Relay.seal(
+            client_reference,
+            Cell(b"", ctype=inner_type, stream_id=stream_id))
+
+    @staticmethod
+    def response_frames(client_reference, pieces, stream_id=None):
+        """Encrypt a streamed response into frames for the client, yielding
+        a list of them for every piece read from the website:
+        CONTINUE frames for the head and the body chunks, then an
+        empty FINISHED frame, or a FAILED one if the website broke off."""
+        sent = 0
+        try:
+            for piece in pieces:
+                frames = Relay.piece_frames(
+                    client_reference, piece, sent, stream_id)
+                yield frames
+                sent += len(frames)
+        except requests.exceptions.RequestException:
+            print("Response from website broke off", file=sys.stderr)
+            sent = 0
+        yield [Relay.finish_frame(client_reference, sent, stream_id)]
+
+    @staticmethod
+    def invalid_request(client_reference, stream_id=None):
+        """Frame to send back for a request that could not be read. It fails
+        the stream the way an unreachable website does, since the circuit
+        itself is fine."""
+        print("Request is not a readable URL", file=sys.stderr)
+        return CellType.FINISHED, Relay.seal(
+            client_reference,
+            Cell(b"Request is not a readable URL", ctype=CellType.FAILED,
+                 stream_id=stream_id))
+
+    @staticmethod
+    def decode_request(cell_to_next):
+        """The URL carried by a REQ cell, or None if it is not readable."""
+        print(cell_to_next.payload)
+        try:
+            return cell_to_next.payload.decode() or None
+        except UnicodeDecodeError:
+            return None
+
+    def start_request(self, circuit, cell_to_next):
+        """Fetch a request in a thread of its own, so other streams and
+        circuits carry on meanwhile. The pieces it reads are encrypted and
+        sent by the select loop, which keeps the circuit's keystream in
+        the order the cells go out."""
+        request = self.decode_request(cell_to_next)
+        if not request:
+            self.send(circuit["link"], *self.invalid_request(
+                circuit, cell_to_next.stream_id), circuit["circ_id"])
+            return
+        stream = {
+            "circuit": circuit,
+            "stream_id": cell_to_next.stream_id,
+            "sent": 0,  # frames sent so far
+            # pieces the fetching thread may read ahead of the loop.
+            "window": threading.Semaphore(FETCH_AHEAD)
+        }
+        threading.Thread(target=self.fetch_stream, args=(stream, request),
+                         daemon=True).start()
+
+    def fetch_stream(self, stream, request):
+        """Body of a fetching thread: hand the response to the select
+        loop a piece at a time, then None once it is over."""
+        pieces = self.fetch(request)
+        try:
+            for piece in pieces:
+                stream["window"].acquire()
+                if stream["circuit"]["closed"]:
                     return
+                self.fetched.append((stream, piece))
+                self.wake(None)
+        except requests.exceptions.RequestException:
+            print("Response from website broke off", file=sys.stderr)
+            self.fetched.append((stream, FETCH_FAILED))
+        finally:
+            pieces.close()
+        self.fetched.append((stream, None))
+        self.wake(None)
+
+    def send_fetched(self):
+        """Encrypt and send whatever the fetching threads have read."""
+        while self.fetched:
+            stream, piece = self.fetched.popleft()
+            circuit = stream["circuit"]
+            if piece is FETCH_FAILED:
+                stream["failed"] = True
+                continue
+            if circuit["closed"]:
+                if piece is not None:
+                    stream["window"].release()  # lets the thread find out
+                continue
+            if piece is None:
+                sent = 0 if stream.get("failed") else stream["sent"]
+                self.send(circuit["link"], *self.finish_frame(
+                    circuit, sent, stream["stream_id"]), circuit["circ_id"])
+                continue
+            frames = self.piece_frames(
+                circuit, piece, stream["sent"], stream["stream_id"])
+            self.send_many(circuit["link"], frames, circuit["circ_id"])
+            stream["sent"] += len(frames)
+            self.counters["bytes_relayed"] += sum(
+                len(body) for _, body in frames)
+            if circuit["link"]["queued"] < OUTBOX_LOW_WATER:
+                stream["window"].release()
+            else:
+                # the client is behind; fetch more once it catches up.
+                circuit["link"]["waiting"].append(stream)
+
+    @staticmethod
+    def relay_reply(client_reference, frame):
+        """Add this hop's layer to a frame coming back from the next hop.
+        Only the body is encrypted, so the frame type passes through."""
+        ctype, _, body = frame
+        print("================================================")
+        print(f"Received packet, length {len(body)}")
+        print(ctype)
+        out_cell = client_reference["cipher"].backward.update(body)
+        if ctype == CellType.CONTINUE:
+            print(f"Relayed a packet, length {len(out_cell)}.")
+        else:
+            print(f"Relayed last packet, length {len(out_cell)}")
+            print("Relay success.\n\n\n\n\n")
+        return ctype, out_cell
 
     def run(self):
         """main method"""
-        client_obj = None  # initialise as none.
-        read_ready, _, _ = select.select(
-            [self.relay_socket] + self.CLIENT_SOCKS, [], [])
+        sending = [sock for sock, link in self.links.items() if link["outbox"]]
+        greeting = any(link["handshake_by"] is not None
+                       for link in self.links.values())
+        if greeting:
+            timeout = HANDSHAKE_TIMEOUT
+        elif sending or self.peer_links:
+            timeout = LINK_SWEEP_INTERVAL
+        else:
+            timeout = None
+        read_ready, write_ready, _ = select.select(
+            [self.relay_socket, self.wakeup_reader] + list(self.links),
+            sending, [], timeout)
+        for sock in write_ready:
+            link = self.links.get(sock)
+            if link is not None and link["connecting"]:
+                self.finish_connect(link)
+            if link is not None and not link["closed"]:
+                self.flush(link)
+        self.close_stalled_links()
+        self.close_silent_links()
+        self.close_idle_links()
         for i in read_ready:
-            if i == self.relay_socket:  # i've gotten a new connection
-                print("Client connecting...")
-                client_sock, _ = self.relay_socket.accept()
-                client_sock.settimeout(0.3)
-                try:
-                    client_obj = self.handle_client(client_sock)
-                    if not client_obj:  # client object is None
-                        continue
-                except (struct.error, ConnectionResetError,
-                        socket.timeout, pickle.UnpicklingError,
-                        pickle.PickleError):
-                    print("ERROR! might have timed out, or inappropriate data "
-                          + "was provided!", file=sys.stderr)
-                    if client_obj is not None:
-                        self.CLIENTS.remove(client_obj)
-                    continue
+            if i == self.wakeup_reader:
+                # crypto workers or fetching threads are done with some
+                self.wakeup_reader.recv(4096)
+                self.finish_pending_handshakes()
+                self.send_fetched()
+            elif i == self.relay_socket:  # i've gotten a new connection
+                self.accept()
             else:
-                # came from an existing client
-                for k in self.CLIENTS:
-                    if k["sock"] == i:
-                        # identify the sending client
-                        sending_client = k
-                        continue
+                # came from an existing link, unless it closed just now
+                link = self.links.get(i)
+                if link is not None:
+                    self.read_link(link)
+
+    def read_link(self, link):
+        """Handle the frames that arrived on a link."""
+        reader = link["reader"]
+        while True:
+            try:
+                frame = reader.read_frame()
+                if frame is None:
+                    # the other end hung up.
+                    raise ConnectionResetError
+                if link["handshake_by"] is not None:
+                    # a new connection has to start with a handshake.
+                    if frame[0] != CellType.ADD_CON:
+                        raise FramingError("Connection did not start "
+                                           + "with a handshake")
+                    link["handshake_by"] = None
+                self.handle_frame(link, frame)
+            except BlockingIOError:
+                return  # the rest of the frame is still on its way
+            except (struct.error, OSError, FramingError):
+                print("Link was closed or timed out.", file=sys.stderr)
+                self.close_link(link)
+                return
+            # select() cannot see frames that are already buffered.
+            if link["closed"] or not reader.pending():
+                return
+
+
+class AsyncRelay(Relay):
+    """Relay that serves every link on an asyncio event loop.
+    Each link has one task reading from it, and each request its own task
+    fetching from the website, so a slow hop or website only stalls the
+    circuits that depend on it."""
+
+    def __init__(self, *args, **kwargs):
+        Relay.__init__(self, *args, **kwargs)
+        self.loop = None
+        self.connecting = {}  # address -> future for a link being opened
+        self.written = []  # links written to since they were last drained
+
+    def run_forever(self):
+        """Serve circuits until interrupted."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.relay_socket.setblocking(False)
+        server = self.loop.run_until_complete(asyncio.start_server(
+            self.handle_link, sock=self.relay_socket))
+        sweeper = self.loop.create_task(self.sweep_loop())
+        try:
+            self.loop.run_forever()
+        finally:
+            sweeper.cancel()
+            # the server waits for its connections to close, and the
+            # neighbours it has links from may be waiting on ours.
+            for link in list(self.links.values()):
+                self.close_link(link)
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+
+    async def sweep_loop(self):
+        """Close idle links every LINK_SWEEP_INTERVAL seconds."""
+        while True:
+            await asyncio.sleep(LINK_SWEEP_INTERVAL)
+            self.close_idle_links()
+
+    def new_link(self, writer, peer=None):
+        """Record for a link, written to through an asyncio StreamWriter."""
+        return {
+            "writer": writer,
+            "drain_lock": asyncio.Lock(),
+            "circuits": {},
+            "peer": peer,
+            "next_circ_id": 1,
+            "closed": False,
+            "idle_since": None
+        }
+
+    @staticmethod
+    def link_name(link):
+        """Address of the other end of a link, for printing."""
+        return link["writer"].get_extra_info("peername")
+
+    def send_many(self, link, frames, circ_id):
+        """Queue frames for one circuit on a link; whoever is handling the
+        frame that caused them drains it afterwards."""
+        if link["closed"]:
+            return
+        write_frames(link["writer"], frames, circ_id)
+        if link not in self.written:
+            self.written.append(link)
+
+    async def drain(self, link):
+        """Wait for a link to take what was written to it."""
+        if link["closed"]:
+            return
+        try:
+            # several tasks may be writing to one link.
+            async with link["drain_lock"]:
+                await link["writer"].drain()
+        except OSError:
+            print("Link was closed or timed out.", file=sys.stderr)
+            self.close_link(link)
+
+    async def drain_written(self):
+        """Drain every link written to since the last call."""
+        written, self.written = self.written, []
+        for link in written:
+            await self.drain(link)
+
+    def forget_link(self, link):
+        """Stop serving a closed link; its reading task ends with it."""
+        self.links.pop(link["writer"], None)
+        self.forget_peer_link(link)
+        link["writer"].close()
+
+    async def handle_link(self, reader, writer):
+        """Serve a link someone opened to us, from its first handshake
+        until it closes."""
+        print("Client connecting...")
+        try:
+            frame = await asyncio.wait_for(
+                read_frame_async(reader), HANDSHAKE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, FramingError):
+            print("ERROR! might have timed out, or inappropriate data "
+                  + "was provided!", file=sys.stderr)
+            frame = None
+        if frame is None or frame[0] != CellType.ADD_CON:
+            writer.close()
+            return
+        link = self.new_link(writer)
+        self.links[writer] = link
+        self.handle_frame(link, frame)
+        await self.drain_written()
+        await self.serve_link(link, reader)
+
+    async def serve_link(self, link, reader):
+        """Handle the frames coming in on a link until it closes."""
+        try:
+            while not link["closed"]:
+                frame = await read_frame_async(reader)
+                if frame is None:
+                    break
+                self.handle_frame(link, frame)
+                await self.drain_written()
+        except (OSError, struct.error, FramingError):
+            print("Link was closed or timed out.", file=sys.stderr)
+        finally:
+            self.close_link(link)
+            await self.drain_written()
+
+    def start_handshake(self, link, circ_id, body):
+        """Answer an ADD_CON frame; with crypto workers, in a task of its
+        own that waits for them."""
+        if not self.crypto_workers:
+            Relay.start_handshake(self, link, circ_id, body)
+            return
+        self.loop.create_task(self.offloaded_handshake(link, circ_id, body))
+
+    async def offloaded_handshake(self, link, circ_id, body):
+        """Have a crypto worker answer a handshake, then reply to it."""
+        try:
+            answer = await asyncio.wrap_future(self.submit_handshake(body))
+        except Exception:  # pylint: disable=broad-except
+            answer = None
+        if link["closed"]:
+            print("Client left before its handshake was answered",
+                  file=sys.stderr)
+            return
+        self.finish_handshake(link, circ_id, answer)
+        await self.drain_written()
+
+    def extend_circuit(self, circuit, cell_to_next):
+        """Extend the circuit to the next hop without blocking other
+        circuits, opening the link to it first if need be."""
+        if circuit["next"] is not None:
+            print("Circuit is already extended.", file=sys.stderr)
+            return
+        if not cell_to_next.ip_addr or not cell_to_next.port:
+            raise struct.error("Extend cell names no relay")
+        address = (cell_to_next.ip_addr, cell_to_next.port)
+        link = self.pick_peer_link(address)
+        if link is not None:
+            self.attach_next(circuit, link, cell_to_next)
+            return
+        self.loop.create_task(
+            self.extend_circuit_async(circuit, address, cell_to_next))
+
+    async def extend_circuit_async(self, circuit, address, cell_to_next):
+        """Extend the circuit once the link to the next hop is open."""
+        try:
+            link = await self.open_peer_link(address)
+        except (OSError, asyncio.TimeoutError):
+            link = None
+        if circuit["closed"]:
+            return
+        if link is None:
+            self.send(circuit["link"], *self.extend_failure(circuit),
+                      circuit["circ_id"])
+            print("sent back failure message.")
+        else:
+            self.attach_next(circuit, link, cell_to_next)
+        await self.drain_written()
+
+    async def open_peer_link(self, address):
+        """Open a link to the relay at address. Circuits heading there at
+        the same time wait for the same connection."""
+        if address in self.connecting:
+            self.counters["links_reused"] += 1
+            return await asyncio.shield(self.connecting[address])
+        future = self.loop.create_future()
+        self.connecting[address] = future
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(*address), CIRCUIT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as error:
+            future.set_exception(error)
+            future.exception()  # waited for by nobody, maybe
+            raise
+        finally:
+            del self.connecting[address]
+        link = self.new_link(writer, address)
+        self.links[writer] = link
+        self.add_peer_link(link)
+        self.loop.create_task(self.serve_link(link, reader))
+        future.set_result(link)
+        return link
+
+    def start_request(self, circuit, cell_to_next):
+        """Fetch a request in a task of its own."""
+        self.loop.create_task(self.request_processing_async(
+            circuit, cell_to_next))
+
+    async def request_processing_async(self, circuit, cell_to_next):
+        """Fetch the request in a worker thread and stream the answer back.
+        Each piece is read in the executor, so a slow website only holds up
+        its own stream, and encrypted here, so the streams of a circuit
+        keep its keystream in the order their cells go out."""
+        link, circ_id = circuit["link"], circuit["circ_id"]
+        stream_id = cell_to_next.stream_id
+        request = self.decode_request(cell_to_next)
+        if not request:
+            self.send(link, *self.invalid_request(circuit, stream_id),
+                      circ_id)
+            await self.drain(link)
+            return
+        pieces = self.fetch(request)
+        sent = 0
+        try:
+            while not circuit["closed"]:
                 try:
-                    received = i.recv(4096)
-                    print("Got a packet from an existing client")
-                    if not received:
-                        # received None
-                        # shouldn't be possible but just in case.
-                        raise ConnectionResetError
-                except (struct.error, ConnectionResetError,
-                        ConnectionAbortedError, socket.timeout):
-                    print("Client was closed or timed out.", file=sys.stderr)
-                    # clean up the client and delete.
-                    sending_client["sock"].close()
-                    if sending_client["bounce_socket"] is not None:
-                        sending_client["bounce_socket"].close()
-                    self.CLIENT_SOCKS.remove(i)
-                    self.CLIENTS.remove(sending_client)
-                    continue
-
-                gotten_cell = pickle.loads(received)
-                decrypted = util.aes_decryptor(
-                    sending_client["key"], gotten_cell)
-                # decrypt the obtained cell
-                cell_to_next = pickle.loads(decrypted)
-
-                if util.RELAY_DEBUG:
-                    print(f"Cell type: {cell_to_next.type}")
-
-                if cell_to_next.type == CellType.RELAY_CONNECT:
-                    # is a request for a relay connect
-                    self.extend_circuit(
-                        sending_client, cell_to_next, decrypted, i)
-                elif cell_to_next.type == CellType.RELAY:
-                    # is a cell that is to be relayed.
-                    self.relay(sending_client, cell_to_next, decrypted)
-                elif cell_to_next.type == CellType.REQ:
-                    self.request_processing(sending_client, cell_to_next)
-                else:
-                    print("Invalid cell type in relay run().",
-                          file=sys.stderr)
+                    piece = await self.loop.run_in_executor(
+                        None, next, pieces, None)
+                except requests.exceptions.RequestException:
+                    print("Response from website broke off", file=sys.stderr)
+                    sent = 0
+                    break
+                if piece is None:
+                    break
+                frames = self.piece_frames(circuit, piece, sent, stream_id)
+                self.send_many(link, frames, circ_id)
+                sent += len(frames)
+                self.counters["bytes_relayed"] += sum(
+                    len(body) for _, body in frames)
+                await self.drain(link)
+        finally:
+            pieces.close()
+        if not circuit["closed"]:
+            self.send(link, *self.finish_frame(circuit, sent, stream_id),
+                      circ_id)
+            await self.drain(link)
+
+
+class StatusReporter:
+    """Tells the directory how much traffic a relay carries and how many
+    circuits it has open, for clients to weigh it by when picking paths.
+    The bandwidth reported is the best rate of the last BANDWIDTH_WINDOW
+    reports, since a relay that has been idle for a while can still carry
+    what it did before."""
+
+    def __init__(self, directory_socket):
+        self.directory_socket = directory_socket
+        self.rates = collections.deque(maxlen=BANDWIDTH_WINDOW)
+        self.last_bytes = None
+        self.last_time = None
+
+    def report(self, bytes_relayed, circuits):
+        """Send the directory a status worked out from the relay's
+        bytes_relayed counter and open circuits."""
+        now = time.monotonic()
+        if self.last_time is not None and now > self.last_time:
+            self.rates.append(
+                (bytes_relayed - self.last_bytes) / (now - self.last_time))
+        self.last_bytes, self.last_time = bytes_relayed, now
+        bandwidth = int(max(self.rates)) if self.rates else 0
+        send_frame(self.directory_socket, CellType.RELAY_STATUS, Cell(
+            util.pack_relay_status(bandwidth, circuits),
+            ctype=CellType.RELAY_STATUS).to_bytes())
+
+
+def serve(relay):
+    """Serve circuits until interrupted."""
+    relay.start_crypto_workers()
+    relay.start_status_reports()
+    if isinstance(relay, AsyncRelay):
+        try:
+            relay.run_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        while True:
+            try:
+                relay.run()
+            except KeyboardInterrupt:
+                if relay.relay_socket:
+                    relay.relay_socket.close()
+                break
+    # a second signal must not cut the clean up short.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if relay.crypto_executor is not None:
+        # the workers only go once told to, so wait until they have been.
+        relay.crypto_executor.shutdown()
+
+
+def _interrupt(signum, frame):
+    """Turn a SIGTERM into the KeyboardInterrupt serve() stops on."""
+    raise KeyboardInterrupt
+
+
+def merge_stats(all_stats):
+    """Add up the stats of several workers. Minimums stay minimums."""
+    merged = {}
+    for stats in all_stats:
+        for name, value in stats.items():
+            if isinstance(value, dict):
+                merged[name] = merge_stats([merged.get(name, {}), value])
+            elif name not in merged:
+                merged[name] = value
+            elif name.startswith("min_"):
+                merged[name] = min(merged[name], value)
+            else:
+                merged[name] += value
+    return merged
+
+
+class RelayWorkers:
+    """Serves one relay from several forked worker processes, so its
+    handshakes and AES layers are not pinned to a single core.
+    The workers share the relay's port and each carries its own circuits.
+    This process holds the one directory registration and adds up the
+    stats every worker reports over a pipe."""
+
+    def __init__(self, relay, count, ephemeral_pool_size):
+        self.relay = relay
+        self.count = count
+        self.ephemeral_pool_size = ephemeral_pool_size
+        self.workers = {}  # stats pipe -> worker record
+        self.finished = []  # last stats of the workers that have exited
+        self.last_printed = None
+        self.reporter = None  # reports the workers' load to the directory
+
+    def start(self, directory_address):
+        """Fork the workers, then register the relay."""
+        for index in range(self.count):
+            self.spawn(index)
+        # the workers have their own copies of the listening socket.
+        self.relay.relay_socket.close()
+        if directory_address is not None:
+            self.relay.register(directory_address)
+            self.reporter = StatusReporter(self.relay.directory_socket)
+
+    def spawn(self, index):
+        """Fork a worker, keeping the read end of its stats pipe."""
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            for other in self.workers:
+                os.close(other)
+            try:
+                self.work(write_end, index)
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        self.workers[read_end] = {
+            "index": index,
+            "pid": pid,
+            "stats": {},
+            "buffer": b""
+        }
+        print(f"Started worker {index} as process {pid}")
+
+    def work(self, write_end, index):
+        """Body of a worker: serve circuits, reporting stats as we go."""
+        signal.signal(signal.SIGTERM, _interrupt)
+        relay = self.relay
+        relay.after_fork(self.ephemeral_pool_size, index)
+        report_lock = threading.Lock()
+        stopped = threading.Event()
+
+        def report():
+            with report_lock:
+                os.write(write_end, json.dumps(relay.stats()).encode()
+                         + b"\n")
+
+        def report_loop():
+            while not stopped.wait(WORKER_STATS_INTERVAL):
+                report()
+
+        threading.Thread(target=report_loop, daemon=True).start()
+        try:
+            serve(relay)
+        finally:
+            stopped.set()
+            report()
+
+    def read_stats(self, read_end):
+        """Take in what a worker reported, or clean up after it exited."""
+        worker = self.workers[read_end]
+        received = os.read(read_end, 65536)
+        if not received:
+            os.close(read_end)
+            os.waitpid(worker["pid"], 0)
+            del self.workers[read_end]
+            self.finished.append(worker["stats"])
+            print(f"Worker {worker['index']} (process {worker['pid']}) "
+                  + "exited")
+            return
+        *lines, worker["buffer"] = (worker["buffer"] + received).split(b"\n")
+        if lines:
+            worker["stats"] = json.loads(lines[-1].decode())
+
+    def stats(self):
+        """Every worker's stats added up, with the share of each worker."""
+        live = [worker["stats"] for worker in self.workers.values()]
+        stats = merge_stats(live + self.finished)
+        if "cache" in stats:  # the ratios were added up
+            stats["cache"]["hit_ratio"] = httpcache.hit_ratio(stats["cache"])
+        stats["workers"] = [
+            {"pid": worker["pid"],
+             "circuits": worker["stats"].get("circuits", 0),
+             "open_circuits": worker["stats"].get("open_circuits", 0)}
+            for worker in self.workers.values()
+        ]
+        return stats
+
+    def report_status(self):
+        """Report the load of all the workers together to the directory."""
+        stats = self.stats()
+        circuits = sum(worker["open_circuits"] for worker in stats["workers"])
+        try:
+            self.reporter.report(stats.get("bytes_relayed", 0), circuits)
+        except OSError:
+            self.reporter = None  # the directory is gone
+
+    def print_stats(self):
+        """Print the added up stats if they changed since the last time."""
+        stats = self.stats()
+        if stats != self.last_printed:
+            print(f"Relay stats: {stats}")
+            self.last_printed = stats
+
+    def supervise(self):
+        """Gather stats until the workers are gone or we are interrupted,
+        then stop the workers and print their final stats."""
+        signal.signal(signal.SIGTERM, _interrupt)
+        next_report = time.monotonic() + STATUS_INTERVAL
+        try:
+            while self.workers:
+                read_ready, _, _ = select.select(
+                    list(self.workers), [], [],
+                    max(next_report - time.monotonic(), 0))
+                for read_end in read_ready:
+                    self.read_stats(read_end)
+                self.print_stats()
+                if time.monotonic() >= next_report:
+                    next_report += STATUS_INTERVAL
+                    if self.reporter is not None:
+                        self.report_status()
+        except KeyboardInterrupt:
+            pass
+        for worker in self.workers.values():
+            try:
+                os.kill(worker["pid"], signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        while self.workers:
+            read_ready, _, _ = select.select(list(self.workers), [], [])
+            for read_end in read_ready:
+                self.read_stats(read_end)
+        print(f"Relay stats: {self.stats()}")
 
 
 def main():
     """Main function"""
     # sys.argv = input("you know the drill. \n")  # added for my debug
     # sys.argv = sys.argv.split()  # added for console debug
-    if len(sys.argv) == 2 or len(sys.argv) == 4:
+    options = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    relay_class = AsyncRelay if "--async" in options else Relay
+    ephemeral_pool_size = util.EPHEMERAL_POOL_SIZE
+    suite = util.SUITE_RSA
+    workers = 1
+    crypto_workers = 0
+    max_peer_links = MAX_PEER_LINKS
+    fetch_timeout = FETCH_TIMEOUT
+    cache_size = None
+    cache_directory = None
+    for option in options:
+        if option.startswith("--ephemeral-pool="):
+            ephemeral_pool_size = int(option.split("=", 1)[1])
+        elif option.startswith("--suite="):
+            suite = option.split("=", 1)[1]
+        elif option.startswith("--workers="):
+            workers = int(option.split("=", 1)[1])
+        elif option.startswith("--crypto-workers="):
+            crypto_workers = int(option.split("=", 1)[1])
+        elif option.startswith("--max-peer-links="):
+            max_peer_links = max(1, int(option.split("=", 1)[1]))
+        elif option.startswith("--fetch-timeout="):
+            # one number for both, or connect,read
+            timeouts = [float(timeout) for timeout
+                        in option.split("=", 1)[1].split(",")]
+            fetch_timeout = tuple(timeouts) if len(timeouts) == 2 \
+                else timeouts[0]
+        elif option.startswith("--cache="):
+            cache_size = int(float(option.split("=", 1)[1]) * 1024 * 1024)
+        elif option.startswith("--cache-dir="):
+            cache_directory = option.split("=", 1)[1]
+    if suite not in util.HANDSHAKE_SUITES:
+        print(f"Unknown suite {suite}, pick one of "
+              + ", ".join(util.HANDSHAKE_SUITES))
+        return
+    cache = None
+    if cache_size is not None or cache_directory is not None:
+        cache = httpcache.HttpCache(
+            httpcache.DEFAULT_CACHE_SIZE if cache_size is None else cache_size,
+            cache_directory)
+    if workers > 1 and not hasattr(os, "fork"):
+        print("--workers needs os.fork(), running a single process")
+        workers = 1
+    if len(args) == 1 or len(args) == 3:
         identity = None
-        port = sys.argv[1]
+        port = args[0]
         if port == "a":
             port = 45000
             identity = "0"
@@ -481,22 +1740,42 @@ def main():
             port = 45004
             identity = "4"
 
-        if len(sys.argv) == 4:
-            relay = Relay(int(port), identity, (sys.argv[2], int(sys.argv[3])))
+        if len(args) == 3:
+            directory_address = (args[1], int(args[2]))
         else:
-            relay = Relay(int(port), identity)
+            directory_address = ("127.0.0.1", 50000)
+        if workers > 1:
+            # the workers register once they are listening, and make their
+            # own key pools; nothing here may be running threads at the fork.
+            relay = relay_class(int(port), identity, None, 0, suite,
+                                reuse_port=hasattr(socket, "SO_REUSEPORT"),
+                                crypto_workers=crypto_workers,
+                                max_peer_links=max_peer_links,
+                                fetch_timeout=fetch_timeout, cache=cache)
+        else:
+            relay = relay_class(int(port), identity, directory_address,
+                                ephemeral_pool_size, suite,
+                                crypto_workers=crypto_workers,
+                                max_peer_links=max_peer_links,
+                                fetch_timeout=fetch_timeout, cache=cache)
     else:
-        print("Usage: python relay.py [port] (directory ip) (directory port)")
+        print("Usage: python relay.py [port] (directory ip) (directory port)"
+              + " (--async) (--ephemeral-pool=N) (--suite=rsa|x25519)"
+              + " (--workers=N) (--crypto-workers=N) (--max-peer-links=N)"
+              + " (--fetch-timeout=S|connect,read) (--cache=MB)"
+              + " (--cache-dir=path)")
         return
 
-    print("Started relay on "+str(port) + " with identity " + str(identity))
-    while True:
-        try:
-            relay.run()
-        except KeyboardInterrupt:
-            if relay.relay_socket:
-                relay.relay_socket.close()
-            break
+    print("Started relay on "+str(port) + " with identity " + str(identity)
+          + " and the " + suite + " handshake suite")
+    if workers > 1:
+        relay_workers = RelayWorkers(relay, workers, ephemeral_pool_size)
+        relay_workers.start(directory_address)
+        relay_workers.supervise()
+        return
+    signal.signal(signal.SIGTERM, _interrupt)
+    serve(relay)
+    print(f"Relay stats: {relay.stats()}")
 
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
-"""Generate RSA keys"""
+"""Generate RSA keys, or the Ed25519 keys of x25519 relays with
+python rsa_keygen.py ed25519"""
 
-from cryptography.hazmat.primitives.asymmetric import rsa
+import sys
+
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 
@@ -46,5 +49,27 @@ def main():
             key_file.close()
 
 
+def ed25519_main(count=11):
+    """Generate the identity keys used by relays with --suite=x25519"""
+    for i in range(count):
+        key = ed25519.Ed25519PrivateKey.generate()
+        private_bytes = key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        public_bytes = key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        with open("privates/ed25519test" + str(i) + ".pem", "wb") as private_file:
+            private_file.write(private_bytes)
+        with open("publics/ed25519test" + str(i) + ".pem", "wb") as public:
+            public.write(public_bytes)
+
+
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["ed25519"]:
+        ed25519_main()
+    else:
+        main()
@@ -0,0 +1,39 @@
+"""Tests for the cell codec. Run with: python -m unittest test_cell"""
+import struct
+import unittest
+
+from cell import CELL_HEADER, HAS_ADDR, Cell, CellType
+
+
+class CellCodecTest(unittest.TestCase):
+    """Cells must round trip, and anything else must be a struct.error."""
+
+    def test_round_trip(self):
+        cell = Cell(b"payload", ctype=CellType.RELAY, stream_id=7)
+        cell.ip_addr = "127.0.0.1"
+        cell.port = 45001
+        unpacked = Cell.from_bytes(cell.to_bytes())
+        self.assertEqual(unpacked.payload, b"payload")
+        self.assertEqual(unpacked.ip_addr, "127.0.0.1")
+        self.assertEqual(unpacked.port, 45001)
+        self.assertEqual(unpacked.stream_id, 7)
+
+    def test_address_not_utf8(self):
+        data = CELL_HEADER.pack(CellType.RELAY.value, HAS_ADDR, 0, 0) \
+            + b"\x01\xff"
+        with self.assertRaises(struct.error):
+            Cell.from_bytes(data)
+
+    def test_truncated(self):
+        data = CELL_HEADER.pack(CellType.RELAY.value, HAS_ADDR, 0, 0) \
+            + b"\x09abc"
+        with self.assertRaises(struct.error):
+            Cell.from_bytes(data)
+
+    def test_unknown_type(self):
+        with self.assertRaises(struct.error):
+            Cell.from_bytes(CELL_HEADER.pack(250, 0, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
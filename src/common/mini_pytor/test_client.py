@@ -0,0 +1,140 @@
+"""Tests for the client's circuit pool. Run with: python -m unittest test_client"""
+import unittest
+from unittest import mock
+
+import client
+from client import CircuitPool
+
+
+class FakeCircuit:
+    """Stands in for a built Client."""
+
+    def __init__(self, length):
+        self.relay_list = [None] * length
+        self.alive = True
+        self.closed = False
+
+    def is_alive(self):
+        return self.alive and not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDirectory:
+    """Stands in for a DirectoryCache listing a few relays."""
+
+    def __init__(self, *args, **kwargs):
+        self.relays = [{} for _ in range(4)]
+        self.down = False
+
+    def start(self):
+        pass
+
+    def get(self):
+        if self.down:
+            raise ConnectionRefusedError
+        return self.relays
+
+    def stats(self):
+        return {}
+
+
+class FakePool(CircuitPool):
+    """A pool that builds fake circuits, and only when asked to."""
+
+    def _build(self, num_of_relays, order=client.RANDOM_RELAY_ORDER):
+        self.builds.append(num_of_relays)
+        return FakeCircuit(num_of_relays)
+
+    def _refill_loop(self):
+        pass  # the tests refill by hand
+
+
+class CircuitPoolTest(unittest.TestCase):
+    """Circuits are reused, shared, and retired when spent or broken."""
+
+    def setUp(self):
+        patches = [mock.patch.object(client, "DirectoryCache", FakeDirectory),
+                   mock.patch.object(client.Client, "ephemeral_keys")]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.pool = FakePool(lengths=(3,), size=2, max_age=60, max_uses=3,
+                             max_streams=2)
+        self.pool.builds = []
+
+    def test_reused_once_released(self):
+        first = self.pool.acquire(3)
+        self.pool.release(first)
+        self.assertEqual(len(self.pool.idle[3]), 1)
+        self.assertIs(self.pool.acquire(3), first)
+        stats = self.pool.stats()
+        self.assertEqual((stats["misses"], stats["hits"]), (1, 1))
+        self.assertEqual(self.pool.builds, [3])
+
+    def test_shared_up_to_max_streams(self):
+        first = self.pool.acquire(3)
+        self.assertIs(self.pool.acquire(3), first)
+        self.assertIsNot(self.pool.acquire(3), first)
+        self.assertEqual(self.pool.stats()["shared"], 1)
+        # only the last of its requests hands it back.
+        self.pool.release(first)
+        self.assertEqual(self.pool.idle[3], [])
+        self.pool.release(first)
+        self.assertEqual(len(self.pool.idle[3]), 1)
+
+    def test_unmet_count_pooled_as_three(self):
+        my_client = self.pool.acquire(9)
+        self.assertEqual(self.pool.builds, [3])
+        self.pool.release(my_client)
+        self.assertEqual(list(self.pool.idle), [3])
+        self.assertIs(self.pool.acquire(9), my_client)
+
+    def test_directory_down(self):
+        self.pool.directory.down = True
+        self.pool.acquire(4)
+        self.assertEqual(self.pool.builds, [4])
+
+    def test_unhealthy_retired(self):
+        my_client = self.pool.acquire(3)
+        self.pool.release(my_client, healthy=False)
+        self.assertTrue(my_client.closed)
+        self.assertEqual(self.pool.idle[3], [])
+        self.assertEqual(self.pool.stats()["unhealthy"], 1)
+
+    def test_dead_idle_circuit_retired(self):
+        my_client = self.pool.acquire(3)
+        self.pool.release(my_client)
+        my_client.alive = False
+        self.assertIsNot(self.pool.acquire(3), my_client)
+        self.assertEqual(self.pool.stats()["unhealthy"], 1)
+
+    def test_max_age(self):
+        my_client = self.pool.acquire(3)
+        self.pool.release(my_client)
+        self.pool.idle[3][0]["created"] -= 61
+        self.assertIsNot(self.pool.acquire(3), my_client)
+        self.assertTrue(my_client.closed)
+        self.assertEqual(self.pool.stats()["retired"], 1)
+
+    def test_max_age_while_idle(self):
+        my_client = self.pool.acquire(3)
+        self.pool.release(my_client)
+        self.pool.idle[3][0]["created"] -= 61
+        self.pool._check_idle()
+        self.assertEqual(self.pool.idle[3], [])
+        self.assertTrue(my_client.closed)
+
+    def test_max_uses(self):
+        my_client = self.pool.acquire(3)
+        for _ in range(2):
+            self.pool.release(my_client)
+            self.assertIs(self.pool.acquire(3), my_client)
+        self.pool.release(my_client)  # its third use
+        self.assertTrue(my_client.closed)
+        self.assertEqual(self.pool.idle[3], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Tests for signed consensus documents. Run with: python -m unittest test_consensus"""
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import unittest
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.backends import default_backend
+
+import consensus
+
+RELAYS = [{"ip_addr": "127.0.0.1", "port": 45000, "key": b"key0",
+           "bandwidth": 100, "circuits": 2},
+          {"ip_addr": "127.0.0.1", "port": 45001, "key": b"key1"}]
+
+
+def new_key():
+    return rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend())
+
+
+class ConsensusTest(unittest.TestCase):
+    """Documents must only be taken from the directory, and while fresh."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = new_key()
+        cls.public_key = cls.key.public_key()
+
+    def test_round_trip(self):
+        document = consensus.pack_consensus(self.key, "epoch", 7, RELAYS)
+        unpacked = consensus.unpack_consensus(document, self.public_key)
+        self.assertEqual((unpacked["epoch"], unpacked["version"]),
+                         ("epoch", 7))
+        self.assertEqual([relay["key"] for relay in unpacked["relays"]],
+                         [b"key0", b"key1"])
+        self.assertEqual(unpacked["relays"][1]["bandwidth"], 0)
+
+    def test_other_key(self):
+        document = consensus.pack_consensus(new_key(), "epoch", 7, RELAYS)
+        with self.assertRaises(InvalidSignature):
+            consensus.unpack_consensus(document, self.public_key)
+
+    def test_tampered(self):
+        document = consensus.pack_consensus(self.key, "epoch", 7, RELAYS)
+        with self.assertRaises(InvalidSignature):
+            consensus.unpack_consensus(
+                document.replace(b"45001", b"45666"), self.public_key)
+
+    def test_expired(self):
+        document = consensus.pack_consensus(
+            self.key, "epoch", 7, RELAYS, lifetime=-1)
+        with self.assertRaises(ValueError):
+            consensus.unpack_consensus(document, self.public_key)
+
+    def test_truncated(self):
+        document = consensus.pack_consensus(self.key, "epoch", 7, RELAYS)
+        with self.assertRaises(struct.error):
+            consensus.unpack_consensus(document[:100], self.public_key)
+
+
+class DirectoryKeyTest(unittest.TestCase):
+    """The signing key is made on first use and kept from then on."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_made_once(self):
+        private_path = os.path.join(self.directory, "privates", "directory.pem")
+        public_path = os.path.join(self.directory, "directory.pem")
+        key = consensus.load_directory_key(private_path, public_path)
+        self.assertEqual(stat.S_IMODE(os.stat(private_path).st_mode), 0o600)
+        public_key = consensus.load_directory_public_key(public_path)
+        self.assertEqual(public_key.public_numbers(),
+                         key.public_key().public_numbers())
+        again = consensus.load_directory_key(private_path, public_path)
+        self.assertEqual(
+            again.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()),
+            key.private_bytes(serialization.Encoding.PEM,
+                              serialization.PrivateFormat.PKCS8,
+                              serialization.NoEncryption()))
+
+
+class ConsensusFileTest(unittest.TestCase):
+    """Published documents are served from the file."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_publish(self):
+        path = os.path.join(self.directory, "consensus.bin")
+        served = consensus.ConsensusFile(path)
+        self.assertIsNone(served.serve())
+        served.publish(b"first")
+        served.publish(b"second")
+        self.assertEqual(bytes(served.serve()), b"second")
+        restarted = consensus.ConsensusFile(path)
+        self.assertTrue(restarted.load())
+        self.assertEqual(bytes(restarted.serve()), b"second")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Tests for the directory's relay registry. Run with: python -m unittest test_directory"""
+import collections
+import unittest
+
+import util
+from cell import Cell
+from directory import BANDWIDTH_FLOOR, UPDATE_CHUNK, RelayRegistry
+
+
+def relay(port, **fields):
+    return dict({"ip_addr": "127.0.0.1", "port": port,
+                 "key": b"key%d" % port}, **fields)
+
+
+def read_update(frames):
+    """The chunks of an update, unpacked."""
+    return [util.unpack_directory_update(Cell.from_bytes(frame).payload)
+            for frame in frames]
+
+
+class RelayRegistryTest(unittest.TestCase):
+    """Clients that say what they have get only what changed since."""
+
+    def setUp(self):
+        self.registry = RelayRegistry()
+        self.registry.add(relay(45000), fileno=10)
+        self.registry.add(relay(45001), fileno=11)
+
+    def ports(self, relays):
+        return sorted(relay["port"] for relay in relays)
+
+    def test_full_for_another_epoch(self):
+        update, = read_update(self.registry.update(None, 0))
+        self.assertTrue(update["full"])
+        self.assertEqual(update["epoch"], self.registry.epoch)
+        self.assertEqual(update["version"], 2)
+        self.assertEqual(self.ports(update["added"]), [45000, 45001])
+        self.assertEqual(update["removed"], [])
+
+    def test_diff(self):
+        epoch, since = self.registry.epoch, self.registry.version
+        self.registry.add(relay(45002), fileno=12)
+        self.registry.remove(10)
+        update, = read_update(self.registry.update(epoch, since))
+        self.assertFalse(update["full"])
+        self.assertEqual(update["version"], since + 2)
+        self.assertEqual(self.ports(update["added"]), [45002])
+        self.assertEqual(update["removed"], [("127.0.0.1", 45000)])
+
+    def test_nothing_changed(self):
+        update, = read_update(self.registry.update(
+            self.registry.epoch, self.registry.version))
+        self.assertFalse(update["full"])
+        self.assertEqual((update["added"], update["removed"]), ([], []))
+
+    def test_joined_and_left_since(self):
+        epoch, since = self.registry.epoch, self.registry.version
+        self.registry.add(relay(45002), fileno=12)
+        self.registry.remove(12)
+        update, = read_update(self.registry.update(epoch, since))
+        self.assertEqual(update["added"], [])
+        self.assertEqual(update["removed"], [("127.0.0.1", 45002)])
+
+    def test_registered_again(self):
+        self.registry.add(relay(45000, key=b"new"), fileno=20)
+        self.assertIsNone(self.registry.remove(10))  # the old connection
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(self.registry.remove(20)["key"], b"new")
+
+    def test_small_reports_kept_back(self):
+        version = self.registry.version
+        self.registry.report(10, BANDWIDTH_FLOOR // 2, 1)
+        self.assertEqual(self.registry.version, version)
+        self.registry.report(10, BANDWIDTH_FLOOR * 4, 1)
+        self.assertEqual(self.registry.version, version + 1)
+        update, = read_update(self.registry.update(
+            self.registry.epoch, version))
+        self.assertEqual(update["added"][0]["bandwidth"], BANDWIDTH_FLOOR * 4)
+
+    def test_full_once_history_is_gone(self):
+        self.registry.changes = collections.deque(
+            self.registry.changes, maxlen=2)
+        epoch = self.registry.epoch
+        self.registry.add(relay(45002), fileno=12)
+        self.registry.add(relay(45003), fileno=13)
+        update, = read_update(self.registry.update(epoch, 1))
+        self.assertTrue(update["full"])
+        update, = read_update(self.registry.update(epoch, 3))
+        self.assertFalse(update["full"])
+        self.assertEqual(self.ports(update["added"]), [45003])
+
+    def test_chunks(self):
+        for i in range(UPDATE_CHUNK + 10):
+            self.registry.add(relay(50000 + i), fileno=100 + i)
+        chunks = read_update(self.registry.update(None, 0))
+        self.assertEqual([chunk["more"] for chunk in chunks], [True, False])
+        self.assertEqual(sum(len(chunk["added"]) for chunk in chunks),
+                         UPDATE_CHUNK + 12)
+
+    def test_update_reused(self):
+        epoch, since = self.registry.epoch, self.registry.version
+        self.registry.add(relay(45002), fileno=12)
+        first = self.registry.update(epoch, since)
+        self.assertIs(self.registry.update(epoch, since), first)
+        self.assertEqual(self.registry.stats()["update_hits"], 1)
+        self.registry.remove(12)
+        self.assertIsNot(self.registry.update(epoch, since), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Tests for frame reading. Run with: python -m unittest test_framing"""
+import socket
+import unittest
+
+from cell import CellType
+from framing import (FRAME_HEADER, MAX_FRAME_SIZE, FrameReader, FramingError,
+                     pack_header)
+
+
+def frame(ctype, body, circ_id=1):
+    return pack_header(ctype, len(body), circ_id) + body
+
+
+class FrameReaderTest(unittest.TestCase):
+    """Frames must come out whole however the byte stream is cut up."""
+
+    def setUp(self):
+        self.sender, receiver = socket.socketpair()
+        receiver.setblocking(False)
+        self.reader = FrameReader(receiver)
+        self.addCleanup(self.sender.close)
+        self.addCleanup(receiver.close)
+
+    def test_partial_frame(self):
+        data = frame(CellType.RELAY, b"hello", circ_id=9)
+        self.sender.sendall(data[:FRAME_HEADER.size + 2])
+        with self.assertRaises(BlockingIOError):
+            self.reader.read_frame()  # the rest is still on its way
+        self.assertFalse(self.reader.pending())
+        self.sender.sendall(data[FRAME_HEADER.size + 2:])
+        self.assertEqual(self.reader.read_frame(),
+                         (CellType.RELAY, 9, b"hello"))
+
+    def test_header_split(self):
+        data = frame(CellType.CONTINUE, b"abc")
+        self.sender.sendall(data[:3])
+        with self.assertRaises(BlockingIOError):
+            self.reader.read_frame()
+        self.sender.sendall(data[3:])
+        self.assertEqual(self.reader.read_frame(),
+                         (CellType.CONTINUE, 1, b"abc"))
+
+    def test_frames_in_one_read(self):
+        self.sender.sendall(frame(CellType.CONTINUE, b"one")
+                            + frame(CellType.FINISHED, b"", circ_id=2)
+                            + frame(CellType.RELAY, b"thr")[:4])
+        self.assertEqual(self.reader.read_frame(),
+                         (CellType.CONTINUE, 1, b"one"))
+        self.assertTrue(self.reader.pending())
+        self.assertEqual(self.reader.read_frame(),
+                         (CellType.FINISHED, 2, b""))
+        self.assertFalse(self.reader.pending())
+
+    def test_closed_between_frames(self):
+        self.sender.sendall(frame(CellType.RELAY, b"x"))
+        self.sender.close()
+        self.assertEqual(self.reader.read_frame(), (CellType.RELAY, 1, b"x"))
+        self.assertIsNone(self.reader.read_frame())
+
+    def test_closed_mid_frame(self):
+        self.sender.sendall(frame(CellType.RELAY, b"hello")[:-1])
+        self.sender.close()
+        with self.assertRaises(ConnectionResetError):
+            self.reader.read_frame()
+
+    def test_too_large(self):
+        self.sender.sendall(FRAME_HEADER.pack(
+            MAX_FRAME_SIZE + 1, CellType.RELAY.value, 1))
+        with self.assertRaises(FramingError):
+            self.reader.read_frame()
+
+    def test_unknown_type(self):
+        self.sender.sendall(FRAME_HEADER.pack(0, 250, 1))
+        with self.assertRaises(FramingError):
+            self.reader.read_frame()
+
+
+if __name__ == "__main__":
+    unittest.main()
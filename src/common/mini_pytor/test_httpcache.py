@@ -0,0 +1,144 @@
+"""Tests for the HTTP response cache. Run with: python -m unittest test_httpcache"""
+import email.utils
+import os
+import shutil
+import tempfile
+import unittest
+
+import httpcache
+from httpcache import HttpCache, freshness_lifetime
+
+NOW = 1000000000.0
+LAST_MODIFIED = email.utils.formatdate(NOW - 10 * 24 * 3600, usegmt=True)
+
+
+class FreshnessTest(unittest.TestCase):
+    """How long responses stay fresh, and which are kept at all."""
+
+    def test_max_age(self):
+        self.assertEqual(freshness_lifetime(
+            200, [("Cache-Control", "max-age=60")], True, NOW), 60)
+
+    def test_age_counts_against_it(self):
+        self.assertEqual(freshness_lifetime(
+            200, [("Cache-Control", "max-age=60"), ("Age", "15")],
+            True, NOW), 45)
+
+    def test_s_maxage_only_for_shared(self):
+        headers = [("Cache-Control", "max-age=60, s-maxage=5")]
+        self.assertEqual(freshness_lifetime(200, headers, True, NOW), 5)
+        self.assertEqual(freshness_lifetime(200, headers, False, NOW), 60)
+
+    def test_no_store(self):
+        self.assertIsNone(freshness_lifetime(
+            200, [("Cache-Control", "no-store, max-age=60")], False, NOW))
+
+    def test_private_only_for_one_user(self):
+        headers = [("Cache-Control", "private, max-age=60")]
+        self.assertIsNone(freshness_lifetime(200, headers, True, NOW))
+        self.assertEqual(freshness_lifetime(200, headers, False, NOW), 60)
+
+    def test_cookies_not_shared(self):
+        headers = [("Cache-Control", "max-age=60"), ("Set-Cookie", "a=b")]
+        self.assertIsNone(freshness_lifetime(200, headers, True, NOW))
+
+    def test_heuristic(self):
+        lifetime = freshness_lifetime(
+            200, [("Last-Modified", LAST_MODIFIED)], True, NOW)
+        self.assertAlmostEqual(lifetime, 10 * 24 * 3600 * 0.1)
+
+    def test_stale_without_validators(self):
+        self.assertIsNone(freshness_lifetime(
+            200, [("Cache-Control", "no-cache")], True, NOW))
+        self.assertEqual(freshness_lifetime(
+            200, [("Cache-Control", "no-cache"), ("ETag", '"v1"')],
+            True, NOW), 0)
+
+    def test_uncacheable_status(self):
+        self.assertIsNone(freshness_lifetime(
+            500, [("Last-Modified", LAST_MODIFIED)], True, NOW))
+        self.assertEqual(freshness_lifetime(
+            500, [("Cache-Control", "max-age=60")], True, NOW), 60)
+
+
+class HttpCacheTest(unittest.TestCase):
+    """Keeping, evicting and revalidating responses."""
+
+    FRESH = [("Cache-Control", "max-age=60")]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_lookup(self):
+        cache = HttpCache(800)
+        self.assertEqual(cache.lookup("http://a/"), (None, False))
+        cache.store("http://a/", 200, "OK", self.FRESH, b"body")
+        entry, fresh = cache.lookup("http://a/")
+        self.assertTrue(fresh)
+        self.assertEqual(entry["body"], b"body")
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_not_kept(self):
+        cache = HttpCache(800)
+        self.assertIsNone(cache.store(
+            "http://a/", 200, "OK", [("Cache-Control", "no-store")], b"x"))
+        self.assertIsNone(cache.store(
+            "http://a/", 200, "OK", self.FRESH, b"x" * 101))  # over 800 / 8
+        self.assertEqual(cache.lookup("http://a/"), (None, False))
+
+    def test_least_recently_used_go_first(self):
+        cache = HttpCache(800)
+        for i in range(8):
+            cache.store(f"http://a/{i}", 200, "OK", self.FRESH, b"x" * 100)
+        cache.lookup("http://a/0")  # now the most recently used
+        cache.store("http://a/8", 200, "OK", self.FRESH, b"x" * 100)
+        self.assertIsNotNone(cache.lookup("http://a/0")[0])
+        self.assertIsNone(cache.lookup("http://a/1")[0])
+        stats = cache.stats()
+        self.assertEqual(stats["evicted"], 1)
+        self.assertEqual(stats["bytes"], 800)
+
+    def test_revalidation(self):
+        cache = HttpCache(800)
+        cache.store("http://a/", 200, "OK",
+                    [("Cache-Control", "no-cache"), ("ETag", '"v1"')], b"old")
+        entry, fresh = cache.lookup("http://a/")
+        self.assertFalse(fresh)
+        self.assertEqual(cache.validators(entry), {"If-None-Match": '"v1"'})
+        entry = cache.revalidated(entry, [("Cache-Control", "max-age=60"),
+                                          ("Content-Length", "0")])
+        self.assertEqual(entry["body"], b"old")
+        self.assertEqual(httpcache.header_value(entry["headers"], "ETag"),
+                         '"v1"')
+        self.assertIsNone(httpcache.header_value(
+            entry["headers"], "Content-Length"))
+        self.assertTrue(cache.lookup("http://a/")[1])
+        self.assertEqual(cache.stats()["revalidated"], 1)
+
+    def test_kept_on_disk(self):
+        cache = HttpCache(800, self.directory)
+        cache.store("http://a/", 200, "OK", self.FRESH, b"body")
+        restarted = HttpCache(800, self.directory)
+        entry, fresh = restarted.lookup("http://a/")
+        self.assertTrue(fresh)
+        self.assertEqual(entry["body"], b"body")
+
+    def test_for_worker(self):
+        cache = HttpCache(800, self.directory, max_disk_bytes=5000)
+        worker = cache.for_worker(1)
+        self.assertEqual(worker.directory,
+                         os.path.join(self.directory, "worker1"))
+        self.assertEqual((worker.max_bytes, worker.max_disk_bytes,
+                          worker.shared), (800, 5000, True))
+        worker.store("http://a/", 200, "OK", self.FRESH, b"body")
+        self.assertEqual(os.listdir(worker.directory),
+                         [HttpCache.file_name("http://a/")])
+        # the workers' directories are not entries of the parent's.
+        self.assertEqual(HttpCache(800, self.directory).stats()["disk_bytes"],
+                         0)
+        self.assertIsNone(HttpCache(800).for_worker(1).directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,58 +1,172 @@
 """Suite of utility methods"""
 
-import os
-import pickle
+import json
+import threading
+from collections import deque
 
-from cryptography.hazmat.primitives import padding, asymmetric, hashes
+from cryptography.hazmat.primitives import asymmetric, hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, x25519
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
-
-from cell import Cell
-
 RELAY_DEBUG = False
 CLIENT_DEBUG = False
-BASE_PACKET_SIZE = 4406
-WRAPPER_SIZE = 192
-
-
-def padder128(data):
-    """ pad ip to 256 bits... because this can vary too"""
-    padder1b = padding.PKCS7(128).padder()
-    p1b = padder1b.update(data)
-    p1b += padder1b.finalize()
-    return p1b
-
-
-def aes_encryptor(secret_key, cell):
-    """Encrypt something given a secret key. and data."""
-    if not isinstance(cell, Cell):
-        raise Exception("AES encryptor input is not Cell")
-    init_vector = os.urandom(16)
-    cipher = Cipher(
-        algorithms.AES(secret_key),
-        modes.CBC(init_vector),
+DERIVED_KEY_SIZE = 64  # an AES-256 key for each direction of a hop
+# room update_into() wants past the end of its output, a block less one.
+CTR_SLACK = 15
+EPHEMERAL_POOL_SIZE = 32  # ECDH key pairs kept ready for handshakes
+
+# handshake suites a relay can offer, advertised in the directory listing.
+# rsa: RSA-4096 OAEP wrapped SECP384R1 keys, with RSA-PSS signatures.
+# x25519: X25519 keys sent in the clear, with an Ed25519 signature over
+# both public keys and the salt.
+SUITE_RSA = "rsa"
+SUITE_X25519 = "x25519"
+HANDSHAKE_SUITES = (SUITE_RSA, SUITE_X25519)
+X25519_KEY_SIZE = 32  # bytes in a raw X25519 public key
+
+
+class LayerCipher:
+    """Crypto context for one hop of a circuit, made once after the key
+    exchange. Each direction is an AES-CTR keystream that both ends keep
+    running for the life of the circuit, so cells need no IV or padding,
+    but every byte must be processed in the order it was sent."""
+
+    def __init__(self, derived_key):
+        # forward carries the client's cells out, backward the replies.
+        self.forward = _ctr_stream(derived_key[:32])
+        self.backward = _ctr_stream(derived_key[32:])
+
+
+def _ctr_stream(key):
+    """AES-CTR context; encrypting and decrypting are the same operation.
+    Every key is fresh from the handshake, so the counter can start at 0."""
+    return Cipher(
+        algorithms.AES(key),
+        modes.CTR(bytes(16)),
         backend=default_backend()
+    ).encryptor()
+
+
+class EphemeralKeyPool:
+    """Supply of ready made ephemeral ECDH key pairs, each with its public
+    key already serialised, so a handshake does not wait for a key to be
+    generated. A background thread tops the pool back up to size once it
+    drops below the low watermark; if it ever runs dry, keys are made
+    on the spot instead."""
+
+    def __init__(self, size=EPHEMERAL_POOL_SIZE, low_watermark=None,
+                 make_key_pair=None):
+        self.size = size
+        self.make_key_pair = make_key_pair or ecdh_key_pair
+        self.low_watermark = size // 4 if low_watermark is None \
+            else low_watermark
+        self.keys = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.refiller = None
+        self.counters = {
+            "taken": 0,
+            "generated": 0,
+            "inline": 0,  # taken while the pool was empty
+            "below_low_watermark": 0,  # taken leaving fewer than that
+            "min_available": size
+        }
+
+    def start(self):
+        """Start filling the pool in the background, if not yet started."""
+        with self.lock:
+            if self.refiller is None and self.size > 0:
+                self.refiller = threading.Thread(
+                    target=self._refill_loop, daemon=True)
+                self.refiller.start()
+
+    def take(self):
+        """Hand out a key pair, as (private key, PEM public key)."""
+        self.start()
+        with self.lock:
+            key_pair = self.keys.popleft() if self.keys else None
+            available = len(self.keys)
+            self.counters["taken"] += 1
+            self.counters["min_available"] = min(
+                self.counters["min_available"], available)
+            if key_pair is None:
+                self.counters["inline"] += 1
+            low = available < self.low_watermark
+            if low:
+                self.counters["below_low_watermark"] += 1
+        if low:
+            self.wakeup.set()
+        return key_pair or self.make_key_pair()
+
+    def _refill_loop(self):
+        """Fill the pool up to size whenever take() finds it low."""
+        while True:
+            self.wakeup.clear()
+            while len(self.keys) < self.size:
+                key_pair = self.make_key_pair()
+                with self.lock:
+                    self.keys.append(key_pair)
+                    self.counters["generated"] += 1
+            self.wakeup.wait()
+
+    def stats(self):
+        """Snapshot of the pool counters."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["available"] = len(self.keys)
+        stats["size"] = self.size
+        stats["low_watermark"] = self.low_watermark
+        return stats
+
+
+def ecdh_key_pair():
+    """Make a SECP384R1 key pair, returning it with its PEM public key."""
+    private_key = ec.generate_private_key(
+        ec.SECP384R1(), default_backend())  # elliptic curve
+    public_bytes = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
     )
-    encryptor = cipher.encryptor()
-    encrypted = encryptor.update(padder128(pickle.dumps(cell)))
-    encrypted += encryptor.finalize()  # finalise decryption
-    return encrypted, init_vector
-
-
-def aes_decryptor(secret_key, cell):
-    """Decrypt cell's payload with an AES key"""
-    if not isinstance(cell, Cell):
-        raise Exception("AES encryptor input is not Cell")
-    cipher = Cipher(
-        algorithms.AES(secret_key),
-        modes.CBC(cell.init_vector),
-        backend=default_backend()
+    return private_key, public_bytes
+
+
+def x25519_key_pair():
+    """Make an X25519 key pair, returning it with its raw public key."""
+    private_key = x25519.X25519PrivateKey.generate()
+    return private_key, x25519_public_bytes(private_key)
+
+
+def x25519_public_bytes(private_key):
+    """The 32 byte public half of an X25519 key, as sent in cells."""
+    return private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
     )
-    decryptor = cipher.decryptor()
-    decrypted = decryptor.update(cell.payload)
-    decrypted += decryptor.finalize()  # finalise decryption
-    return decrypted
+
+
+def x25519_transcript(client_public, relay_public, salt):
+    """What an x25519 relay signs: both halves of the exchange and the
+    salt, so nobody in between can swap either key."""
+    return b"x25519" + client_public + relay_public + salt
+
+
+def suite_of(identity_key):
+    """The handshake suite that goes with a relay's identity key."""
+    if isinstance(identity_key, (ed25519.Ed25519PublicKey,
+                                 ed25519.Ed25519PrivateKey)):
+        return SUITE_X25519
+    return SUITE_RSA
+
+
+def verify_signature(pubkey, signature, message):
+    """Verify a signature made by a relay's identity key, of either suite.
+    Raises InvalidSignature if it does not match."""
+    if suite_of(pubkey) == SUITE_X25519:
+        pubkey.verify(signature, message)
+    else:
+        rsa_verify(pubkey, signature, message)
 
 
 def rsa_verify(pubkey, signature, message):
@@ -66,3 +180,106 @@ def rsa_verify(pubkey, signature, message):
             salt_length=asymmetric.padding.PSS.MAX_LENGTH),
         hashes.SHA256()
     )
+
+
+def raise_open_file_limit():
+    """Allow this process as many open files as the system lets it have,
+    for servers holding a connection per peer."""
+    try:
+        import resource
+    except ImportError:  # Windows has no such limit to raise
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass  # keep what we have
+
+
+def relay_entry(relay):
+    """The fields of a relay that go into a listing"""
+    return {"ip_addr": relay["ip_addr"], "port": relay["port"],
+            "key": relay["key"].decode(),
+            "suite": relay.get("suite", SUITE_RSA),
+            "bandwidth": relay.get("bandwidth", 0),
+            "circuits": relay.get("circuits", 0)}
+
+
+def read_relay_entries(relays):
+    """Inverse of relay_entry, in place"""
+    for relay in relays:
+        relay["key"] = relay["key"].encode()
+        relay.setdefault("suite", SUITE_RSA)
+        relay.setdefault("bandwidth", 0)
+        relay.setdefault("circuits", 0)
+    return relays
+
+
+def pack_relay_list(relays):
+    """Serialise the directory's relay list for a GET_DIRECT cell"""
+    return json.dumps([relay_entry(relay) for relay in relays]).encode()
+
+
+def unpack_relay_list(payload):
+    """Inverse of pack_relay_list"""
+    return read_relay_entries(json.loads(payload.decode()))
+
+
+def pack_relay_status(bandwidth, circuits):
+    """Serialise the load a relay reports to the directory: the bytes per
+    second it has shown it can carry and the circuits it has open"""
+    return json.dumps({"bandwidth": bandwidth, "circuits": circuits}).encode()
+
+
+def unpack_relay_status(payload):
+    """Inverse of pack_relay_status, giving (bandwidth, circuits)"""
+    status = json.loads(payload.decode())
+    return max(int(status["bandwidth"]), 0), max(int(status["circuits"]), 0)
+
+
+def pack_directory_request(epoch, version):
+    """Serialise a GET_DIRECT request for the changes to the directory
+    since the given version of its listing.
+    An epoch of None asks for the whole listing."""
+    return json.dumps({"epoch": epoch, "since": version}).encode()
+
+
+def unpack_directory_request(payload):
+    """Inverse of pack_directory_request, giving (epoch, version)"""
+    request = json.loads(payload.decode())
+    return request["epoch"], int(request["since"])
+
+
+def pack_directory_update(epoch, version, full, added, removed, more):
+    """Serialise one chunk of the directory's answer to a GET_DIRECT
+    request: the relays that joined (or all of them, if full) and the
+    (ip, port) of those that left, and whether more chunks follow."""
+    return json.dumps({
+        "epoch": epoch, "version": version, "full": full, "more": more,
+        "added": [relay_entry(relay) for relay in added],
+        "removed": removed
+    }).encode()
+
+
+def unpack_directory_update(payload):
+    """Inverse of pack_directory_update"""
+    update = json.loads(payload.decode())
+    read_relay_entries(update["added"])
+    update["removed"] = [tuple(address) for address in update["removed"]]
+    return update
+
+
+def pack_response_head(status_code, reason, headers):
+    """Serialise the status line and headers of a response,
+    which the exit relay sends ahead of the body"""
+    return json.dumps({
+        "status_code": status_code,
+        "reason": reason,
+        "headers": [[name, value] for name, value in headers]
+    }).encode()
+
+
+def unpack_response_head(payload):
+    """Inverse of pack_response_head"""
+    return json.loads(payload.decode())